@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+# Standard library imports
+from collections import OrderedDict
+import argparse
+import functools
+import json
+import multiprocessing as mp
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Make the local package and the synthetic data generators importable when running from a source checkout
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~GLOBALS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+BENCHMARKS = OrderedDict()
+
+def benchmark (name, unit):
+    """
+    Register a benchmark function. The function is called with the dict of synthetic data files and a temporary output
+    directory. It does the imports and setup and returns a callable without arguments, which is the only timed part, and the
+    number of items processed (in unit) to compute the throughput
+    """
+    def decorator (func):
+        BENCHMARKS[name] = (func, unit)
+        return func
+    return decorator
+
+#~~~~~~~~~~~~~~~~~~~~~~~~Synthetic dataset~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def make_dataset (data_dir, scale=1.0, seed=42):
+    """
+    Generate all the synthetic input files in data_dir if they do not already exist and return a dict of file paths and sizes.
+    The number of reference bases, calls, sites and intervals grows linearly with scale
+    """
+    import synthetic
+
+    data_fn = os.path.join(data_dir, "dataset.json")
+    if os.path.isfile(data_fn):
+        with open(data_fn) as fp:
+            return json.load(fp)
+
+    os.makedirs(data_dir, exist_ok=True)
+    d = OrderedDict()
+    chrom_len = int(1000000*scale)
+    d["ref_fasta"] = os.path.join(data_dir, "ref.fa")
+    seq_d = synthetic.make_reference(d["ref_fasta"], n_chrom=3, chrom_len=chrom_len, seed=seed)
+    d["n_bases"] = 3*chrom_len
+
+    d["calls"] = os.path.join(data_dir, "calls.tsv")
+    d["n_calls"] = synthetic.make_nanopolish_calls(d["calls"], seq_d, depth=10, seed=seed+1)
+    d["sorted_calls"] = os.path.join(data_dir, "calls_sorted.tsv")
+    synthetic.make_nanopolish_calls(d["sorted_calls"], seq_d, depth=10, sort=True, seed=seed+1)
+
+    d["cpg_aggregate_list"] = []
+    d["interval_aggregate_list"] = []
+    for i, shift in enumerate([0.0, 1.0, -6.0, -5.0]):
+        fn = os.path.join(data_dir, "cpg_aggregate_{}.tsv".format(i))
+        d["n_sites"] = synthetic.make_cpg_aggregate(fn, seq_d, depth=10, shift=shift, seed=seed+10+i)
+        d["cpg_aggregate_list"].append(fn)
+        fn = os.path.join(data_dir, "interval_aggregate_{}.tsv".format(i))
+        d["n_intervals"] = synthetic.make_interval_aggregate(fn, seq_d, interval_size=1000, shift=shift, seed=seed+20+i)
+        d["interval_aggregate_list"].append(fn)
+
+    d["meth_comp"] = os.path.join(data_dir, "meth_comp.tsv")
+    d["n_meth_comp"] = synthetic.make_meth_comp(d["meth_comp"], seq_d, n_samples=3, seed=seed+30)
+    d["gff3"] = os.path.join(data_dir, "annotation.gff3")
+    d["n_tx"] = synthetic.make_gff3(d["gff3"], seq_d, seed=seed+40)
+
+    with open(data_fn, "w") as fp:
+        json.dump(d, fp, indent=2)
+    return d
+
+#~~~~~~~~~~~~~~~~~~~~~~~~Subcommands benchmarks~~~~~~~~~~~~~~~~~~~~~~~~#
+
+@benchmark("CpG_Aggregate", unit="calls")
+def bench_cpg_aggregate (d, outdir):
+    from pycoMeth.CpG_Aggregate import CpG_Aggregate
+    def run():
+        CpG_Aggregate(nanopolish_fn=d["calls"], ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), quiet=True)
+    return run, d["n_calls"]
+
+@benchmark("CpG_Aggregate sorted_input", unit="calls")
+def bench_cpg_aggregate_sorted (d, outdir):
+    from pycoMeth.CpG_Aggregate import CpG_Aggregate
+    def run():
+        CpG_Aggregate(nanopolish_fn=d["sorted_calls"], ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), sorted_input=True, quiet=True)
+    return run, d["n_calls"]
+
+@benchmark("Interval_Aggregate", unit="sites")
+def bench_interval_aggregate (d, outdir):
+    from pycoMeth.Interval_Aggregate import Interval_Aggregate
+    def run():
+        Interval_Aggregate(cpg_aggregate_fn=d["cpg_aggregate_list"][0], ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), quiet=True)
+    return run, d["n_sites"]
+
+@benchmark("Meth_Comp MW CpG", unit="sites")
+def bench_meth_comp_mw (d, outdir):
+    from pycoMeth.Meth_Comp import Meth_Comp
+    def run():
+        Meth_Comp(aggregate_fn_list=d["cpg_aggregate_list"][:2], ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), quiet=True)
+    return run, 2*d["n_sites"]
+
+@benchmark("Meth_Comp KW CpG", unit="sites")
+def bench_meth_comp_kw (d, outdir):
+    from pycoMeth.Meth_Comp import Meth_Comp
+    def run():
+        Meth_Comp(aggregate_fn_list=d["cpg_aggregate_list"], ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), quiet=True)
+    return run, len(d["cpg_aggregate_list"])*d["n_sites"]
+
+@benchmark("Meth_Comp KW Interval", unit="intervals")
+def bench_meth_comp_kw_interval (d, outdir):
+    from pycoMeth.Meth_Comp import Meth_Comp
+    def run():
+        Meth_Comp(aggregate_fn_list=d["interval_aggregate_list"], ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), quiet=True)
+    return run, len(d["interval_aggregate_list"])*d["n_intervals"]
+
+@benchmark("Comp_Report api_mode", unit="intervals")
+def bench_comp_report (d, outdir):
+    from pycoMeth.Comp_Report import Comp_Report
+    def run():
+        Comp_Report(methcomp_fn=d["meth_comp"], gff3_fn=d["gff3"], ref_fasta_fn=d["ref_fasta"], outdir=outdir, n_top=10, api_mode=True, report_non_significant=True, quiet=True)
+    return run, d["n_meth_comp"]
+
+@benchmark("CGI_Finder", unit="bases")
+def bench_cgi_finder (d, outdir):
+    from pycoMeth.CGI_Finder import CGI_Finder
+    def run():
+        CGI_Finder(ref_fasta_fn=d["ref_fasta"], output_tsv_fn=os.path.join(outdir, "out.tsv"), quiet=True)
+    return run, d["n_bases"]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~Hot functions benchmarks~~~~~~~~~~~~~~~~~~~~~~~~#
+
+@benchmark("FileParser.iter_chunks", unit="calls")
+def bench_file_parser (d, outdir):
+    from pycoMeth.FileParser import FileParser
+    dtypes = {"start":int, "end":int, "log_lik_ratio":float, "num_motifs":int}
+    def run():
+        with FileParser(fn=d["calls"], dtypes=dtypes, quiet=True) as fp:
+            for chunk in fp.iter_chunks(chunk_size=100000):
+                pass
+    return run, d["n_calls"]
+
+@benchmark("SitesIndex.add_chunk", unit="calls")
+def bench_sites_index (d, outdir):
+    from pycoMeth.FileParser import FileParser
+    from pycoMeth.CpG_Aggregate import SitesIndex
+    dtypes = {"start":int, "end":int, "log_lik_ratio":float, "num_motifs":int}
+    with FileParser(fn=d["calls"], dtypes=dtypes, quiet=True) as fp:
+        chunk_list = list(fp.iter_chunks(chunk_size=100000))
+    def run():
+        sites_index = SitesIndex(ref_fasta_fn=d["ref_fasta"])
+        for chunk in chunk_list:
+            sites_index.add_chunk(chunk)
+        sites_index.filter_low_count(10)
+        sites_index.sort()
+    return run, d["n_calls"]
+
+@benchmark("segment_median", unit="values")
+def bench_segment_median (d, outdir):
+    import numpy as np
+    from pycoMeth.common import segment_median
+    rng = np.random.default_rng(1)
+    offsets = np.append(0, np.cumsum(rng.integers(1, 20, max(d["n_calls"]//10, 1))))
+    values = np.round(rng.normal(0, 3, offsets[-1]), 2)
+    def run():
+        segment_median(values, offsets)
+    return run, int(offsets[-1])
+
+@benchmark("Meth_Comp stats batch MW", unit="sites")
+def bench_stats_mw (d, outdir):
+    from pycoMeth.Meth_Comp import _stats_test_batch
+    batch = _random_llr_batch(d["n_sites"], 2)
+    def run():
+        _stats_test_batch("MW", batch)
+    return run, len(batch)
+
+@benchmark("Meth_Comp stats batch KW", unit="sites")
+def bench_stats_kw (d, outdir):
+    from pycoMeth.Meth_Comp import _stats_test_batch
+    batch = _random_llr_batch(d["n_sites"], 4)
+    def run():
+        _stats_test_batch("KW", batch)
+    return run, len(batch)
+
+@benchmark("CGI_Finder find_valid_windows", unit="bases")
+def bench_find_valid_windows (d, outdir):
+    from pyfaidx import Fasta
+    from pycoMeth.CGI_Finder import FastaSeqArray, find_valid_windows
+    def run():
+        with Fasta(d["ref_fasta"]) as fa:
+            for seq_name in fa.keys():
+                find_valid_windows(FastaSeqArray(fa, seq_name))
+    return run, d["n_bases"]
+
+@benchmark("Comp_Report get_closest_tx_df", unit="intervals")
+def bench_closest_tx (d, outdir):
+    import pandas as pd
+    from pycoMeth.Comp_Report import get_ensembl_tx, get_tss_index, get_closest_tx_df
+    df = pd.read_table(d["meth_comp"], usecols=["chromosome","start","end"])
+    tx_df = get_ensembl_tx(d["gff3"])
+    def run():
+        get_closest_tx_df(tx_df=tx_df, tss_index=get_tss_index(tx_df), df=df)
+    return run, len(df)
+
+def _random_llr_batch (n_sites, n_samples, seed=1):
+    """Random batch of raw llr lists for statistical tests"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    return [[np.round(rng.normal(0, 3, rng.integers(5, 30)), 2).tolist() for _ in range(n_samples)] for _ in range(max(n_sites, 1))]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~CLI startup benchmarks~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def bench_startup (argv, d, outdir, n=5):
+    """Launch the command line interface n times in new interpreters, to guard against slow imports at startup"""
+    cmd = [sys.executable, "-c", "import sys; from pycoMeth.__main__ import main; main(sys.argv[1:])"]+argv
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(BENCH_DIR)]+[os.environ.get("PYTHONPATH", "")]))
+    def run():
+        for _ in range(n):
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, env=env, check=True)
+    return run, n
+
+for argv in (["--help"], ["CpG_Aggregate", "--help"], ["Interval_Aggregate", "--help"], ["Meth_Comp", "--help"], ["Comp_Report", "--help"], ["CGI_Finder", "--help"]):
+    benchmark("CLI startup {}".format(" ".join(argv)), unit="launches")(functools.partial(bench_startup, argv))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~Runner~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def _run_child (name, d, outdir, conn):
+    """Run a single benchmark in a fresh process and send back the wall time of the timed part, number of items and peak RSS"""
+    from pycoMeth.common import peak_rss_mb
+    func, unit = BENCHMARKS[name]
+    try:
+        run, n = func(d, outdir)
+        t = time.perf_counter()
+        run()
+        wall = time.perf_counter()-t
+        conn.send({"wall":wall, "n":n, "peak_rss_mb":peak_rss_mb()})
+    except Exception as E:
+        conn.send({"error":"{}: {}".format(type(E).__name__, E)})
+    finally:
+        conn.close()
+
+def run_benchmark (name, d, outdir, repeat=1):
+    """Run a benchmark repeat times, each in a new process, and return a summary dict"""
+    ctx = mp.get_context("spawn")
+    run_list = []
+    for i in range(repeat):
+        run_dir = os.path.join(outdir, name.replace(" ", "_").replace(".", "_"), str(i))
+        os.makedirs(run_dir, exist_ok=True)
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=_run_child, args=(name, d, run_dir, child_conn))
+        p.start()
+        res = parent_conn.recv()
+        p.join()
+        if "error" in res:
+            return OrderedDict([("name", name), ("error", res["error"])])
+        run_list.append(res)
+
+    unit = BENCHMARKS[name][1]
+    wall = statistics.median(r["wall"] for r in run_list)
+    summary = OrderedDict()
+    summary["name"] = name
+    summary["unit"] = unit
+    summary["n"] = run_list[0]["n"]
+    summary["wall_s"] = wall
+    summary["wall_min_s"] = min(r["wall"] for r in run_list)
+    summary["throughput"] = summary["n"]/wall if wall else float("inf")
+    summary["peak_rss_mb"] = max(r["peak_rss_mb"] for r in run_list)
+    return summary
+
+def main (args=None):
+    parser = argparse.ArgumentParser(description="Benchmark pycoMeth subcommands and hot functions on deterministic synthetic datasets")
+    parser.add_argument("-s", "--scale", type=float, default=1.0, help="Size of the synthetic dataset. 1 = 3 chromosomes of 1 Mb with 10X coverage (default: %(default)s)")
+    parser.add_argument("-o", "--outdir", type=str, default="./pycoMeth_benchmarks", help="Directory where to write synthetic data and benchmark outputs (default: %(default)s)")
+    parser.add_argument("-b", "--bench", type=str, nargs="*", default=[], help="Only run benchmarks containing any of these strings")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of runs of each benchmark. The median wall time is reported (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the synthetic data generators (default: %(default)s)")
+    parser.add_argument("-j", "--json", type=str, default="", help="Path to write the results in JSON format")
+    parser.add_argument("-l", "--list", action="store_true", default=False, help="List available benchmarks and exit")
+    a = parser.parse_args(args)
+
+    if a.list:
+        for name, (func, unit) in BENCHMARKS.items():
+            print("{}\t{}".format(name, unit))
+        return
+
+    data_dir = os.path.join(a.outdir, "data_scale{}_seed{}".format(a.scale, a.seed))
+    print("Generating synthetic dataset in {}".format(data_dir), file=sys.stderr)
+    t = time.perf_counter()
+    # Generate in a child process to keep the memory of the runner, and of the benchmark processes it starts, low
+    with mp.get_context("spawn").Pool(1) as pool:
+        d = pool.apply(make_dataset, (data_dir, a.scale, a.seed))
+    print("Dataset ready in {:.1f} s: {:,} bases, {:,} calls, {:,} sites, {:,} intervals".format(
+        time.perf_counter()-t, d["n_bases"], d["n_calls"], d["n_sites"], d["n_intervals"]), file=sys.stderr)
+
+    results = []
+    print("{:<40}{:>12}{:>18}{:>16}".format("benchmark", "wall (s)", "throughput (/s)", "peak RSS (MB)"))
+    for name in BENCHMARKS.keys():
+        if a.bench and not any(b.lower() in name.lower() for b in a.bench):
+            continue
+        res = run_benchmark(name, d, os.path.join(a.outdir, "runs"), repeat=a.repeat)
+        results.append(res)
+        if "error" in res:
+            print("{:<40}ERROR {}".format(name, res["error"]))
+        else:
+            print("{:<40}{:>12.3f}{:>18,.0f}{:>16.1f}  {}".format(name, res["wall_s"], res["throughput"], res["peak_rss_mb"], res["unit"]))
+        sys.stdout.flush()
+
+    if a.json:
+        with open(a.json, "w") as fp:
+            json.dump({"scale":a.scale, "seed":a.seed, "dataset":d, "results":results}, fp, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+# Standard library imports
+from collections import OrderedDict
+import gzip
+
+# Third party imports
+import numpy as np
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~GLOBALS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Base frequencies (A, C, G, T) of background sequence and CpG islands
+BG_FREQ = [0.3, 0.2, 0.2, 0.3]
+CGI_FREQ = [0.15, 0.35, 0.35, 0.15]
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~Synthetic data generators~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def make_reference (fn, n_chrom=3, chrom_len=1000000, cgi_spacing=20000, seed=42):
+    """
+    Write a deterministic reference fasta file with CpG island like regions and return an OrderedDict of chromosome sequences
+    as numpy arrays of ASCII bytes
+    * fn
+        Path of the fasta file to write
+    * n_chrom
+        Number of chromosomes
+    * chrom_len
+        Length of each chromosome
+    * cgi_spacing
+        Average distance between 2 CpG islands
+    * seed
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    seq_d = OrderedDict()
+    with open(fn, "w") as fp:
+        for i in range(n_chrom):
+            seq = BASES[rng.choice(4, chrom_len, p=BG_FREQ)]
+
+            # Add CpG islands enriched in C, G and CG dinucleotides
+            for start in np.sort(rng.integers(0, chrom_len, max(chrom_len//cgi_spacing, 1))):
+                end = min(start+int(rng.integers(300, 2000)), chrom_len)
+                seq[start:end] = BASES[rng.choice(4, end-start, p=CGI_FREQ)]
+                cg_pos = np.arange(start, end-1, 8)
+                seq[cg_pos] = ord("C")
+                seq[cg_pos+1] = ord("G")
+
+            chrom = "chr{}".format(i+1)
+            seq_d[chrom] = seq
+            fp.write(">{}\n".format(chrom))
+            for j in range(0, chrom_len, 60):
+                fp.write(seq[j:j+60].tobytes().decode()+"\n")
+    return seq_d
+
+def cpg_positions (seq):
+    """Positions of CpG dinucleotides in a sequence array"""
+    return np.flatnonzero((seq[:-1] == ord("C")) & (seq[1:] == ord("G")))
+
+def simulate_llr (rng, pos, n, shift=0.0, region_size=5000):
+    """Draw n llr values for each CpG position, alternating methylated and unmethylated regions of region_size"""
+    base = np.where((pos//region_size)%2 == 1, 3.0, -3.0)+shift
+    return np.round(rng.normal(np.repeat(base, n), 3.0), 2)
+
+def make_nanopolish_calls (fn, seq_d, depth=10, read_len=5000, shift=0.0, sort=False, seed=1):
+    """
+    Write a deterministic Nanopolish call_methylation file from a reference generated by make_reference and return the number of calls
+    * fn
+        Path of the file to write (can be gzipped)
+    * seq_d
+        OrderedDict of chromosome sequences returned by make_reference
+    * depth
+        Average number of reads covering each position
+    * read_len
+        Average read length
+    * shift
+        Value added to all the log likelihood ratios to simulate a different sample
+    * sort
+        Sort calls by coordinates instead of shuffling them
+    * seed
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    block_list = []
+    for chrom, seq in seq_d.items():
+        pos = cpg_positions(seq)
+        n_reads = max(int(depth*len(seq)/read_len), 1)
+        read_start = rng.integers(0, len(seq), n_reads)
+        read_end = read_start+rng.integers(read_len//2, read_len*3//2, n_reads)
+
+        # Expand reads to the CpG sites they overlap
+        first = np.searchsorted(pos, read_start)
+        count = np.searchsorted(pos, read_end)-first
+        read_id = np.repeat(np.arange(n_reads), count)
+        site = np.repeat(first-np.cumsum(count)+count, count)+np.arange(count.sum())
+        call_pos = pos[site]
+
+        # Sequence context of each call
+        context_idx = np.clip(call_pos[:,None]+np.arange(-5, 6), 0, len(seq)-1)
+        context = np.ascontiguousarray(seq[context_idx]).view("S11").ravel().astype(str)
+
+        block = OrderedDict()
+        block["chromosome"] = np.full(len(call_pos), chrom)
+        block["strand"] = np.where(read_id%2, "+", "-")
+        block["start"] = call_pos
+        block["end"] = call_pos
+        block["read_name"] = np.char.add("read_{}_".format(chrom), read_id.astype(str))
+        block["log_lik_ratio"] = simulate_llr(rng, call_pos, 1, shift)
+        block["log_lik_methylated"] = np.full(len(call_pos), -50.0)
+        block["log_lik_unmethylated"] = np.full(len(call_pos), -52.0)
+        block["num_calling_strands"] = np.ones(len(call_pos), dtype=np.int64)
+        block["num_motifs"] = np.ones(len(call_pos), dtype=np.int64)
+        block["sequence"] = context
+        block_list.append(block)
+
+    cols = OrderedDict((k, np.concatenate([b[k] for b in block_list])) for k in block_list[0].keys())
+    n_calls = len(cols["start"])
+    if sort:
+        chrom_idx = np.repeat(np.arange(len(block_list)), [len(b["start"]) for b in block_list])
+        order = np.lexsort((cols["start"], chrom_idx))
+    else:
+        order = rng.permutation(n_calls)
+
+    # Write by slices to limit the memory used by string conversion
+    with _open_write(fn) as fp:
+        fp.write("\t".join(cols.keys())+"\n")
+        for i in range(0, n_calls, 100000):
+            _write_columns(fp, [cols[k][order[i:i+100000]] for k in cols.keys()])
+    return n_calls
+
+def make_cpg_aggregate (fn, seq_d, depth=10, shift=0.0, seed=2):
+    """
+    Write a deterministic CpG_Aggregate TSV file from a reference generated by make_reference and return the number of sites
+    * fn
+        Path of the file to write (can be gzipped)
+    * seq_d
+        OrderedDict of chromosome sequences returned by make_reference
+    * depth
+        Average number of llr values per site
+    * shift
+        Value added to all the log likelihood ratios to simulate a different sample
+    * seed
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    n_sites = 0
+    with _open_write(fn) as fp:
+        fp.write("chromosome\tstart\tend\tsequence\tnum_motifs\tmedian_llr\tllr_list\n")
+        for chrom, seq in seq_d.items():
+            pos = cpg_positions(seq)
+            n = np.maximum(rng.poisson(depth, len(pos)), 1)
+            llr = simulate_llr(rng, pos, n, shift)
+            offsets = np.append(0, np.cumsum(n))
+            med = np.array([np.median(llr[offsets[i]:offsets[i+1]]) for i in range(len(pos))])
+            llr_list = _lists_to_str(llr, offsets)
+            context_idx = np.clip(pos[:,None]+np.arange(-5, 6), 0, len(seq)-1)
+            context = np.ascontiguousarray(seq[context_idx]).view("S11").ravel().astype(str)
+            _write_columns(fp, [np.full(len(pos), chrom), pos, pos+1, context, np.ones(len(pos), dtype=np.int64), med, llr_list])
+            n_sites+=len(pos)
+    return n_sites
+
+def make_interval_aggregate (fn, seq_d, interval_size=1000, depth=10, shift=0.0, seed=3):
+    """
+    Write a deterministic Interval_Aggregate TSV file from a reference generated by make_reference and return the number of intervals
+    * fn
+        Path of the file to write (can be gzipped)
+    * seq_d
+        OrderedDict of chromosome sequences returned by make_reference
+    * interval_size
+        Size of the sliding window intervals
+    * depth
+        Number of llr values used to compute the median llr of each site
+    * shift
+        Value added to all the log likelihood ratios to simulate a different sample
+    * seed
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    n_intervals = 0
+    with _open_write(fn) as fp:
+        fp.write("chromosome\tstart\tend\tnum_motifs\tmedian_llr\tllr_list\tpos_list\n")
+        for chrom, seq in seq_d.items():
+            pos = cpg_positions(seq)
+            site_llr = np.round(simulate_llr(rng, pos, depth, shift).reshape(-1, depth).mean(axis=1), 3)
+            bins = pos//interval_size
+            valid_bins, first, count = np.unique(bins, return_index=True, return_counts=True)
+            keep = count >= 5
+            valid_bins, first, count = valid_bins[keep], first[keep], count[keep]
+            idx = np.concatenate([np.arange(f, f+c) for f, c in zip(first, count)]) if len(first) else np.zeros(0, dtype=np.int64)
+            offsets = np.append(0, np.cumsum(count))
+            llr = site_llr[idx]
+            med = np.array([np.median(llr[offsets[i]:offsets[i+1]]) for i in range(len(count))])
+            _write_columns(fp, [
+                np.full(len(count), chrom), valid_bins*interval_size, (valid_bins+1)*interval_size, count, np.round(med, 3),
+                _lists_to_str(llr, offsets), _lists_to_str(pos[idx], offsets)])
+            n_intervals+=len(count)
+    return n_intervals
+
+def make_meth_comp (fn, seq_d, n_samples=3, interval_size=1000, sig_fraction=0.1, seed=4):
+    """
+    Write a deterministic Meth_Comp TSV file for intervals, as expected by Comp_Report, and return the number of intervals
+    * fn
+        Path of the file to write (can be gzipped)
+    * seq_d
+        OrderedDict of chromosome sequences returned by make_reference
+    * n_samples
+        Number of samples compared
+    * interval_size
+        Size of the sliding window intervals
+    * sig_fraction
+        Fraction of intervals with a significant adjusted pvalue
+    * seed
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    n_intervals = 0
+    labels = "[{}]".format(",".join(str(i) for i in range(n_samples)))
+    header = [
+        "chromosome","start","end","n_samples","pvalue","adj_pvalue","neg_med","pos_med","ambiguous_med",
+        "unique_cpg_pos","labels","med_llr_list","raw_llr_list","raw_pos_list","comment"]
+    with _open_write(fn) as fp:
+        fp.write("\t".join(header)+"\n")
+        for chrom, seq in seq_d.items():
+            pos = cpg_positions(seq)
+            for start in range(0, len(seq)-interval_size, interval_size):
+                int_pos = pos[np.searchsorted(pos, start):np.searchsorted(pos, start+interval_size)]
+                if len(int_pos) < 5:
+                    continue
+                significant = rng.random() < sig_fraction
+                shifts = rng.choice([-3.0, 3.0], n_samples) if significant else np.zeros(n_samples)
+                raw_llr = [np.round(rng.normal(s, 2.0, len(int_pos)), 3) for s in shifts]
+                med_llr = [float(np.median(l)) for l in raw_llr]
+                pvalue = rng.random()*1e-6 if significant else rng.random()
+                adj_pvalue = min(pvalue*10, 1.0)
+                line = [
+                    chrom, start, start+interval_size, n_samples, pvalue, adj_pvalue,
+                    sum(m <= -2 for m in med_llr), sum(m >= 2 for m in med_llr), sum(-2 < m < 2 for m in med_llr),
+                    len(int_pos), labels, _list_to_str(med_llr), "[{}]".format(",".join(_list_to_str(l) for l in raw_llr)),
+                    "[{}]".format(",".join(_list_to_str(int_pos) for _ in raw_llr)),
+                    "Significant pvalue" if adj_pvalue <= 0.01 else "Non-significant pvalue"]
+                fp.write("\t".join(str(i) for i in line)+"\n")
+                n_intervals+=1
+    return n_intervals
+
+def make_gff3 (fn, seq_d, tx_spacing=10000, seed=5):
+    """
+    Write a deterministic Ensembl like GFF3 file with transcripts and return the number of transcripts
+    * fn
+        Path of the file to write (can be gzipped)
+    * seq_d
+        OrderedDict of chromosome sequences returned by make_reference
+    * tx_spacing
+        Average distance between 2 transcripts
+    * seed
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    n_tx = 0
+    with _open_write(fn) as fp:
+        fp.write("##gff-version 3\n")
+        for chrom, seq in seq_d.items():
+            n = max(len(seq)//tx_spacing, 1)
+            start = np.sort(rng.integers(1, len(seq)-5000, n))
+            end = start+rng.integers(200, 5000, n)
+            strand = rng.choice(["+","-"], n)
+            biotype = rng.choice(["protein_coding","lncRNA","miRNA"], n)
+            for s, e, st, bt in zip(start, end, strand, biotype):
+                fp.write("{}\tensembl\tmRNA\t{}\t{}\t.\t{}\t.\tID=transcript:T{:06};Parent=gene:G{:06};Name=TX{:06};biotype={}\n".format(
+                    chrom, s, e, st, n_tx, n_tx, n_tx, bt))
+                n_tx+=1
+    return n_tx
+
+#~~~~~~~~~~~~~~~~~~~~~~~~Helper functions~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def _open_write (fn):
+    """Open a text file for writing, gzipped if needed"""
+    return gzip.open(fn, "wt") if fn.endswith(".gz") else open(fn, "w")
+
+def _write_columns (fp, col_list):
+    """Write columns of equal length as tab separated lines"""
+    col_list = [c.astype(str) if isinstance(c, np.ndarray) else np.asarray(c, dtype=str) for c in col_list]
+    for line in zip(*col_list):
+        fp.write("\t".join(line)+"\n")
+
+def _list_to_str (l):
+    """Compact string representation of a list of numbers"""
+    return "[{}]".format(",".join(str(i) for i in np.asarray(l).tolist()))
+
+def _lists_to_str (values, offsets):
+    """Compact string representation of the segments of a flat array defined by offsets"""
+    str_values = values.astype(str)
+    return np.array(["[{}]".format(",".join(str_values[offsets[i]:offsets[i+1]])) for i in range(len(offsets)-1)])
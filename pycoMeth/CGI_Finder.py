@@ -3,11 +3,11 @@
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 # Standard library imports
 from collections import OrderedDict, namedtuple, Counter
+from multiprocessing import Pool
 
 # Third party imports
-from tqdm import trange
-
-# Third party imports
+from tqdm import tqdm
+import numpy as np
 from pyfaidx import Fasta
 
 # Local imports
@@ -23,9 +23,14 @@ def CGI_Finder (
     min_win_len:int=200,
     min_CG_freq:float=0.5,
     min_obs_CG_ratio:float=0.6,
+    threads:int=1,
+    chunk_size:int=1000000,
     verbose:bool=False,
     quiet:bool=False,
     progress:bool=False,
+    profile:bool=False,
+    profile_dir:str="",
+    metrics_json:str="",
     **kwargs):
     """
     Simple method to find putative CpG islands in DNA sequences by using a sliding window and merging
@@ -45,17 +50,24 @@ def CGI_Finder (
         Minimal C+G frequency in a window to be counted as a valid CpG island
     * min_obs_CG_ratio
         Minimal Observed CG dinucleotidefrequency over expected distribution in a window to be counted as a valid CpG island
+    * threads
+        Number of worker processes used to process reference sequences in parallel
+    * chunk_size
+        Number of windows evaluated at once. Sequences are read from the fasta file by overlapping chunks of this size
     """
 
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
     log = get_logger (name="pycoMeth_CGI_Finder", verbose=verbose, quiet=quiet)
+    prof = Profiler(enabled=profile, profile_dir=profile_dir, metrics_json=metrics_json, prefix="CGI_Finder", options=opt_summary_dict)
 
     log.warning("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
 
     # Init collections
     counter = Counter()
+    prof.add_counter("Results summary", counter)
+    prof.add_files(input_fn=ref_fasta_fn, output_fn=[output_bed_fn, output_tsv_fn])
 
     # At least one output file is required, otherwise it doesn't make any sense
     log.debug ("Checking required output")
@@ -64,91 +76,33 @@ def CGI_Finder (
 
     log.warning("Parsing reference fasta file")
     try:
-        with Fasta(ref_fasta_fn) as fasta_fp:
-            with CGI_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, verbose=verbose) as writer:
-
-                # Iterate over reference sequences in fasta file
-                for seq in fasta_fp:
-
-                    # Hard copy of seq and cast to lower case
-                    seq_name = seq.name
-                    seq = str(seq).lower()
-                    log.info ("Parsing Reference sequence: {}".format(seq_name))
-                    counter["Number of reference sequences"]+=1
-
-                    # Loop control counters
-                    valid_win_start = valid_win_end = 0
-                    previous_valid = False
-
-                    # Compute and evaluate first window
-                    c_count = g_count = cg_count = 0
-                    for i in range(min_win_len):
-                        if seq[i] == "c":
-                            c_count+=1
-                        elif seq[i] == "g":
-                            g_count+=1
-                        if seq[i:i+2] =="cg":
-                            cg_count+=1
-
-                    if valid_window (c_count, g_count, cg_count, min_win_len, min_CG_freq, min_obs_CG_ratio):
-                        counter["Valid minimal size windows"]+=1
-                        valid_win_start = i
-                        valid_win_end = i+min_win_len
-                        previous_valid = True
-
-                    for i in trange(1, len(seq)-min_win_len, unit=" bases", unit_scale=True, desc="\tProgress", disable=not progress):
-
-                        # Decrement counters based on changes at previous start
-                        prev_start = i-1
-                        if seq[prev_start] == "c":
-                            c_count-=1
-                        elif seq[prev_start] == "g":
-                            g_count-=1
-                        if seq[prev_start:prev_start+2] =="cg":
-                            cg_count-=1
-
-                        # Increment counters based on changes at new end
-                        end = i+min_win_len
-                        if seq[end] == "c":
-                            c_count+=1
-                        elif seq[end] == "g":
-                            g_count+=1
-                        if seq[end-1:end+1] =="cg":
-                            cg_count+=1
-
-                        # Evaluate windows
-                        if valid_window (c_count, g_count, cg_count, min_win_len, min_CG_freq, min_obs_CG_ratio):
-                            counter["Valid minimal size windows"]+=1
-
-                            # Previous valid overlapping windows was valid => extend end
-                            if previous_valid:
-                                valid_win_end = i+min_win_len
-
-                                # Special case where reaching end with valid window => save window
-                                if i == len(seq)-min_win_len-1:
-                                    counter["Valid merged windows"]+=1
-                                    win_len, win_cg_count, win_cg_freq, win_obs_exp = compute_win (seq[valid_win_start:valid_win_end]) # Sometimes valid merged windows are not excatly matching the definition of a proper CpG_island
-                                    writer.write(seq_name, valid_win_start, valid_win_end, win_len, win_cg_count, win_cg_freq, win_obs_exp)
-
-                            # Not overlapping a previous valid window => Start new one
-                            else:
-                                valid_win_start = i
-                                valid_win_end = i+min_win_len
-
-                            previous_valid=True
-
-                        # A previous overlapping windows was valid and getting out of the valid window or reaching end of sequence => save window
-                        elif i > (valid_win_end+merge_gap) or i == len(seq)-min_win_len-1:
-                            if previous_valid:
-                                counter["Valid merged windows"]+=1
-                                win_len, win_cg_count, win_cg_freq, win_obs_exp = compute_win (seq[valid_win_start:valid_win_end])
-                                writer.write(seq_name, valid_win_start, valid_win_end, win_len, win_cg_count, win_cg_freq, win_obs_exp)
-
-                            previous_valid=False
+        # Index fasta file if needed before starting workers and list sequences
+        with prof.stage("Indexing reference"), Fasta(ref_fasta_fn) as fasta_fp:
+            seq_len_d = OrderedDict((seq.name, len(seq)) for seq in fasta_fp)
+
+        with CGI_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, verbose=verbose) as writer:
+            task_gen = ((ref_fasta_fn, seq_name, min_win_len, min_CG_freq, min_obs_CG_ratio, merge_gap, chunk_size) for seq_name in seq_len_d.keys())
+            with tqdm(total=sum(seq_len_d.values()), unit=" bases", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+                pool = Pool(threads) if threads > 1 else None
+                try:
+                    # Collect results in reference order
+                    res_iter = pool.imap(_find_seq_cgi, task_gen) if pool else map(_find_seq_cgi, task_gen)
+                    for seq_name, win_list, seq_counter in prof.iter("Finding CpG islands", res_iter, unit="bases", count=lambda res: seq_len_d[res[0]]):
+                        log.info ("Parsed Reference sequence: {}".format(seq_name))
+                        counter["Number of reference sequences"]+=1
+                        counter.update(seq_counter)
+                        with prof.stage("Writing CpG islands", n_items=len(win_list), unit="CpG islands"):
+                            for win in win_list:
+                                writer.write(seq_name, *win)
+                        pbar.update(seq_len_d[seq_name])
+                finally:
+                    if pool:
+                        pool.terminate()
 
     finally:
         # Print counters
         log_dict(counter, log.info, "Results summary")
+        prof.report(log.info)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~Comp_Writer HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class CGI_Writer():
@@ -207,34 +161,133 @@ class CGI_Writer():
         """Write line to TSV file"""
         self.tsv_fp.write ("{}\t{}\t{}\t{}\t{}\t{:.3f}\t{:.3f}\n".format(chrom, start, end, length, n_cpg, cg_freq, obs_exp))
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~FastaSeqArray HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class FastaSeqArray():
+    """Read slices of a fasta reference sequence on demand as numpy arrays of ASCII bytes"""
+
+    def __init__ (self, fasta_fp, seq_name):
+        """"""
+        self.record = fasta_fp[seq_name]
+        self.seq_len = len(self.record)
+
+    def __len__ (self):
+        return self.seq_len
+
+    def __getitem__ (self, item):
+        start, stop, step = item.indices(self.seq_len)
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+        return np.frombuffer(str(self.record[start:stop]).encode(), dtype=np.uint8)
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~Helper Functions~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-def valid_window (c_count, g_count, cg_count, min_win_len=200, min_CG_freq=0.5, min_obs_CG_ratio=0.6):
-    cg_freq = (c_count+g_count)/min_win_len
-    if cg_freq < min_CG_freq:
-        return False
 
-    # Safely compute obs_exp in case of no Cs or Gs on windows
-    try:
-        obs_exp = cg_count/(c_count*g_count/min_win_len)
-    except ZeroDivisionError:
-        obs_exp = 0
+def _find_seq_cgi (task):
+    """Worker function finding merged CpG islands windows in a reference sequence read by chunks"""
+    ref_fasta_fn, seq_name, min_win_len, min_CG_freq, min_obs_CG_ratio, merge_gap, chunk_size = task
+    counter = Counter()
+    win_list = []
+    with Fasta(ref_fasta_fn) as fasta_fp:
+        seq = FastaSeqArray(fasta_fp, seq_name)
 
-    if obs_exp < min_obs_CG_ratio:
-        return False
+        # Find all valid minimal windows and merge them
+        run_first, run_last = find_valid_windows (seq, min_win_len, min_CG_freq, min_obs_CG_ratio, block_size=chunk_size)
+        n_valid = int((run_last-run_first+1).sum())
+        if n_valid:
+            counter["Valid minimal size windows"]+=n_valid
+        win_start_list, win_end_list = merge_windows (run_first, run_last, len(seq), min_win_len, merge_gap)
 
-    return True
+        # Compute stats of merged windows
+        for win_start, win_end in zip(win_start_list, win_end_list):
+            counter["Valid merged windows"]+=1
+            win_len, win_cg_count, win_cg_freq, win_obs_exp = compute_win_array (seq[win_start:win_end]) # Sometimes valid merged windows are not excatly matching the definition of a proper CpG_island
+            win_list.append((win_start, win_end, win_len, win_cg_count, win_cg_freq, win_obs_exp))
+
+    return (seq_name, win_list, counter)
 
-def compute_win (win_seq):
-    win_len = len(win_seq)
-    c_count = g_count = cg_count = 0
 
-    for j in range(win_len):
-        if win_seq[j] == "c":
-            c_count+=1
-        elif win_seq[j] == "g":
-            g_count+=1
-        if win_seq[j:j+2] =="cg":
-            cg_count+=1
+def find_valid_windows (seq, min_win_len=200, min_CG_freq=0.5, min_obs_CG_ratio=0.6, block_size=1000000):
+    """
+    Evaluate all the sliding windows of a sequence at once with cumulative sums of C, G and CpG indicator arrays, by blocks of windows.
+    Return the first and last start positions of runs of consecutive windows satisfying the CpG island definition.
+    The counts follow the original base by base implementation: the first window counts C and G over [0, min_win_len[ while
+    the following windows i count them over [i, i+min_win_len] minus the base at position min_win_len. CpG are counted for all
+    dinucleotides starting in [i, i+min_win_len[
+    * seq
+        Sequence as a numpy array of ASCII bytes (case insensitive) or any object returning such arrays when sliced, like FastaSeqArray
+    * min_win_len
+        Length of the sliding window
+    * min_CG_freq
+        Minimal C+G frequency in a window
+    * min_obs_CG_ratio
+        Minimal Observed CG dinucleotide frequency over expected distribution in a window
+    * block_size
+        Number of windows evaluated at once. Blocks of sequence overlapping by min_win_len are read from seq
+    """
+    seq_len = len(seq)
+    if seq_len < min_win_len:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    # First window
+    first_win = seq[:min_win_len+1]
+    is_c, is_g = _is_c_g(first_win)
+    c_count = np.array([is_c[:min_win_len].sum()], dtype=np.int64)
+    g_count = np.array([is_g[:min_win_len].sum()], dtype=np.int64)
+    cg_count = np.array([(is_c[:-1] & is_g[1:]).sum()], dtype=np.int64)
+    run_list = [_valid_runs(_valid_windows(c_count, g_count, cg_count, min_win_len, min_CG_freq, min_obs_CG_ratio), 0)]
+
+    # Following windows are affected by the base at position min_win_len never being counted
+    w_is_c, w_is_g = _is_c_g(seq[min_win_len:min_win_len+1])
+    for block_start in range(1, seq_len-min_win_len, block_size):
+        block_end = min(block_start+block_size, seq_len-min_win_len)
+        is_c, is_g = _is_c_g(seq[block_start:block_end+min_win_len])
+        c_cumsum = _cumsum(is_c)
+        g_cumsum = _cumsum(is_g)
+        cg_cumsum = _cumsum(is_c[:-1] & is_g[1:])
+
+        n = block_end-block_start
+        c_count = c_cumsum[min_win_len+1:min_win_len+1+n]-c_cumsum[:n]-int(w_is_c[0])
+        g_count = g_cumsum[min_win_len+1:min_win_len+1+n]-g_cumsum[:n]-int(w_is_g[0])
+        cg_count = cg_cumsum[min_win_len:min_win_len+n]-cg_cumsum[:n]
+        valid = _valid_windows(c_count, g_count, cg_count, min_win_len, min_CG_freq, min_obs_CG_ratio)
+        run_list.append(_valid_runs(valid, block_start))
+
+    return (np.concatenate([r[0] for r in run_list]), np.concatenate([r[1] for r in run_list]))
+
+def merge_windows (run_first, run_last, seq_len, min_win_len=200, merge_gap=0):
+    """
+    Merge runs of valid windows overlapping or separated by less than merge_gap and return the start and end positions of merged windows.
+    Reproduces the original implementation: a window valid at position 0 starts at min_win_len-1 and ends at 2*min_win_len-1,
+    a valid window at the last position is only reported if merged with a previous one
+    """
+    if not len(run_first):
+        return [], []
+
+    # End of the runs and new merged window where a run does not extend the previous one
+    win_end = run_last+min_win_len
+    if run_last[0] == 0:
+        win_end[0] = 2*min_win_len-1
+    new_win = np.ones(len(run_first), dtype=bool)
+    new_win[1:] = run_first[1:] > win_end[:-1]+merge_gap+1
+
+    first = np.flatnonzero(new_win)
+    last = np.append(first[1:], len(run_first))-1
+    start_list = run_first[first]
+    end_list = win_end[last]
+    if start_list[0] == 0:
+        start_list[0] = min_win_len-1
+
+    # Discard merged windows ending at the last position without previous valid window or never reported
+    last_pos = seq_len-min_win_len-1
+    reported = (run_last[last] < last_pos) | ((run_last[last] == last_pos) & (run_last[last] > run_first[first]))
+    return start_list[reported].tolist(), end_list[reported].tolist()
+
+def compute_win_array (win_seq):
+    """Compute the length, number of CpGs, CG frequency and observed/expected CpG ratio of a window numpy array of ASCII bytes"""
+    win_len = len(win_seq)
+    is_c, is_g = _is_c_g(win_seq)
+    c_count = int(is_c.sum())
+    g_count = int(is_g.sum())
+    cg_count = int((is_c[:-1] & is_g[1:]).sum())
 
     cg_freq = (c_count+g_count)/win_len
     if c_count == 0 or g_count == 0:
@@ -243,3 +296,26 @@ def compute_win (win_seq):
         obs_exp = cg_count/(c_count*g_count/win_len)
 
     return (win_len, cg_count, cg_freq, obs_exp)
+
+def _is_c_g (seq):
+    """Case insensitive C and G indicator arrays"""
+    return ((seq == 99) | (seq == 67), (seq == 103) | (seq == 71))
+
+def _valid_runs (valid, offset=0):
+    """First and last positions of runs of True values in a boolean array"""
+    edges = np.diff(valid.astype(np.int8), prepend=0, append=0)
+    return (np.flatnonzero(edges == 1)+offset, np.flatnonzero(edges == -1)-1+offset)
+
+def _cumsum (a):
+    """Cumulative sum with a leading 0"""
+    c = np.zeros(len(a)+1, dtype=np.int64)
+    np.cumsum(a, out=c[1:])
+    return c
+
+def _valid_windows (c_count, g_count, cg_count, min_win_len=200, min_CG_freq=0.5, min_obs_CG_ratio=0.6):
+    """Boolean mask of the windows passing the CG frequency and observed/expected CpG ratio thresholds from their C, G and CpG counts"""
+    cg_freq = (c_count+g_count)/min_win_len
+    exp = c_count*g_count/min_win_len
+    with np.errstate(divide="ignore", invalid="ignore"):
+        obs_exp = np.where(exp != 0, cg_count/exp, 0)
+    return ~(cg_freq < min_CG_freq) & ~(obs_exp < min_obs_CG_ratio)
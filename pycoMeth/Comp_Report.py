@@ -5,6 +5,8 @@
 # Standard library imports
 from collections import OrderedDict, namedtuple, Counter
 import hashlib
+from functools import lru_cache
+from multiprocessing import Pool
 
 # Third party imports
 from tqdm import tqdm
@@ -25,6 +27,9 @@ import plotly.offline as py
 from pycoMeth import __version__ as version
 from pycoMeth.common import *
 
+# URL of plotly.js used by HTML reports when it is not written in the output directory
+PLOTLYJS_CDN = "https://cdn.plot.ly/plotly-latest.min.js"
+
 #~~~~~~~~~~~~~~~~~~~~~~~~Main Function~~~~~~~~~~~~~~~~~~~~~~~~#
 
 def Comp_Report (
@@ -39,10 +44,15 @@ def Comp_Report (
     n_len_bin:int=500,
     api_mode:bool=False,
     export_static_plots:bool=False,
+    local_plotlyjs:bool=False,
     report_non_significant:bool=False,
+    threads:int=1,
     verbose:bool=False,
     quiet:bool=False,
     progress:bool=False,
+    profile:bool=False,
+    profile_dir:str="",
+    metrics_json:str="",
     **kwargs):
     """
     Generate an HTML report of significantly differentially methylated CpG intervals from `Meth_Comp` text output.
@@ -71,219 +81,291 @@ def Comp_Report (
         for the top candidates found. These dataframes can then be used to with the plotting functions containned in this module
     * export_static_plots
         Export all the plots from the reports in SVG format.
+    * local_plotlyjs
+        Write plotly.js once in the output directory and link all the HTML reports to this file instead of loading it from the plotly CDN (for offline viewing)
     * report_non_significant
         Report all valid CpG islands, significant or not in the text report. This option also adds a non-significant track to the TSS_distance plot
+    * threads
+        Number of worker processes used to render the top candidates interval reports
     """
 
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
     log = get_logger (name="pycoMeth_CpG_Comp", verbose=verbose, quiet=quiet)
+    prof = Profiler(enabled=profile, profile_dir=profile_dir, metrics_json=metrics_json, prefix="Comp_Report", options=opt_summary_dict)
 
     log.warning("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
 
-    log.warning("Loading and preparing data")
-
-    # Parse methcomp data
-    log.info("Loading Methcomp data from TSV file")
-    df = pd.read_table(methcomp_fn, low_memory=False)
-
-    # Check that the input file was generated by methcomp from samples aggregated with Interval_Aggregate
-    req_fields = [
-        "chromosome","start","end","n_samples","pvalue","adj_pvalue","neg_med","pos_med",
-        "ambiguous_med","unique_cpg_pos","labels","med_llr_list","raw_llr_list","raw_pos_list"]
-    if not all_in(req_fields, df.columns):
-        raise pycoMethError ("Invalid input file type passed. Expecting Meth_Comp TSV file generated from samples processed with Interval_Aggregate")
-
-    # Parse GFF3 annotations
-    log.info("Loading transcripts info from GFF file")
-    tx_df = get_ensembl_tx(gff3_fn)
-    if tx_df.empty:
-        log.error("No valid transcripts found in GFF3 input file")
-    if not all_in(df["chromosome"], tx_df["chromosome"]):
-        log.error ("Not all the chromosomes found in the data file are present in the GFF3 file. This will lead to missing transcript ids")
-
-    # Parse FASTA reference
-    log.info("Loading chromosome info from reference FASTA file")
-    chr_len_d = get_chr_len(ref_fasta_fn)
-    if not chr_len_d:
-        log.error("No valid reference sequences found in FASTA file")
-    if not all_in(df["chromosome"], chr_len_d.keys()):
-        log.error ("Not all the chromosomes found in the data file are present in the Fasta file. This will lead to missing reference sequences in the ideogram")
-
-    # Select only sites with a valid pvalue
-    valid_df = df.dropna(subset=["adj_pvalue"])
-
-    # Check number of valid pvalues
-    sig_df = valid_df[valid_df.adj_pvalue <= pvalue_threshold]
-    log.info("Number of significant intervals found (adjusted pvalue<{}): {}".format(pvalue_threshold, len(sig_df)))
-    if len(sig_df)<5:
-        log.error("Low number of significant sites. The summary report will likely contain errors")
-    if len(sig_df)<n_top:
-        log.error("Number of significant intervals lower than number of top candidates to plot")
-
-    # List top candidates
-    log.info("Finding top candidates")
-    top_dict = OrderedDict()
-    top_candidates = sig_df.sort_values(by="adj_pvalue").head(n_top)
-    for rank, (idx, line) in enumerate(iter_idx_tuples(top_candidates), 1):
-        coord = "{}-{}-{}".format(line.chromosome,line.start,line.end)
-        bn = "interval_{:04}_chr{}".format(rank, coord)
-        top_dict[idx] = {"rank":rank, "coord":coord, "bn":bn}
-    rank_fn_dict = {i["rank"]:i["bn"] for i in top_dict.values()}
+    try:
+        log.warning("Loading and preparing data")
+        prof.add_files(input_fn=[methcomp_fn, gff3_fn, ref_fasta_fn], output_fn=None if api_mode else outdir)
+        with prof.stage("Loading data", unit="intervals"):
+            # Parse methcomp data
+            log.info("Loading Methcomp data from TSV file")
+            df = pd.read_table(methcomp_fn, low_memory=False)
+
+            # Check that the input file was generated by methcomp from samples aggregated with Interval_Aggregate
+            req_fields = [
+                "chromosome","start","end","n_samples","pvalue","adj_pvalue","neg_med","pos_med",
+                "ambiguous_med","unique_cpg_pos","labels","med_llr_list","raw_llr_list","raw_pos_list"]
+            if not all_in(req_fields, df.columns):
+                raise pycoMethError ("Invalid input file type passed. Expecting Meth_Comp TSV file generated from samples processed with Interval_Aggregate")
+
+            # Parse GFF3 annotations
+            log.info("Loading transcripts info from GFF file")
+            tx_df = get_ensembl_tx(gff3_fn)
+            if tx_df.empty:
+                log.error("No valid transcripts found in GFF3 input file")
+            if not all_in(df["chromosome"], tx_df["chromosome"]):
+                log.error ("Not all the chromosomes found in the data file are present in the GFF3 file. This will lead to missing transcript ids")
+
+            log.info("Indexing transcripts TSS")
+            tss_index = get_tss_index(tx_df)
+
+            # Parse FASTA reference
+            log.info("Loading chromosome info from reference FASTA file")
+            chr_len_d = get_chr_len(ref_fasta_fn)
+            if not chr_len_d:
+                log.error("No valid reference sequences found in FASTA file")
+            if not all_in(df["chromosome"], chr_len_d.keys()):
+                log.error ("Not all the chromosomes found in the data file are present in the Fasta file. This will lead to missing reference sequences in the ideogram")
+
+        prof.add_items("Loading data", len(df))
+
+        # Select only sites with a valid pvalue
+        valid_df = df.dropna(subset=["adj_pvalue"])
+
+        # Check number of valid pvalues
+        sig_df = valid_df[valid_df.adj_pvalue <= pvalue_threshold]
+        log.info("Number of significant intervals found (adjusted pvalue<{}): {}".format(pvalue_threshold, len(sig_df)))
+        if len(sig_df)<5:
+            log.error("Low number of significant sites. The summary report will likely contain errors")
+        if len(sig_df)<n_top:
+            log.error("Number of significant intervals lower than number of top candidates to plot")
+
+        # List top candidates
+        log.info("Finding top candidates")
+        top_dict = OrderedDict()
+        top_candidates = sig_df.sort_values(by="adj_pvalue").head(n_top)
+        for rank, (idx, line) in enumerate(iter_idx_tuples(top_candidates), 1):
+            coord = "{}-{}-{}".format(line.chromosome,line.start,line.end)
+            bn = "interval_{:04}_chr{}".format(rank, coord)
+            top_dict[idx] = {"rank":rank, "coord":coord, "bn":bn}
 
-    all_cpg_d = OrderedDict()
-    all_interval_summary = []
-    top_interval_summary = []
+        all_cpg_d = OrderedDict()
+        all_interval_summary = []
+        top_interval_summary = []
 
-    # Init dict to collect data for api_mode
-    if api_mode:
-        top_cpg_df_d = OrderedDict()
+        # Init dict to collect data for api_mode
+        if api_mode:
+            top_cpg_df_d = OrderedDict()
 
-    # In normal mode, create output structure and file names
-    else:
-        log.info("Creating output directory structure")
-        summary_report_fn = "pycoMeth_summary_report.html"
-        top_intervals_fn = "pycoMeth_summary_intervals.tsv"
-        reports_outdir = "interval_reports"
-        tables_outdir = "interval_tables"
-        mkdir (outdir, exist_ok=True)
-        mkdir (os.path.join(outdir, reports_outdir), exist_ok=True)
-        mkdir (os.path.join(outdir, tables_outdir), exist_ok=True)
-        if export_static_plots:
-            kaleido = Kaleido()
+        # In normal mode, create output structure and file names
+        else:
+            log.info("Creating output directory structure")
+            summary_report_fn = "pycoMeth_summary_report.html"
+            top_intervals_fn = "pycoMeth_summary_intervals.tsv"
+            reports_outdir = "interval_reports"
+            tables_outdir = "interval_tables"
+            mkdir (outdir, exist_ok=True)
+            mkdir (os.path.join(outdir, reports_outdir), exist_ok=True)
+            mkdir (os.path.join(outdir, tables_outdir), exist_ok=True)
             plot_outdir = "static_plots"
-            mkdir (os.path.join(outdir, plot_outdir), exist_ok=True)
-
-        # Prepare src file for report and compute md5
-        log.info("Computing source md5")
-        src_file = os.path.abspath(methcomp_fn)
-        md5 = md5_str(methcomp_fn)
-
-    # Extract info from each intervals
-    log.warning("Parsing methcomp data")
-    log.info("Iterating over significant intervals")
-
-    for idx, line in tqdm(iter_idx_tuples(valid_df), total=len(valid_df), unit=" intervals", unit_scale=True, desc="\tProgress", disable=not progress):
-
-        # collect summary stats for significant intervals or all if required
-        if line.adj_pvalue <= pvalue_threshold or report_non_significant:
-            close_tx_df = get_close_tx_df(tx_df=tx_df, chromosome=line.chromosome, start=line.start, end=line.end, max_tss_distance=max_tss_distance)
-            all_interval_summary.append(get_interval_summary(line=line, close_tx_df=close_tx_df))
-
-        # collect median llr for all significant intervals
-        if line.adj_pvalue <= pvalue_threshold:
-            lab_list = ["Sample {}".format(lab) for lab in str_to_list(line.labels)]
-            med_list = str_to_list(line.med_llr_list)
-            coord = "{}-{}-{}".format(line.chromosome,line.start,line.end)
-            all_cpg_d[coord] = {lab:llr for lab, llr in zip(lab_list, med_list)}
-
-        # Extract more data for reports of top hits
-        if idx in top_dict:
-            rank = top_dict[idx]["rank"]
-            log.debug (f"Ploting top candidates rank: #{rank}")
-
-            # Extract data from line
-            cpg_df = get_cpg_df(line)
-
-            # In API mode just collect the CpG data
-            if api_mode:
-                top_cpg_df_d[rank] = cpg_df
-
-            # Generate figures and tables
-            else:
-                try:
-                    heatmap_fig = cpg_heatmap(cpg_df, lim_llr=10, min_diff_llr=min_diff_llr)
-                    ridgeplot_fig = cpg_ridgeplot(cpg_df, box=False, scatter=True, min_diff_llr=min_diff_llr)
-                    interval_df = get_interval_df(line=line, rank=rank)
-                except ValueError as E:
-                    from IPython.core.display import display
-                    print(line)
-                    display(cpg_df)
-                    raise E
-
-                # Collect Interval minimal info
-                link_out_file = os.path.join(reports_outdir, top_dict[idx]["bn"]+".html")
-                top_interval_summary.append(get_interval_summary(line=line, close_tx_df=close_tx_df, rank=rank, out_file=link_out_file))
-
-                # Render interval HTML report
-                html_out_file = os.path.join(outdir, reports_outdir, top_dict[idx]["bn"]+".html")
-                write_cpg_interval_html(
-                    out_file = html_out_file,
+            plotlyjs_fn = "plotly.min.js"
+            if export_static_plots:
+                kaleido = _get_kaleido()
+                mkdir (os.path.join(outdir, plot_outdir), exist_ok=True)
+
+            # Prepare src file for report and compute md5
+            log.info("Computing source md5")
+            src_file = os.path.abspath(methcomp_fn)
+            md5 = md5_str(methcomp_fn)
+
+            # Write plotly.js only once for all reports if required
+            if local_plotlyjs:
+                log.info("Writing plotly.js to output directory")
+                with open(os.path.join(outdir, plotlyjs_fn), "w") as fp:
+                    fp.write(py.get_plotlyjs())
+
+        # Extract info from each intervals
+        log.warning("Parsing methcomp data")
+        log.info("Finding closest transcripts TSS")
+        with prof.stage("Finding closest TSS", n_items=len(valid_df), unit="intervals"):
+            closest_tx_df = get_closest_tx_df(tx_df=tx_df, tss_index=tss_index, df=valid_df, max_tss_distance=max_tss_distance)
+
+        log.info("Iterating over significant intervals")
+        with prof.stage("Collecting intervals data", n_items=len(valid_df), unit="intervals"):
+            closest_tx_iter = closest_tx_df.itertuples(index=False, name=None)
+            for (idx, line), closest_tx in tqdm(zip(iter_idx_tuples(valid_df), closest_tx_iter), total=len(valid_df), unit=" intervals", unit_scale=True, desc="\tProgress", disable=not progress):
+
+                # collect summary stats for significant intervals or all if required
+                if line.adj_pvalue <= pvalue_threshold or report_non_significant:
+                    all_interval_summary.append(get_interval_summary(line=line, closest_tx=closest_tx))
+
+                # collect median llr for all significant intervals
+                if line.adj_pvalue <= pvalue_threshold:
+                    lab_list = ["Sample {}".format(lab) for lab in str_to_list(line.labels)]
+                    med_list = str_to_list(line.med_llr_list)
+                    coord = "{}-{}-{}".format(line.chromosome,line.start,line.end)
+                    all_cpg_d[coord] = {lab:llr for lab, llr in zip(lab_list, med_list)}
+
+                # Extract more data for reports of top hits
+                if idx in top_dict:
+                    rank = top_dict[idx]["rank"]
+                    log.debug (f"Ploting top candidates rank: #{rank}")
+
+                    # In API mode just collect the CpG data
+                    if api_mode:
+                        top_cpg_df_d[rank] = get_cpg_df(line)
+
+                    # Collect Interval minimal info and defer the rendering of the interval report
+                    else:
+                        link_out_file = os.path.join(reports_outdir, top_dict[idx]["bn"]+".html")
+                        top_interval_summary.append(get_interval_summary(line=line, closest_tx=closest_tx, rank=rank, out_file=link_out_file))
+
+        # Render interval reports of top hits in worker processes or serially
+        if top_dict and not api_mode:
+            log.info("Rendering top candidates interval reports")
+            with prof.stage("Rendering interval reports", n_items=len(top_dict), unit="reports"):
+                report_opt = dict(
+                    outdir = outdir,
+                    reports_outdir = reports_outdir,
+                    tables_outdir = tables_outdir,
+                    plot_outdir = plot_outdir,
                     src_file = src_file,
                     md5 = md5,
                     summary_link = "../{}".format(summary_report_fn),
-                    previous_link = prev_fn(rank_fn_dict, rank)+".html",
-                    next_link = next_fn(rank_fn_dict, rank)+".html",
+                    plotlyjs_src = "../{}".format(plotlyjs_fn) if local_plotlyjs else PLOTLYJS_CDN,
                     max_tss_distance = max_tss_distance,
-                    interval_df = interval_df,
-                    close_tx_df = close_tx_df,
-                    heatmap_fig = heatmap_fig,
-                    ridgeplot_fig = ridgeplot_fig)
+                    min_diff_llr = min_diff_llr,
+                    export_static_plots = export_static_plots)
+                task_gen = _interval_report_tasks(top_candidates=top_candidates, top_dict=top_dict, tx_df=tx_df, tss_index=tss_index, opt=report_opt)
+
+                with tqdm (total=len(top_dict), unit=" reports", desc="\tProgress", disable=not progress) as pbar:
+                    if threads > 1:
+                        with Pool(threads) as pool:
+                            for _ in pool.imap_unordered(_write_interval_report, task_gen):
+                                pbar.update(1)
+                    else:
+                        for task in task_gen:
+                            _write_interval_report(task)
+                            pbar.update(1)
+
+        # Convert to DataFrame
+        all_cpg_df = pd.DataFrame.from_dict(all_cpg_d)
+        all_summary_df = get_interval_summary_df(all_interval_summary)
+
+        if api_mode:
+            # Sort dictionary by rank
+            top_cpg_df_d = OrderedDict(sorted(top_cpg_df_d.items(), key=lambda t: t[0]))
+            # Return all dataframe and sorted dataframe dictionary
+            return (all_summary_df, all_cpg_df, top_cpg_df_d)
+
+        else:
+            # Collect data at CpG interval level
+            log.info("Generating summary report")
+            with prof.stage("Generating summary report"):
+                # Generate figures and tables
+                summary_df = get_summary_df(df, sig_df)
+                top_interval_summary_df = get_interval_summary_df(top_interval_summary)
+                all_heatmap_fig = cpg_heatmap(all_cpg_df, lim_llr=4, min_diff_llr=min_diff_llr)
+                all_ridgeplot_fig = cpg_ridgeplot(all_cpg_df, box=True, scatter=False, min_diff_llr=min_diff_llr)
+                catplot_fig = category_barplot(all_cpg_df, min_diff_llr=min_diff_llr)
+                ideogram_fig = chr_ideogram_plot(all_cpg_df, ref_fasta_fn, n_len_bin=n_len_bin)
+                tss_dist_fig = tss_dist_plot(all_summary_df, pvalue_threshold=pvalue_threshold, max_distance=max_tss_distance)
+
+                # Write out HTML report
+                html_out_path = os.path.join(outdir, summary_report_fn)
+                write_summary_html(
+                    out_file = html_out_path,
+                    src_file = src_file,
+                    md5 = md5,
+                    summary_df = summary_df,
+                    top_interval_summary_df = top_interval_summary_df,
+                    catplot_fig = catplot_fig,
+                    heatmap_fig = all_heatmap_fig,
+                    ridgeplot_fig = all_ridgeplot_fig,
+                    ideogram_fig = ideogram_fig,
+                    tss_dist_fig = tss_dist_fig,
+                    plotlyjs_src = plotlyjs_fn if local_plotlyjs else PLOTLYJS_CDN)
 
                 # Write out TSV table
-                if not close_tx_df.empty:
-                    table_out_path = os.path.join(outdir, tables_outdir, top_dict[idx]["bn"]+".tsv")
-                    close_tx_df.to_csv(table_out_path, sep="\t", index=False)
+                table_out_path = os.path.join(outdir, top_intervals_fn)
+                if not all_summary_df.empty:
+                    all_summary_df.to_csv(table_out_path, sep="\t", index=False)
 
                 # Try to export static plots if required
                 if export_static_plots:
-                    kaleido.export_plotly_svg (fig=heatmap_fig, fn=os.path.join(outdir, plot_outdir, top_dict[idx]["bn"]+"_heatmap.svg"), width=1400)
-                    kaleido.export_plotly_svg (fig=ridgeplot_fig, fn=os.path.join(outdir, plot_outdir, top_dict[idx]["bn"]+"_ridgeplot.svg"), width=1400)
-
-    # Convert to DataFrame
-    all_cpg_df = pd.DataFrame.from_dict(all_cpg_d)
-    all_summary_df = get_interval_summary_df(all_interval_summary)
+                    kaleido.export_plotly_svg (fig=all_heatmap_fig, fn=os.path.join(outdir, plot_outdir, "all_heatmap.svg"), width=1400)
+                    kaleido.export_plotly_svg (fig=all_ridgeplot_fig, fn=os.path.join(outdir, plot_outdir, "all_ridgeplot.svg"), width=1400)
+                    kaleido.export_plotly_svg (fig=catplot_fig, fn=os.path.join(outdir, plot_outdir, "all_catplot.svg"), width=1400)
+                    kaleido.export_plotly_svg (fig=ideogram_fig, fn=os.path.join(outdir, plot_outdir, "all_ideogram.svg"), width=1400)
+                    kaleido.export_plotly_svg (fig=tss_dist_fig, fn=os.path.join(outdir, plot_outdir, "all_tss_distance.svg"), width=1400)
 
-    if api_mode:
-        # Sort dictionary by rank
-        top_cpg_df_d = OrderedDict(sorted(top_cpg_df_d.items(), key=lambda t: t[0]))
-        # Return all dataframe and sorted dataframe dictionary
-        return (all_summary_df, all_cpg_df, top_cpg_df_d)
-
-    else:
-        # Collect data at CpG interval level
-        log.info("Generating summary report")
-
-        # Generate figures and tables
-        summary_df = get_summary_df(df, sig_df)
-        top_interval_summary_df = get_interval_summary_df(top_interval_summary)
-        all_heatmap_fig = cpg_heatmap(all_cpg_df, lim_llr=4, min_diff_llr=min_diff_llr)
-        all_ridgeplot_fig = cpg_ridgeplot(all_cpg_df, box=True, scatter=False, min_diff_llr=min_diff_llr)
-        catplot_fig = category_barplot(all_cpg_df, min_diff_llr=min_diff_llr)
-        ideogram_fig = chr_ideogram_plot(all_cpg_df, ref_fasta_fn, n_len_bin=n_len_bin)
-        tss_dist_fig = tss_dist_plot(all_summary_df, pvalue_threshold=pvalue_threshold, max_distance=max_tss_distance)
-
-        # Write out HTML report
-        html_out_path = os.path.join(outdir, summary_report_fn)
-        write_summary_html(
-            out_file = html_out_path,
-            src_file = src_file,
-            md5 = md5,
-            summary_df = summary_df,
-            top_interval_summary_df = top_interval_summary_df,
-            catplot_fig = catplot_fig,
-            heatmap_fig = all_heatmap_fig,
-            ridgeplot_fig = all_ridgeplot_fig,
-            ideogram_fig = ideogram_fig,
-            tss_dist_fig = tss_dist_fig)
-
-        # Write out TSV table
-        table_out_path = os.path.join(outdir, top_intervals_fn)
-        if not all_summary_df.empty:
-            all_summary_df.to_csv(table_out_path, sep="\t", index=False)
-
-        # Try to export static plots if required
-        if export_static_plots:
-            kaleido.export_plotly_svg (fig=all_heatmap_fig, fn=os.path.join(outdir, plot_outdir, "all_heatmap.svg"), width=1400)
-            kaleido.export_plotly_svg (fig=all_ridgeplot_fig, fn=os.path.join(outdir, plot_outdir, "all_ridgeplot.svg"), width=1400)
-            kaleido.export_plotly_svg (fig=catplot_fig, fn=os.path.join(outdir, plot_outdir, "all_catplot.svg"), width=1400)
-            kaleido.export_plotly_svg (fig=ideogram_fig, fn=os.path.join(outdir, plot_outdir, "all_ideogram.svg"), width=1400)
-            kaleido.export_plotly_svg (fig=tss_dist_fig, fn=os.path.join(outdir, plot_outdir, "all_tss_distance.svg"), width=1400)
+    finally:
+        prof.report(log.info)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~HTML generating functions~~~~~~~~~~~~~~~~~~~~~~~~#
 
-def write_cpg_interval_html (out_file, src_file, md5, summary_link, previous_link, next_link, max_tss_distance, interval_df, close_tx_df, heatmap_fig, ridgeplot_fig):
+def _interval_report_tasks (top_candidates, top_dict, tx_df, tss_index, opt):
+    """
+    Lazily generate the rendering tasks of the top candidates in rank order. Each task only contains the data of its interval
+    and the names of the previous and next reports, so that tasks sent to worker processes do not grow with the number of candidates
+    """
+    rank_fn_dict = {i["rank"]:i["bn"] for i in top_dict.values()}
+    for idx, line in iter_idx_tuples(top_candidates):
+        rank = top_dict[idx]["rank"]
+        cpg_df = get_cpg_df(line)
+        close_tx_df = get_close_tx_df(tx_df=tx_df, tss_index=tss_index, chromosome=line.chromosome, start=line.start, end=line.end, max_tss_distance=opt["max_tss_distance"])
+        yield ((line._asdict(), cpg_df, close_tx_df, rank, top_dict[idx]["bn"], prev_fn(rank_fn_dict, rank), next_fn(rank_fn_dict, rank)), opt)
+
+def _write_interval_report (task):
+    """Worker function generating the figures, HTML report, transcript table and static plots of a top candidate interval"""
+    (line_dict, cpg_df, close_tx_df, rank, bn, prev_bn, next_bn), opt = task
+    line = namedtuple("line", line_dict.keys())(**line_dict)
+
+    # Generate figures and tables
+    try:
+        heatmap_fig = cpg_heatmap(cpg_df, lim_llr=10, min_diff_llr=opt["min_diff_llr"])
+        ridgeplot_fig = cpg_ridgeplot(cpg_df, box=False, scatter=True, min_diff_llr=opt["min_diff_llr"])
+        interval_df = get_interval_df(line=line, rank=rank)
+    except ValueError as E:
+        raise pycoMethError ("Cannot generate the report of interval {}:{}-{}: {}".format(line.chromosome, line.start, line.end, E))
+
+    # Render interval HTML report
+    html_out_file = os.path.join(opt["outdir"], opt["reports_outdir"], bn+".html")
+    write_cpg_interval_html(
+        out_file = html_out_file,
+        src_file = opt["src_file"],
+        md5 = opt["md5"],
+        summary_link = opt["summary_link"],
+        previous_link = prev_bn+".html",
+        next_link = next_bn+".html",
+        max_tss_distance = opt["max_tss_distance"],
+        interval_df = interval_df,
+        close_tx_df = close_tx_df,
+        heatmap_fig = heatmap_fig,
+        ridgeplot_fig = ridgeplot_fig,
+        plotlyjs_src = opt["plotlyjs_src"])
+
+    # Write out TSV table
+    if not close_tx_df.empty:
+        table_out_path = os.path.join(opt["outdir"], opt["tables_outdir"], bn+".tsv")
+        close_tx_df.to_csv(table_out_path, sep="\t", index=False)
+
+    # Try to export static plots if required
+    if opt["export_static_plots"]:
+        kaleido = _get_kaleido()
+        kaleido.export_plotly_svg (fig=heatmap_fig, fn=os.path.join(opt["outdir"], opt["plot_outdir"], bn+"_heatmap.svg"), width=1400)
+        kaleido.export_plotly_svg (fig=ridgeplot_fig, fn=os.path.join(opt["outdir"], opt["plot_outdir"], bn+"_ridgeplot.svg"), width=1400)
+
+@lru_cache(maxsize=None)
+def _get_kaleido ():
+    """Start a single Kaleido instance per process"""
+    return Kaleido()
+
+def write_cpg_interval_html (out_file, src_file, md5, summary_link, previous_link, next_link, max_tss_distance, interval_df, close_tx_df, heatmap_fig, ridgeplot_fig, plotlyjs_src=PLOTLYJS_CDN):
     """Write CpG interval HTML report"""
     # Get CpG_Interval template
     template = get_jinja_template ("CpG_Interval.html.j2")
@@ -296,7 +378,7 @@ def write_cpg_interval_html (out_file, src_file, md5, summary_link, previous_lin
 
     # Render HTML report using Jinja
     rendering = template.render(
-        plotlyjs = py.get_plotlyjs(),
+        plotlyjs_src = plotlyjs_src,
         version = version,
         date = datetime.datetime.now().strftime("%d/%m/%y"),
         src_file = src_file,
@@ -312,7 +394,7 @@ def write_cpg_interval_html (out_file, src_file, md5, summary_link, previous_lin
     with open(out_file, "w") as fp:
         fp.write(rendering)
 
-def write_summary_html (out_file, src_file, md5, summary_df, top_interval_summary_df, catplot_fig, heatmap_fig, ridgeplot_fig, ideogram_fig, tss_dist_fig):
+def write_summary_html (out_file, src_file, md5, summary_df, top_interval_summary_df, catplot_fig, heatmap_fig, ridgeplot_fig, ideogram_fig, tss_dist_fig, plotlyjs_src=PLOTLYJS_CDN):
     """Write summary HTML report"""
     # Get CpG_Interval template
     template = get_jinja_template("CpG_summary.html.j2")
@@ -328,7 +410,7 @@ def write_summary_html (out_file, src_file, md5, summary_df, top_interval_summar
 
     # Render HTML report using Jinja
     rendering = template.render(
-        plotlyjs = py.get_plotlyjs(),
+        plotlyjs_src = plotlyjs_src,
         version = version,
         date = datetime.datetime.now().strftime("%d/%m/%y"),
         src_file = src_file,
@@ -397,6 +479,27 @@ def get_ensembl_tx (gff_fn):
         df = df.fillna(pd.NA)
         return df
 
+def get_tss_index (tx_df):
+    """
+    Index transcripts TSS per chromosome. Return a dict of chromosomes containing sorted TSS positions, the corresponding tx_df rows sorted
+    by TSS and row, and the position of the first TSS of each run of identical TSS
+    """
+    tss_index = OrderedDict()
+    if tx_df.empty:
+        return tss_index
+
+    chr_array = tx_df["chromosome"].to_numpy()
+    tss_array = tx_df["tss"].to_numpy(dtype=np.int64)
+    for chromosome in pd.unique(chr_array):
+        rows = np.flatnonzero(chr_array == chromosome)
+        rows = rows[np.lexsort((rows, tss_array[rows]))]
+        tss = tss_array[rows]
+        run_start = np.ones(len(tss), dtype=bool)
+        run_start[1:] = tss[1:] != tss[:-1]
+        run_first = np.maximum.accumulate(np.where(run_start, np.arange(len(tss)), 0))
+        tss_index[str(chromosome)] = (tss, rows, run_first)
+    return tss_index
+
 def get_chr_len(fasta_fn):
     """Extract reference sequences length from fasta files"""
     len_d = OrderedDict()
@@ -424,23 +527,91 @@ def get_cpg_df (line):
 
     return cpg_df.T
 
-def get_close_tx_df (tx_df, chromosome, start, end, max_tss_distance=100000):
+def get_close_tx_df (tx_df, tss_index, chromosome, start, end, max_tss_distance=100000):
     """Find transcripts with a TSS within a given genomic interval"""
-    rdf = tx_df.query("chromosome == '{}' and tss >= {} and tss <= {}".format(chromosome, start-max_tss_distance, end+max_tss_distance))
-    tss_dist = []
-    for tx, line in iter_idx_tuples(rdf):
-        if line.tss > end:
-            tss_dist.append(line.tss-end)
-        elif line.tss < start:
-            tss_dist.append(line.tss-start)
-        else:
-            tss_dist.append(0)
+    chromosome = str(chromosome)
+    if chromosome in tss_index:
+        tss, rows, run_first = tss_index[chromosome]
+        lo, hi = np.searchsorted(tss, [start-max_tss_distance, end+max_tss_distance+1])
+        rows = np.sort(rows[lo:hi])
+    else:
+        rows = []
+
+    rdf = tx_df.iloc[rows].copy()
+    tss = rdf["tss"].to_numpy(dtype=np.int64)
+    tss_dist = np.where(tss > end, tss-end, np.where(tss < start, tss-start, 0))
     rdf["distance to tss"] = tss_dist
     rdf["abs_tss"] = np.abs(tss_dist)
-    rdf.sort_values("abs_tss", inplace=True)
+    rdf.sort_values("abs_tss", inplace=True, kind="mergesort")
     rdf = rdf[["distance to tss", "transcript id","gene id","transcript name","chromosome","start","end","strand","feature type","transcript biotype"]]
     return rdf
 
+def get_closest_tx_df (tx_df, tss_index, df, max_tss_distance=100000):
+    """
+    Annotate all the intervals of a dataframe at once with the number of TSS within max_tss_distance and the closest transcript.
+    Ties between equidistant TSS are resolved by transcript order in the GFF file
+    """
+    n = len(df)
+    n_tss = np.zeros(n, dtype=np.int64)
+    closest_row = np.full(n, -1, dtype=np.int64)
+    distance = np.zeros(n, dtype=np.int64)
+
+    chr_array = df["chromosome"].astype(str).to_numpy()
+    start_array = df["start"].to_numpy(dtype=np.int64)
+    end_array = df["end"].to_numpy(dtype=np.int64)
+    for chromosome in pd.unique(chr_array):
+        if not chromosome in tss_index:
+            continue
+        tss, rows, run_first = tss_index[chromosome]
+        sel = np.flatnonzero(chr_array == chromosome)
+        start = start_array[sel]
+        end = end_array[sel]
+
+        # Count TSS in windows
+        lo = np.searchsorted(tss, start-max_tss_distance, side="left")
+        hi = np.searchsorted(tss, end+max_tss_distance, side="right")
+        n_tss[sel] = hi-lo
+
+        # TSS overlapping intervals are in [first_in, first_down[. Closest upstream TSS is before first_in
+        first_in = np.searchsorted(tss, start, side="left")
+        first_down = np.searchsorted(tss, end, side="right")
+        overlap = first_in < first_down
+        up = first_in-1
+        has_up = up >= lo
+        has_down = first_down < hi
+        up_dist = np.where(has_up, start-tss[np.maximum(up, 0)], np.iinfo(np.int64).max)
+        down_dist = np.where(has_down, tss[np.minimum(first_down, len(tss)-1)]-end, np.iinfo(np.int64).max)
+        up_row = np.where(has_up, rows[run_first[np.maximum(up, 0)]], -1)
+        down_row = np.where(has_down, rows[np.minimum(first_down, len(tss)-1)], -1)
+
+        # Select closest TSS and first transcript in file for equidistant TSS
+        use_up = has_up & (~has_down | (up_dist < down_dist) | ((up_dist == down_dist) & (up_row < down_row)))
+        row = np.where(use_up, up_row, down_row)
+        dist = np.where(use_up, -up_dist, down_dist)
+
+        # Overlapping TSS with the lowest row
+        if overlap.any():
+            bounds = np.column_stack((first_in[overlap], first_down[overlap])).ravel()
+            row[overlap] = np.minimum.reduceat(np.append(rows, 0), bounds)[::2]
+            dist[overlap] = 0
+
+        closest_row[sel] = row
+        distance[sel] = dist
+
+    # Collect transcripts info and set missing values for intervals without nearby TSS
+    found = closest_row >= 0
+    closest_df = pd.DataFrame(index=df.index)
+    closest_df["Number of nearby TSS"] = n_tss
+    for field in ["transcript id", "transcript name", "transcript biotype"]:
+        values = np.full(n, pd.NA, dtype=object)
+        if found.any():
+            values[found] = tx_df[field].to_numpy(dtype=object)[closest_row[found]]
+        closest_df["closest "+field.replace("transcript", "tx")] = values
+    values = np.full(n, pd.NA, dtype=object)
+    values[found] = distance[found].tolist()
+    closest_df["distance to tss"] = values
+    return closest_df
+
 def get_interval_df (line, rank):
     """Generate a single line dataframe describing the current interval"""
 
@@ -466,8 +637,8 @@ def get_summary_df (df, sig_df):
 
     return s.to_frame().T
 
-def get_interval_summary (line, close_tx_df, rank=None, out_file=None):
-    """Generate a summary dict for intervals"""
+def get_interval_summary (line, closest_tx, rank=None, out_file=None):
+    """Generate a summary dict for intervals from a tuple of nearby TSS number and closest transcript info (see get_closest_tx_df)"""
     d = OrderedDict()
     if rank:
         d["rank"] = f"#{rank}"
@@ -478,18 +649,7 @@ def get_interval_summary (line, close_tx_df, rank=None, out_file=None):
     d["start"] = line.start
     d["end"] = line.end
 
-    if close_tx_df.empty:
-        d["Number of nearby TSS"] = 0
-        d["closest tx id"] = pd.NA
-        d["closest tx name"] = pd.NA
-        d["closest tx biotype"] = pd.NA
-        d["distance to tss"] = pd.NA
-    else:
-        d["Number of nearby TSS"] = len(close_tx_df)
-        d["closest tx id"] = close_tx_df.iloc[0]["transcript id"]
-        d["closest tx name"] = close_tx_df.iloc[0]["transcript name"]
-        d["closest tx biotype"] = close_tx_df.iloc[0]["transcript biotype"]
-        d["distance to tss"] = close_tx_df.iloc[0]["distance to tss"]
+    d["Number of nearby TSS"], d["closest tx id"], d["closest tx name"], d["closest tx biotype"], d["distance to tss"] = closest_tx
     return  d
 
 def get_interval_summary_df (interval_summary_list):
@@ -843,8 +1003,9 @@ def tss_dist_plot (
 
 #~~~~~~~~~~~~~~~~~~~~~~~~Help functions~~~~~~~~~~~~~~~~~~~~~~~~#
 
+@lru_cache(maxsize=None)
 def get_jinja_template (template_fn):
-    """Load Jinja template"""
+    """Load Jinja template. Compiled templates are cached and reused for all the reports rendered by a process"""
     try:
         env = jinja2.Environment (
             loader=jinja2.PackageLoader('pycoMeth', 'templates'),
@@ -7,6 +7,8 @@ from collections import OrderedDict, namedtuple, Counter
 
 # Third party imports
 from pyfaidx import Fasta
+import numpy as np
+# pandas is slow to import and only imported when needed
 
 # Local imports
 from pycoMeth.common import *
@@ -79,6 +81,31 @@ class CoordGen():
 
         return Coord(chr_id, chr_name, start, end)
 
+    def chr_ids (self, chr_name, start, end):
+        """
+        Vectorized version of the coordinates check for arrays of coordinates.
+        Return an array of chromosome ids and raise a CoordTupleError for the first invalid coordinates found.
+        * chr_name
+            Array of chromosome names
+        * start
+            Array of interval starts (have to be between 0 and chromosome length)
+        * end
+            Array of interval ends (have to be between start and chromosome length)
+        """
+        import pandas as pd
+        chr_name = np.asarray(chr_name, dtype=object)
+        chr_id = pd.Index(list(self.chr_name_id.keys())).get_indexer(chr_name)
+        chr_len = np.array(list(self.chr_name_len.values()), dtype=np.int64)[chr_id]
+        start = np.asarray(start)
+        end = np.asarray(end)
+        invalid = (chr_id < 0) | (start < 0) | (start > chr_len) | (end < start) | (end > chr_len)
+
+        # Reuse scalar check to raise the same error as for a single coordinate
+        if invalid.any():
+            i = np.flatnonzero(invalid)[0]
+            self(chr_name[i], start[i], end[i])
+        return chr_id
+
 class Coord():
     def __init__ (self, chr_id, chr_name, start, end):
         self.chr_id = chr_id
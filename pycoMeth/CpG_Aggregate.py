@@ -4,6 +4,10 @@
 # Standard library imports
 from collections import OrderedDict, namedtuple, Counter
 import gzip
+import shutil
+import tempfile
+import mmap
+from multiprocessing import Pool
 
 # Third party imports
 from tqdm import tqdm
@@ -20,12 +24,20 @@ def CpG_Aggregate(
     ref_fasta_fn:str,
     output_bed_fn:str="",
     output_tsv_fn:str="",
+    output_parquet_fn:str="",
     min_depth:int=10,
     sample_id:str="",
     min_llr:float=2,
+    sorted_input:bool=False,
+    max_memory:int=0,
+    tmp_dir:str="",
+    threads:int=1,
     verbose:bool=False,
     quiet:bool=False,
     progress:bool=False,
+    profile:bool=False,
+    profile_dir:str="",
+    metrics_json:str="",
     **kwargs):
     """
     Calculate methylation frequency at genomic CpG sites from the output of `nanopolish call-methylation`
@@ -37,76 +49,215 @@ def CpG_Aggregate(
         Path to write a summary result file in BED format (At least 1 output file is required) (can be gzipped)
     * output_tsv_fn
         Path to write a more extensive result report in TSV format (At least 1 output file is required) (can be gzipped)
+    * output_parquet_fn
+        Path to write the same data as the TSV report in binary Parquet format with a native list column for llr values.
+        Faster to parse by Interval_Aggregate and Meth_Comp (At least 1 output file is required) (requires pyarrow)
     * min_depth
         Minimal number of reads covering a site to be reported
     * sample_id
         Sample ID to be used for the BED track header
     * min_llr
         Minimal log likelyhood ratio to consider a site significantly methylated or unmethylated in output BED file
+    * sorted_input
+        Write sites to the output files as soon as all their calls were parsed, instead of keeping all the sites in memory.
+        Requires nanopolish files sorted by coordinates with chromosomes ordered as in the reference file, and fails otherwise
+    * max_memory
+        Approximate memory budget in MB to buffer calls for unsorted inputs too large to fit in memory. If > 0, buffered calls
+        are written to temporary files as sorted runs when the budget is exceeded, and the runs are merged to aggregate sites
+    * tmp_dir
+        Directory where to write temporary files when using max_memory or threads instead of the system temporary directory
+    * threads
+        Number of worker processes used to aggregate and write sites per chromosome (not used with sorted_input and max_memory)
     """
 
     # Init package
     opt_summary_dict = opt_summary(local_opt=locals())
     log = get_logger (name="pycoMeth_CpG_Aggregate", verbose=verbose, quiet=quiet)
+    prof = Profiler(enabled=profile, profile_dir=profile_dir, metrics_json=metrics_json, prefix="CpG_Aggregate", options=opt_summary_dict)
 
     log.warning("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
 
     # At least one output file is required, otherwise it doesn't make any sense
-    if not output_bed_fn and not output_tsv_fn:
-        raise pycoMethError ("At least 1 output file is requires (-t or -b)")
-
-    # Init SitesIndex object with ref_fasta_fn to aggregate data at genomic position level
-    log.warning ("Parsing methylation_calls file")
-    sites_index = SitesIndex(ref_fasta_fn=ref_fasta_fn)
-
-    # Open file parser
-    # Possible fields chromosome	strand	start	end	read_name	log_lik_ratio	log_lik_methylated	log_lik_unmethylated	num_calling_strands	num_motifs	sequence
-    dtypes = {"start":int, "end":int, "log_lik_ratio":float, "num_motifs":int}
-    with FileParser(fn=nanopolish_fn, dtypes=dtypes, verbose=verbose, quiet=quiet, include_byte_len=progress) as fp_in:
-
-        if not fp_in.input_type == "call_methylation":
-            raise pycoMethError("Invalid input file type passed (nanopolish_fn). Expecting Nanopolish call_methylation output TSV file")
-
-        log.info ("Starting to parse file Nanopolish methylation call file")
-        with tqdm (total=len(fp_in), unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
-            for lt in fp_in:
-                sites_index.add(lt)
-                # Update progress_bar
-                if progress: pbar.update(lt.byte_len)
-
-        log_dict(fp_in.counter, log.info, "Parsing summary")
-
-        log.info ("Filtering out low coverage sites")
-        sites_index.filter_low_count(min_depth)
-
-        log.info ("Sorting each chromosome by coordinates")
-        sites_index.sort()
-
-        log_dict(sites_index.counter, log.info, "Sites summary")
-
-    log.warning("Processing valid sites found and write to file")
-
-    with CpG_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, sample_id=sample_id, min_llr=min_llr, verbose=verbose) as fp_out:
-        for coord, val_dict in tqdm(sites_index, unit=" sites", unit_scale=True, desc="\tProgress", disable=not progress):
-            fp_out.write (coord, val_dict)
-
-        log_dict(fp_out.counter, log.info, "Results summary")
+    if not output_bed_fn and not output_tsv_fn and not output_parquet_fn:
+        raise pycoMethError ("At least 1 output file is requires (-t, -b or --output_parquet_fn)")
+
+    # Worker processes are only used to aggregate sites from the in memory index
+    if threads > 1 and (sorted_input or max_memory):
+        log.error ("threads is not used with sorted_input or max_memory. Sites will be aggregated in a single process")
+
+    try:
+        # Init SitesIndex object with ref_fasta_fn to aggregate data at genomic position level
+        log.warning ("Parsing methylation_calls file")
+        if max_memory and not sorted_input:
+            log.debug ("Using disk backed sites index with a {} MB memory budget".format(max_memory))
+            sites_index = SitesSpillIndex(ref_fasta_fn=ref_fasta_fn, max_memory=max_memory, tmp_dir=tmp_dir)
+        else:
+            sites_index = SitesIndex(ref_fasta_fn=ref_fasta_fn)
+        prof.add_counter("Sites summary", sites_index.counter)
+        prof.add_files(input_fn=[nanopolish_fn, ref_fasta_fn], output_fn=[output_bed_fn, output_tsv_fn, output_parquet_fn])
+
+        # Open file parser
+        # Possible fields chromosome	strand	start	end	read_name	log_lik_ratio	log_lik_methylated	log_lik_unmethylated	num_calling_strands	num_motifs	sequence
+        dtypes = {"start":int, "end":int, "log_lik_ratio":float, "num_motifs":int}
+        with FileParser(fn=nanopolish_fn, dtypes=dtypes, verbose=verbose, quiet=quiet, include_byte_len=progress) as fp_in:
+
+            if not fp_in.input_type == "call_methylation":
+                raise pycoMethError("Invalid input file type passed (nanopolish_fn). Expecting Nanopolish call_methylation output TSV file")
+            prof.add_counter("Parsing summary", fp_in.counter)
+
+            # Stream sites to output files if input is sorted
+            if sorted_input:
+                log.info ("Starting to stream sorted Nanopolish methylation call file")
+                with CpG_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, parquet_fn=output_parquet_fn, sample_id=sample_id, min_llr=min_llr, verbose=verbose) as fp_out:
+                    prof.add_counter("Results summary", fp_out.counter)
+                    with tqdm (total=len(fp_in), unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+                        for chunk in prof.iter("Parsing calls", fp_in.iter_chunks(chunk_size=100000), unit="calls"):
+                            with prof.stage("Aggregating and writing sites", n_items=len(chunk), unit="calls"):
+                                for chrom_sites in sites_index.add_sorted_chunk(chunk, min_depth):
+                                    fp_out.write_sites (chrom_sites)
+                            # Update progress_bar
+                            if progress: pbar.update(chunk["byte_len"].sum())
+
+                        with prof.stage("Aggregating and writing sites"):
+                            for chrom_sites in sites_index.flush_sorted(min_depth):
+                                fp_out.write_sites (chrom_sites)
+
+                    log_dict(fp_in.counter, log.info, "Parsing summary")
+                    log_dict(sites_index.counter, log.info, "Sites summary")
+                    log_dict(fp_out.counter, log.info, "Results summary")
+                return
+
+            log.info ("Starting to parse file Nanopolish methylation call file")
+            with tqdm (total=len(fp_in), unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+                for chunk in prof.iter("Parsing calls", fp_in.iter_chunks(chunk_size=100000), unit="calls"):
+                    with prof.stage("Indexing calls", n_items=len(chunk), unit="calls"):
+                        sites_index.add_chunk(chunk)
+                    # Update progress_bar
+                    if progress: pbar.update(chunk["byte_len"].sum())
+
+            log_dict(fp_in.counter, log.info, "Parsing summary")
+
+            # Merge sorted runs from disk and write sites on the fly
+            if max_memory:
+                log.warning("Merging sorted runs and writing valid sites to file")
+                with sites_index, CpG_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, parquet_fn=output_parquet_fn, sample_id=sample_id, min_llr=min_llr, verbose=verbose) as fp_out:
+                    prof.add_counter("Results summary", fp_out.counter)
+                    with tqdm (unit=" sites", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+                        for chrom_sites in prof.iter("Merging sorted runs", sites_index.merge_runs(min_depth), unit="sites"):
+                            with prof.stage("Writing sites", n_items=len(chrom_sites), unit="sites"):
+                                fp_out.write_sites (chrom_sites)
+                            pbar.update(len(chrom_sites))
+
+                    log_dict(sites_index.counter, log.info, "Sites summary")
+                    log_dict(fp_out.counter, log.info, "Results summary")
+                return
+
+            # Aggregate and write sites of each chromosome in worker processes
+            if threads > 1:
+                log.warning("Processing sites with {} worker processes and write to file".format(threads))
+                with prof.stage("Aggregating and writing sites", unit="sites"):
+                    writer_counter = _write_parallel (
+                        sites_index=sites_index, threads=threads, output_bed_fn=output_bed_fn, output_tsv_fn=output_tsv_fn, output_parquet_fn=output_parquet_fn,
+                        min_depth=min_depth, sample_id=sample_id, min_llr=min_llr, tmp_dir=tmp_dir, verbose=verbose, progress=progress, log=log)
+                prof.add_items("Aggregating and writing sites", sites_index.counter["Valid Sites Found"])
+                prof.add_counter("Results summary", writer_counter)
+                return
+
+            log.info ("Filtering out low coverage sites")
+            with prof.stage("Filtering sites", unit="sites"):
+                sites_index.filter_low_count(min_depth)
+            prof.add_items("Filtering sites", sites_index.counter["Initial Sites"])
+
+            log.info ("Sorting each chromosome by coordinates")
+            with prof.stage("Sorting sites", unit="sites"):
+                sites_index.sort()
+            prof.add_items("Sorting sites", sites_index.counter["Valid Sites Found"])
+
+            log_dict(sites_index.counter, log.info, "Sites summary")
+
+        log.warning("Processing valid sites found and write to file")
+
+        with CpG_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, parquet_fn=output_parquet_fn, sample_id=sample_id, min_llr=min_llr, verbose=verbose) as fp_out:
+            prof.add_counter("Results summary", fp_out.counter)
+            with tqdm (total=len(sites_index), unit=" sites", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+                for chrom, chrom_sites in sites_index:
+                    with prof.stage("Writing sites", n_items=len(chrom_sites), unit="sites"):
+                        fp_out.write_sites (chrom_sites)
+                    pbar.update(len(chrom_sites))
+
+            log_dict(fp_out.counter, log.info, "Results summary")
+
+    finally:
+        prof.report(log.info)
+
+def _write_parallel (sites_index, threads, output_bed_fn, output_tsv_fn, output_parquet_fn, min_depth, sample_id, min_llr, tmp_dir, verbose, progress, log):
+    """Dispatch chromosomes to a pool of worker processes, concatenate their output files in reference order and return the writer counter"""
+    with tempfile.TemporaryDirectory(prefix="pycoMeth_", dir=tmp_dir if tmp_dir else None) as tmp:
+
+        # Lazily pop chromosomes from the index to avoid keeping a second copy of the calls in memory
+        def task_gen():
+            for i, chrom in enumerate(list(sites_index.sites.keys())):
+                records = sites_index.pop_records(chrom)
+                if records:
+                    yield (
+                        chrom, records, min_depth, min_llr,
+                        os.path.join(tmp, "{}.bed".format(i)) if output_bed_fn else "",
+                        os.path.join(tmp, "{}.tsv".format(i)) if output_tsv_fn else "",
+                        os.path.join(tmp, "{}.parquet".format(i)) if output_parquet_fn else "")
+
+        with CpG_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, parquet_fn=output_parquet_fn, sample_id=sample_id, min_llr=min_llr, verbose=verbose) as fp_out:
+            with Pool(threads) as pool, tqdm (unit=" sites", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+                for bed_fn, tsv_fn, parquet_fn, sites_counter, writer_counter in pool.imap(_write_chrom_sites, task_gen()):
+                    fp_out.append(bed_fn=bed_fn, tsv_fn=tsv_fn, parquet_fn=parquet_fn, counter=writer_counter)
+                    sites_index.counter.update(sites_counter)
+                    pbar.update(writer_counter["Total Sites Writen"])
+
+            if not sites_index.counter["Valid Sites Found"]:
+                raise pycoMethError ("No valid sites left after coverage filtering")
+            log_dict(sites_index.counter, log.info, "Sites summary")
+            log_dict(fp_out.counter, log.info, "Results summary")
+    return fp_out.counter
+
+def _write_chrom_sites (task):
+    """Worker function grouping all the calls of a chromosome by site and writing valid sites to files without header"""
+    chrom, records, min_count, min_llr, bed_fn, tsv_fn, parquet_fn = task
+    counter = Counter()
+    chrom_sites = SitesArrays.from_records(chrom, *records)
+    counter ["Initial Sites"]+=len(chrom_sites)
+    chrom_sites = _filter_sites(chrom_sites, min_count, counter)
+
+    with CpG_Writer(bed_fn=bed_fn, tsv_fn=tsv_fn, parquet_fn=parquet_fn, min_llr=min_llr, header=False, verbose=False) as fp_out:
+        fp_out.write_sites (chrom_sites)
+    return (bed_fn, tsv_fn, parquet_fn, counter, fp_out.counter)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~SitesIndex HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
 class SitesIndex():
-    def __init__ (self, ref_fasta_fn):
-        """"""
+    def __init__ (self, ref_fasta_fn, buffer_size=1000000):
+        """
+        Index aggregating nanopolish calls per CpG site and per chromosome in compact SitesArrays.
+        Lines are buffered and periodically grouped by site, so that memory usage is mostly driven by the float32 llr buffer
+        * ref_fasta_fn
+            Reference file used for alignment in Fasta format (ideally already indexed with samtools faidx)
+        * buffer_size
+            Minimal number of lines to buffer per chromosome before grouping them by site
+        """
 
         # Init dict with chromosomes names
         self.sites=OrderedDict()
+        self._buffer=OrderedDict()
         with Fasta(ref_fasta_fn) as fa:
             for ref in fa:
-                self.sites[ref.name] = OrderedDict()
+                self.sites[ref.name] = SitesArrays.empty(ref.name)
+                self._buffer[ref.name] = []
 
         # Init other self variables
+        self.buffer_size = buffer_size
         self.counter = Counter()
+        self._buffer_len = Counter()
+        self._chr_id = OrderedDict((chrom, i) for i, chrom in enumerate(self.sites.keys()))
+        self._last_id = self._last_start = self._flushed_id = -1
 
     #~~~~~~~~~~~~~~MAGIC AND PROPERTY METHODS~~~~~~~~~~~~~~#
 
@@ -114,78 +265,491 @@ class SitesIndex():
         return dict_to_str(self.counter)
 
     def __len__(self):
+        self._index_all()
         i=0
         for v in self.sites.values():
             i+=len(v)
         return i
 
     def __iter__(self):
-        ct = namedtuple("ct", ["chr_name", "start", "end"])
-        for chrom, chrom_d in self.sites.items():
-            for (start, end), val_dict in chrom_d.items():
-                yield (ct(chrom, start, end), val_dict)
+        self._index_all()
+        for chrom, chrom_sites in self.sites.items():
+            yield (chrom, chrom_sites)
 
     #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
 
     def add (self, lt):
         """"""
         chrom = lt.chromosome
-        pos = (lt.start,lt.end+1)
 
         if chrom not in self.sites:
             self.counter ["Invalid chromosome lines"]+=1
 
         else:
-            if not pos in self.sites[chrom]: ####################################################### Could also collect read_name, log_lik_methylated, log_lik_unmethylated
-                self.counter ["Initial Sites"]+=1
-                self.sites[chrom][pos]={
-                    "sequence":lt.sequence,
-                    "num_motifs":lt.num_motifs,
-                    "llr":[],
-                    "n_reads":0}
-
             self.counter ["Total Valid Lines"]+=1
-            self.sites[chrom][pos]["llr"].append(lt.log_lik_ratio)
-            self.sites[chrom][pos]["n_reads"]+=1
+            start = np.array([lt.start])
+            end = np.array([lt.end+1])
+            self._buffer_add (
+                chrom=chrom, start=start, end=end, llr=np.array([lt.log_lik_ratio], dtype=np.float32),
+                meta_start=start, meta_end=end, num_motifs=np.array([lt.num_motifs]), sequence=np.array([lt.sequence], dtype="S"))
+
+    def add_chunk (self, df):
+        """Add all the lines from a DataFrame chunk generated by FileParser.iter_chunks"""
+        for chrom, arrays in _chunk_arrays(df, self.sites.keys(), self.counter):
+            self._buffer_add (chrom, *arrays)
+
+    def add_sorted_chunk (self, df, min_count=0):
+        """
+        Add a chunk from a coordinate sorted input and return a list of SitesArrays containing the sites that cannot receive
+        any more calls and passing the coverage filter. Chromosomes have to be ordered as in the reference file.
+        * df
+            DataFrame chunk generated by FileParser.iter_chunks
+        * min_count
+            Minimal number of reads covering a site
+        """
+        # Check that coordinates are sorted, including with the last line of the previous chunk
+        chr_id = df["chromosome"].map(self._chr_id)
+        valid = chr_id.notna().values
+        chr_id = chr_id.values[valid].astype(np.int64)
+        start = df["start"].values[valid]
+        if len(chr_id):
+            prev_id = np.insert(chr_id[:-1], 0, self._last_id)
+            prev_start = np.insert(start[:-1], 0, self._last_start)
+            unsorted = (chr_id < prev_id) | ((chr_id == prev_id) & (start < prev_start))
+            if unsorted.any():
+                i = np.argmax(unsorted)
+                chr_names = list(self._chr_id.keys())
+                raise pycoMethError ("Unsorted coordinate {}:{} found after {}:{}. Input has to be sorted by coordinates with chromosomes ordered as in the reference file".format(
+                    chr_names[chr_id[i]], start[i], chr_names[prev_id[i]], prev_start[i]))
+            self._last_id = chr_id[-1]
+            self._last_start = start[-1]
+
+        self.add_chunk(df)
+
+        # Sites from previous chromosomes and starting before the last line of the chunk are complete
+        l = []
+        for chrom in list(self._chr_id.keys())[max(self._flushed_id, 0):self._last_id]:
+            l.extend(self._pop_valid(chrom, min_count))
+        if self._last_id >= 0:
+            self._flushed_id = self._last_id
+            l.extend(self._pop_valid(list(self._chr_id.keys())[self._last_id], min_count, max_start=self._last_start))
+        return l
+
+    def flush_sorted (self, min_count=0):
+        """
+        Return a list of SitesArrays containing all the remaining sites passing the coverage filter once all the sorted chunks were added
+        * min_count
+            Minimal number of reads covering a site
+        """
+        l = []
+        for chrom in list(self._chr_id.keys())[max(self._flushed_id, 0):]:
+            l.extend(self._pop_valid(chrom, min_count))
+        if not self.counter["Valid Sites Found"]:
+            raise pycoMethError ("No valid sites left after coverage filtering")
+        return l
 
     def filter_low_count (self, min_count=0):
         """"""
+        self._index_all()
         filtered_sites = OrderedDict()
-        for chrom, chrom_d in self.sites.items():
-            filtered_pos = OrderedDict()
-            for pos, val_dict in chrom_d.items():
-                if val_dict["n_reads"]<min_count:
-                    self.counter ["Low Count Sites"]+=1
-                else:
-                    self.counter ["Valid Sites Found"]+=1
-                    filtered_pos[pos] = val_dict
-            if filtered_pos:
-                filtered_sites[chrom] = filtered_pos
+        for chrom, chrom_sites in self.sites.items():
+            chrom_sites = self._filter(chrom_sites, min_count)
+            if len(chrom_sites):
+                filtered_sites[chrom] = chrom_sites
 
         self.sites = filtered_sites
+        self._buffer = OrderedDict((chrom, []) for chrom in filtered_sites.keys())
         if len(self) == 0:
             raise pycoMethError ("No valid sites left after coverage filtering")
 
     def sort (self):
-        """"""
-        for k in self.sites.keys():
-            self.sites[k] = OrderedDict(sorted(self.sites[k].items(), key=lambda t: t[0]))
+        """Sites are always indexed by coordinates. Only make sure that all buffered lines are indexed"""
+        self._index_all()
+
+    def pop_records (self, chrom):
+        """
+        Remove a chromosome from the index and return all its calls in the format expected by SitesArrays.from_records,
+        without grouping the buffered lines. Return None if the chromosome has no calls
+        * chrom
+            Name of the chromosome to remove
+        """
+        chrom_sites = self.sites.pop(chrom)
+        buffer = self._buffer.pop(chrom)
+        self._buffer_len.pop(chrom, None)
+        if not len(chrom_sites) and not buffer:
+            return None
+
+        # Indexed sites will be counted again when grouping the records
+        if len(chrom_sites):
+            self.counter ["Initial Sites"]-=len(chrom_sites)
+        l = [chrom_sites.to_records()]+buffer
+        return tuple(np.concatenate(i) for i in zip(*l))
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+
+    def _filter (self, chrom_sites, min_count):
+        """Select sites with enough reads and update counters"""
+        return _filter_sites(chrom_sites, min_count, self.counter)
+
+    def _pop_valid (self, chrom, min_count, max_start=None):
+        """Remove the sites of a chromosome starting before max_start (all if None) from the index and return them if they pass the coverage filter"""
+        if self._buffer[chrom]:
+            self._index(chrom)
+        chrom_sites = self.sites[chrom]
+        if max_start is None:
+            self.sites[chrom] = SitesArrays.empty(chrom)
+        else:
+            done = chrom_sites.start < max_start
+            self.sites[chrom] = chrom_sites.select(~done)
+            chrom_sites = chrom_sites.select(done)
+
+        chrom_sites = self._filter(chrom_sites, min_count)
+        return [chrom_sites] if len(chrom_sites) else []
+
+    def _buffer_add (self, chrom, start, end, llr, meta_start, meta_end, num_motifs, sequence):
+        """Buffer lines arrays and group them by site if the buffer is getting larger than the indexed data"""
+        self._buffer[chrom].append((start, end, llr, meta_start, meta_end, num_motifs, sequence))
+        self._buffer_len[chrom]+=len(start)
+        if self._buffer_len[chrom] >= max(self.buffer_size, len(self.sites[chrom].llr)):
+            self._index(chrom)
+
+    def _index_all (self):
+        """Group all buffered lines by site"""
+        for chrom, buffer in self._buffer.items():
+            if buffer:
+                self._index(chrom)
+
+    def _index (self, chrom):
+        """Merge buffered lines of a chromosome with already indexed sites"""
+        chrom_sites = self.sites[chrom]
+        n_sites = len(chrom_sites)
+
+        # Collect indexed sites first to preserve the order of llr values
+        l = [chrom_sites.to_records()]+self._buffer[chrom]
+        self.sites[chrom] = SitesArrays.from_records(chrom, *[np.concatenate(i) for i in zip(*l)])
+        if len(self.sites[chrom]) > n_sites:
+            self.counter ["Initial Sites"]+=len(self.sites[chrom])-n_sites
+
+        self._buffer[chrom] = []
+        self._buffer_len[chrom] = 0
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~SitesSpillIndex HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+class SitesSpillIndex():
+    def __init__ (self, ref_fasta_fn, max_memory=1000, tmp_dir=""):
+        """
+        Disk backed alternative to SitesIndex with a bounded memory usage. Buffered calls are written to temporary files as runs
+        sorted by coordinates when they exceed the memory budget. Runs are then merged by blocks to aggregate the sites.
+        Sites are only available through merge_runs, filtered and in coordinate order.
+        * ref_fasta_fn
+            Reference file used for alignment in Fasta format (ideally already indexed with samtools faidx)
+        * max_memory
+            Approximate memory budget in MB for the buffered calls
+        * tmp_dir
+            Directory where to write temporary files (default: system temporary directory)
+        """
+        # Init dict with chromosomes names
+        self._buffer=OrderedDict()
+        with Fasta(ref_fasta_fn) as fa:
+            for ref in fa:
+                self._buffer[ref.name] = []
+
+        # Init other self variables
+        self.max_bytes = max_memory*1024*1024
+        self.counter = Counter()
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="pycoMeth_", dir=tmp_dir if tmp_dir else None)
+        self._runs = []
+        self._buffer_bytes = 0
+
+    #~~~~~~~~~~~~~~MAGIC AND PROPERTY METHODS~~~~~~~~~~~~~~#
+
+    def __repr__(self):
+        return dict_to_str(self.counter)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.close()
+
+    #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
+
+    def close (self):
+        """Remove temporary files"""
+        self._runs = []
+        self._tmp_dir.cleanup()
+
+    def add_chunk (self, df):
+        """Add all the lines from a DataFrame chunk generated by FileParser.iter_chunks"""
+        for chrom, arrays in _chunk_arrays(df, self._buffer.keys(), self.counter):
+            self._buffer_add (chrom, *arrays)
+
+    def merge_runs (self, min_count=0, block_size=None):
+        """
+        k-way merge of the sorted runs. Generate SitesArrays blocks of sites passing the coverage filter in coordinate order.
+        Blocks always contain all the calls of their sites and are identical to the in memory SitesIndex aggregation
+        * min_count
+            Minimal number of reads covering a site
+        * block_size
+            Number of calls to load from each run at once. By default split half of the memory budget between runs
+        """
+        # Keep last buffered calls in memory as a final run
+        runs = self._runs+[self._sorted_run()]
+        if not block_size:
+            block_size = max(self.max_bytes//(2*len(runs)*24), 1000)
+
+        for chr_id, chrom in enumerate(self._buffer.keys()):
+            parts = []
+            for run in runs:
+                i, j = run["offsets"][chr_id], run["offsets"][chr_id+1]
+                k, l = run["meta_offsets"][chr_id], run["meta_offsets"][chr_id+1]
+                if j > i:
+                    parts.append((run["calls"][i:j], run["meta"][k:l]))
+
+            for chrom_sites in self._merge_parts(chrom, parts, block_size):
+                if len(chrom_sites):
+                    self.counter ["Initial Sites"]+=len(chrom_sites)
+                chrom_sites = _filter_sites(chrom_sites, min_count, self.counter)
+                if len(chrom_sites):
+                    yield chrom_sites
+
+        if not self.counter["Valid Sites Found"]:
+            raise pycoMethError ("No valid sites left after coverage filtering")
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+
+    def _buffer_add (self, chrom, start, end, llr, meta_start, meta_end, num_motifs, sequence):
+        """Buffer lines arrays and spill all buffered calls to disk if the memory budget is exceeded"""
+        arrays = (start, end, llr, meta_start, meta_end, num_motifs, sequence)
+        self._buffer[chrom].append(arrays)
+        self._buffer_bytes+=sum(a.nbytes for a in arrays)
+        if self._buffer_bytes >= self.max_bytes:
+            self._spill()
+
+    def _sorted_run (self):
+        """Sort buffered calls by chromosome and coordinates in record arrays, and empty the buffer"""
+        calls_l = []
+        meta_l = []
+        offsets = [0]
+        meta_offsets = [0]
+        # Records of all chromosomes need the same sequence width to be concatenated
+        seq_dtype = "S{}".format(max([a[-1].dtype.itemsize for b in self._buffer.values() for a in b]+[1]))
+        for chrom, buffer in self._buffer.items():
+            if buffer:
+                start, end, llr, meta_start, meta_end, num_motifs, sequence = [np.concatenate(i) for i in zip(*buffer)]
+                # Stable sort to keep the input order of calls for each site
+                order = np.lexsort((end, start))
+                meta_order = np.lexsort((meta_end, meta_start))
+                calls_l.append(np.rec.fromarrays(
+                    (start[order], end[order], llr[order]),
+                    names=("start", "end", "llr")))
+                meta_l.append(np.rec.fromarrays(
+                    (meta_start[meta_order], meta_end[meta_order], num_motifs[meta_order], sequence[meta_order].astype(seq_dtype)),
+                    names=("start", "end", "num_motifs", "sequence")))
+                self._buffer[chrom] = []
+            offsets.append(offsets[-1]+(len(calls_l[-1]) if buffer else 0))
+            meta_offsets.append(meta_offsets[-1]+(len(meta_l[-1]) if buffer else 0))
+        self._buffer_bytes = 0
+
+        run = {"offsets":offsets, "meta_offsets":meta_offsets}
+        if calls_l:
+            run["calls"] = np.concatenate(calls_l)
+            run["meta"] = np.concatenate(meta_l)
+        return run
+
+    def _spill (self):
+        """Write all buffered calls in a new sorted run file and map it back in memory"""
+        run = self._sorted_run()
+        fn = os.path.join(self._tmp_dir.name, "run_{}.bin".format(len(self._runs)))
+        with open (fn, "wb") as fp:
+            fp.write(run["calls"].tobytes())
+            fp.write(run["meta"].tobytes())
+
+        # A single memory map per run to limit the number of open file descriptors
+        with open (fn, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        calls_dtype, meta_dtype = run["calls"].dtype, run["meta"].dtype
+        n_calls, n_meta = len(run["calls"]), len(run["meta"])
+        run["calls"] = np.frombuffer(mm, dtype=calls_dtype, count=n_calls)
+        run["meta"] = np.frombuffer(mm, dtype=meta_dtype, count=n_meta, offset=n_calls*calls_dtype.itemsize)
+        self._runs.append(run)
+        self.counter ["Sorted runs written to disk"]+=1
+
+    def _merge_parts (self, chrom, parts, block_size):
+        """Merge by blocks the sorted calls of a chromosome from several runs"""
+        cur = [0]*len(parts)
+        meta_cur = [0]*len(parts)
+        while True:
+            active = [i for i, (calls, meta) in enumerate(parts) if cur[i] < len(calls)]
+            if not active:
+                break
+
+            # Load blocks ending at the last call of a site start and find the lowest block boundary
+            cutoff = None
+            for i in active:
+                start = parts[i][0]["start"]
+                block_end = cur[i]+block_size
+                if block_end < len(start):
+                    block_end = np.searchsorted(start, start[block_end-1], side="right")
+                    if block_end < len(start) and (cutoff is None or start[block_end-1] < cutoff):
+                        cutoff = start[block_end-1]
+
+            # Collect all calls and meta records starting before the cutoff in runs order
+            calls_l = []
+            meta_l = []
+            for i, (calls, meta) in enumerate(parts):
+                if cutoff is None:
+                    j, k = len(calls), len(meta)
+                else:
+                    j = np.searchsorted(calls["start"], cutoff, side="right")
+                    k = np.searchsorted(meta["start"], cutoff, side="right")
+                calls_l.append(calls[cur[i]:j])
+                meta_l.append(meta[meta_cur[i]:k])
+                cur[i] = j
+                meta_cur[i] = k
+
+            # Concatenate fields separately as sequence widths can differ between runs
+            yield SitesArrays.from_records(
+                chrom, *[np.concatenate([a[field] for a in calls_l]) for field in ("start", "end", "llr")],
+                *[np.concatenate([a[field] for a in meta_l]) for field in ("start", "end", "num_motifs", "sequence")])
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~SitesArrays HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+class SitesArrays():
+    def __init__ (self, chr_name, start, end, num_motifs, sequence, offsets, llr):
+        """
+        Compact storage of the CpG sites of a single chromosome sorted by coordinates.
+        Sites fields are stored in contiguous arrays and the llr values of all the sites are stored in a single float32 buffer.
+        The llr values of site i are llr[offsets[i]:offsets[i+1]]
+        """
+        self.chr_name = chr_name
+        self.start = start
+        self.end = end
+        self.num_motifs = num_motifs
+        self.sequence = sequence
+        self.offsets = offsets
+        self.llr = llr
+
+    #~~~~~~~~~~~~~~CLASS METHODS~~~~~~~~~~~~~~#
+
+    @classmethod
+    def empty (cls, chr_name):
+        """Create an empty SitesArrays"""
+        return cls(
+            chr_name=chr_name, start=np.zeros(0, dtype=np.int64), end=np.zeros(0, dtype=np.int64),
+            num_motifs=np.zeros(0, dtype=np.int64), sequence=np.zeros(0, dtype="S1"),
+            offsets=np.zeros(1, dtype=np.int64), llr=np.zeros(0, dtype=np.float32))
+
+    @classmethod
+    def from_records (cls, chr_name, start, end, llr, meta_start, meta_end, num_motifs, sequence):
+        """
+        Group per read records by site. Sites are sorted by coordinates and the llr values of each site keep the records order.
+        Sequence and number of motifs are taken from the first meta record found for each site.
+        """
+        # Stable sort of records by coordinates
+        order = np.lexsort((end, start))
+        start = start[order]
+        end = end[order]
+        llr = llr[order].astype(np.float32)
+        site_idx = np.flatnonzero(_first_of_group(start, end))
+
+        # Find the first meta record for each site
+        meta_order = np.lexsort((meta_end, meta_start))
+        meta_idx = meta_order[_first_of_group(meta_start[meta_order], meta_end[meta_order])]
+
+        return cls(
+            chr_name=chr_name, start=start[site_idx], end=end[site_idx], num_motifs=num_motifs[meta_idx],
+            sequence=sequence[meta_idx], offsets=np.append(site_idx, len(llr)), llr=llr)
+
+    #~~~~~~~~~~~~~~MAGIC AND PROPERTY METHODS~~~~~~~~~~~~~~#
+
+    def __len__ (self):
+        return len(self.start)
+
+    def __iter__ (self):
+        ct = namedtuple("ct", ["chr_name", "start", "end"])
+        it = zip(self.start.tolist(), self.end.tolist(), self.num_motifs.tolist(), self.sequence.tolist(), self.offsets[:-1].tolist(), self.offsets[1:].tolist())
+        for start, end, num_motifs, sequence, i, j in it:
+            val_dict = {"sequence":sequence.decode(), "num_motifs":num_motifs, "llr":self.llr[i:j], "n_reads":j-i}
+            yield (ct(self.chr_name, start, end), val_dict)
+
+    @property
+    def n_reads (self):
+        return np.diff(self.offsets)
+
+    #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
+
+    def select (self, mask):
+        """Return a new SitesArrays containing only the sites selected by a boolean mask"""
+        n_reads = self.n_reads[mask]
+        offsets = np.zeros(len(n_reads)+1, dtype=np.int64)
+        np.cumsum(n_reads, out=offsets[1:])
+        return SitesArrays(
+            chr_name=self.chr_name, start=self.start[mask], end=self.end[mask], num_motifs=self.num_motifs[mask],
+            sequence=self.sequence[mask], offsets=offsets, llr=self.llr[np.repeat(mask, self.n_reads)])
+
+    def to_records (self):
+        """Expand sites back to per read records in the format expected by from_records"""
+        n_reads = self.n_reads
+        return (np.repeat(self.start, n_reads), np.repeat(self.end, n_reads), self.llr, self.start, self.end, self.num_motifs, self.sequence)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~Helper functions~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def _filter_sites (chrom_sites, min_count, counter):
+    """Select sites with enough reads and update counter"""
+    valid = chrom_sites.n_reads >= min_count
+    if not valid.all():
+        counter ["Low Count Sites"]+=int((~valid).sum())
+    if valid.any():
+        counter ["Valid Sites Found"]+=int(valid.sum())
+    return chrom_sites.select(valid)
+
+def _chunk_arrays (df, chrom_names, counter):
+    """
+    Generate the lines arrays of each valid chromosome from a DataFrame chunk generated by FileParser.iter_chunks and update counter.
+    Arrays are ordered as expected by SitesArrays.from_records
+    """
+    valid = df["chromosome"].isin(list(chrom_names)).values
+    if not valid.all():
+        counter ["Invalid chromosome lines"]+=int((~valid).sum())
+        df = df[valid]
+    if df.empty:
+        return
+
+    counter ["Total Valid Lines"]+=len(df)
+    for chrom, chrom_df in df.groupby("chromosome", sort=False):
+        start = chrom_df["start"].values
+        end = chrom_df["end"].values+1
+        # Only keep sequence and number of motifs for the first line of each site
+        first = ~chrom_df.duplicated(["start", "end"]).values
+        yield (chrom, (
+            start, end, chrom_df["log_lik_ratio"].values.astype(np.float32),
+            start[first], end[first], chrom_df["num_motifs"].values[first], chrom_df["sequence"].values[first].astype("S")))
+
+def _first_of_group (start, end):
+    """Boolean mask of the first element of each group of identical coordinates in sorted arrays"""
+    first = np.ones(len(start), dtype=bool)
+    first[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1])
+    return first
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~CpG_Writer HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
 class CpG_Writer():
-    """Extract data for valid sites and write to BED and/or TSV file"""
+    """Extract data for valid sites and write to BED, TSV and/or Parquet file"""
 
-    def __init__ (self, bed_fn="", tsv_fn="", sample_id="", min_llr=2, verbose=True):
+    def __init__ (self, bed_fn="", tsv_fn="", parquet_fn="", sample_id="", min_llr=2, header=True, verbose=True):
         """"""
         self.log = get_logger (name="pycoMeth_CpG_Writer", verbose=verbose,)
         self.min_llr = min_llr
         self.sample_id = sample_id
+        self.header = header
         self.counter = Counter()
         self.bed_fn = bed_fn
         self.tsv_fn = tsv_fn
+        self.parquet_fn = parquet_fn
         self.bed_fp = self._init_bed () if bed_fn else None
         self.tsv_fp = self._init_tsv () if tsv_fn else None
+        self.parquet_fp = self._init_parquet () if parquet_fn else None
 
         # Color score tables
         self.pos_colors = OrderedDict()
@@ -212,7 +776,7 @@ class CpG_Writer():
         return self
 
     def __exit__(self, exception_type, exception_val, trace):
-        for fp in (self.bed_fp, self.tsv_fp):
+        for fp in (self.bed_fp, self.tsv_fp, self.parquet_fp):
             try:
                 fp.close()
             except:
@@ -220,23 +784,67 @@ class CpG_Writer():
 
     #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
     def write (self, coord, val_dict):
-        """"""
-        self.counter["Total Sites Writen"]+=1
+        """Write a single site"""
+        llr = np.asarray(val_dict["llr"], dtype=np.float32)
+        self.write_sites (SitesArrays(
+            chr_name=coord.chr_name, start=np.array([coord.start]), end=np.array([coord.end]), num_motifs=np.array([val_dict["num_motifs"]]),
+            sequence=np.array([val_dict["sequence"]], dtype="S"), offsets=np.array([0, len(llr)]), llr=llr))
+
+    def write_sites (self, sites):
+        """
+        Write all the sites of a SitesArrays at once. Medians are computed with a single segmented operation over the flat
+        llr buffer and sites are classified in bulk
+        """
+        n_sites = len(sites)
+        if not n_sites:
+            return
+        self.counter["Total Sites Writen"]+=n_sites
 
         # Compute median llr and update counters
-        med_llr = round(np.median(val_dict["llr"]), 3)
-        if med_llr >= self.min_llr:
-            self.counter["Methylated sites"]+=1
-        elif med_llr <= -self.min_llr:
-            self.counter["Unmethylated sites"]+=1
-        else:
-            self.counter["Ambiguous sites"]+=1
+        med_llr = np.round(segment_median(sites.llr, sites.offsets), 3)
+        n_meth = int(np.count_nonzero(med_llr >= self.min_llr))
+        n_unmeth = int(np.count_nonzero(med_llr <= -self.min_llr))
+        for state, n in (("Methylated sites", n_meth), ("Unmethylated sites", n_unmeth), ("Ambiguous sites", n_sites-n_meth-n_unmeth)):
+            if n:
+                self.counter[state]+=n
 
         # Write tsv and/or bed files
+        chr_name = sites.chr_name
+        start_list = sites.start.tolist()
+        end_list = sites.end.tolist()
+        med_list = med_llr.tolist()
         if self.bed_fn:
-            self._write_bed (coord, med_llr)
+            for start, end, med, color in zip(start_list, end_list, med_list, self._bed_colors(med_llr).tolist()):
+                res_line = [chr_name, start, end, ".", med, ".", start, end, color]
+                self.bed_fp.write(str_join(res_line, sep="\t", line_end="\n"))
+        if self.tsv_fn or self.parquet_fn:
+            llr_str = sites.llr.astype(str)
         if self.tsv_fn:
-            self._write_tsv (coord, val_dict, med_llr)
+            llr_str_list = llr_str.tolist()
+            offsets = sites.offsets.tolist()
+            it = zip(start_list, end_list, sites.sequence.tolist(), sites.num_motifs.tolist(), med_list, offsets[:-1], offsets[1:])
+            for start, end, sequence, num_motifs, med, i, j in it:
+                res_line = [chr_name, start, end, sequence.decode(), num_motifs, med, "[{}]".format(",".join(llr_str_list[i:j]))]
+                self.tsv_fp.write(str_join(res_line, sep="\t", line_end="\n"))
+        if self.parquet_fn:
+            # Store llr values as the float64 parsed from their text representation to get the same values as with TSV files
+            pa, pq = import_pyarrow()
+            self.parquet_fp.write ([
+                pa.array(np.repeat(chr_name, n_sites)), sites.start, sites.end, pa.array(np.char.decode(sites.sequence)),
+                sites.num_motifs, med_llr, pa.LargeListArray.from_arrays(sites.offsets, llr_str.astype(np.float64))])
+
+    def append (self, bed_fn="", tsv_fn="", parquet_fn="", counter=None):
+        """Append the content of files written by a CpG_Writer without header and merge its counter"""
+        for fn, fp in ((bed_fn, self.bed_fp), (tsv_fn, self.tsv_fp)):
+            if fn and fp:
+                with open (fn) as fp_in:
+                    shutil.copyfileobj(fp_in, fp)
+        if parquet_fn and self.parquet_fp:
+            pa, pq = import_pyarrow()
+            for batch in pq.ParquetFile(parquet_fn).iter_batches():
+                self.parquet_fp.write(batch.columns)
+        if counter:
+            self.counter.update(counter)
 
     #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
 
@@ -245,23 +853,17 @@ class CpG_Writer():
         self.log.debug("Initialise output bed file")
         mkbasedir (self.bed_fn, exist_ok=True)
         fp = gzip.open(self.bed_fn, "wt") if self.bed_fn.endswith(".gz") else open(self.bed_fn, "w")
-        fp.write("track name={}_CpG itemRgb=On\n".format(self.sample_id))
+        if self.header:
+            fp.write("track name={}_CpG itemRgb=On\n".format(self.sample_id))
         return fp
 
-    def _write_bed (self, coord, med_llr):
-        """Write line to BED file"""
-        # define track color dependign on med llr
-        if med_llr>=0:
-            for min_llr, color in self.pos_colors.items():
-                if med_llr >= min_llr:
-                    break
-        else:
-            for min_llr, color in self.neg_colors.items():
-                if med_llr <= min_llr:
-                    break
-        # Write line
-        res_line = [coord.chr_name, coord.start, coord.end, ".", round(med_llr, 3), ".", coord.start, coord.end, color]
-        self.bed_fp.write(str_join(res_line, sep="\t", line_end="\n"))
+    def _bed_colors (self, med_llr):
+        """Vectorized selection of the track colors from an array of median llr"""
+        pos = med_llr >= 0
+        condlist = [pos & (med_llr >= min_llr) for min_llr in self.pos_colors.keys()]
+        condlist+= [~pos & (med_llr <= min_llr) for min_llr in self.neg_colors.keys()]
+        choicelist = list(self.pos_colors.values())+list(self.neg_colors.values())
+        return np.select(condlist, choicelist, default=self.neg_colors[0])
 
     def _init_tsv (self):
         """Open TSV file and write file header"""
@@ -269,11 +871,16 @@ class CpG_Writer():
         mkbasedir (self.tsv_fn, exist_ok=True)
         fp = gzip.open(self.tsv_fn, "wt") if self.tsv_fn.endswith(".gz") else open(self.tsv_fn, "w")
         # Write header line
-        header = ["chromosome","start","end","sequence","num_motifs","median_llr","llr_list"]
-        fp.write(str_join(header, sep="\t", line_end="\n"))
+        if self.header:
+            header = ["chromosome","start","end","sequence","num_motifs","median_llr","llr_list"]
+            fp.write(str_join(header, sep="\t", line_end="\n"))
         return fp
 
-    def _write_tsv (self, coord, val_dict, med_llr):
-        """Write line to TSV file"""
-        res_line = [coord.chr_name, coord.start, coord.end, val_dict["sequence"], val_dict["num_motifs"], round(med_llr, 3), list_to_str(val_dict["llr"])]
-        self.tsv_fp.write(str_join(res_line, sep="\t", line_end="\n"))
+    def _init_parquet (self):
+        """Open Parquet file with native list column for llr values"""
+        self.log.debug("Initialise output parquet file")
+        pa, pq = import_pyarrow()
+        schema = pa.schema([
+            ("chromosome", pa.string()), ("start", pa.int64()), ("end", pa.int64()), ("sequence", pa.string()),
+            ("num_motifs", pa.int64()), ("median_llr", pa.float64()), ("llr_list", pa.large_list(pa.float64()))])
+        return ParquetWriter(self.parquet_fn, schema)
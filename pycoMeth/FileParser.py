@@ -6,6 +6,13 @@ import os
 from collections import *
 import gzip
 from glob import iglob
+import itertools
+import io
+import csv
+
+# Third party imports
+import numpy as np
+# pandas is slow to import and only imported when needed
 
 # Local imports
 from pycoMeth.common import *
@@ -25,13 +32,14 @@ class FileParser ():
         dtypes={},
         force_dtypes=False,
         force_col_len=True,
+        chunk_size=0,
         verbose=False,
         quiet=False,
         **kwargs):
         """
         Open a parser ++ for field delimited file
         * fn
-            Path to a field delimited file
+            Path to a field delimited file. Parquet files are also transparently parsed (requires pyarrow)
         * label
             Label for the file of file group
         * colnames
@@ -48,6 +56,10 @@ class FileParser ():
             Dict corresponding to fields (based on colnames) to cast in a given python type
         * force_dtypes
             Raise an error if type casting fails
+        * chunk_size
+            If > 0 parse the files by blocks of chunk_size lines with a vectorized engine instead of line by line.
+            Lines are then generated from the parsed blocks when iterating or calling next. Parquet files are always
+            parsed by blocks
         * kwargs
             Allow to pass extra options such as verbose, quiet and progress
         """
@@ -65,9 +77,12 @@ class FileParser ():
         self.auto_numeric = auto_numeric
         self.force_dtypes = force_dtypes
         self.force_col_len = force_col_len
+        self.chunk_size = chunk_size
 
         # Input file opening
         self.f_list = self._open_files (fn)
+        if not self.chunk_size and any(self._is_parquet(fp) for fn, fp in self.f_list):
+            self.chunk_size = 100000
 
         # Init extra private variables
         self._previous_index = -1
@@ -75,6 +90,7 @@ class FileParser ():
         self._header_len = 0
         self._current = None
         self._previous = None
+        self._chunk_lines = None
 
         # Define colname based on provided list of names
         if colnames and isinstance( colnames, (list, tuple)):
@@ -138,6 +154,14 @@ class FileParser ():
         self.close()
 
     def __iter__ (self):
+        # Generate lines from vectorized blocks
+        if self.chunk_size:
+            for line in self._iter_chunk_lines():
+                self._previous = self._current
+                self._current = line
+                yield line
+            return
+
         for i, (fn, fp) in enumerate(self.f_list):
             self.log.debug("Starting to parse file {}".format(fn))
             self._current_index = i
@@ -168,6 +192,15 @@ class FileParser ():
         return self._previous
 
     def next (self):
+        # Get next line from vectorized blocks
+        if self.chunk_size:
+            if not self._chunk_lines:
+                self._chunk_lines = self._iter_chunk_lines()
+            line = next(self._chunk_lines)
+            self._previous = self._current
+            self._current = line
+            return line
+
         # try to read a line
         while True:
             try:
@@ -198,9 +231,38 @@ class FileParser ():
             except FileParserError:
                 self.counter["Malformed or Invalid Lines"]+=1
 
+    def iter_chunks (self, chunk_size=None):
+        """
+        Parse the files by blocks of lines and yield pandas DataFrame chunks with one column per field.
+        Field splitting and type casting are vectorized. As columns are typed, lines containing values that cannot
+        be cast in the required type are considered as invalid and skipped.
+        * chunk_size
+            Maximal number of lines read per chunk. By default use the value given at init or 100000
+        """
+        chunk_size = chunk_size or self.chunk_size or 100000
+        for i, (fn, fp) in enumerate(self.f_list):
+            self.log.debug("Starting to parse file {}".format(fn))
+            self._current_index = i
+            if self._is_parquet(fp):
+                for df in self._iter_parquet_chunks(fn, fp, chunk_size):
+                    yield df
+                self.log.debug("End of file: {}".format(fn))
+                continue
+            while True:
+                lines = list(itertools.islice(fp, chunk_size))
+                if not lines:
+                    break
+                df = self._parse_chunk(lines)
+                if not df.empty:
+                    yield df
+            self.log.debug("End of file: {}".format(fn))
+        self.log.debug("All files done")
+
     #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
 
     def _get_first_line_header (self, fp):
+        if self._is_parquet(fp):
+            return list(fp.schema_arrow.names)
         header_line = next(fp)
         self._header_len+=len(header_line)
         return header_line.rstrip().split(self.sep)
@@ -267,7 +329,15 @@ class FileParser ():
             for fn_regex in fn_list:
                 for fn in iglob(fn_regex):
                     self.counter["Input files"]+=1
-                    if fn.endswith(".gz"):
+                    with open(fn, "rb") as fp:
+                        magic = fp.read(4)
+                    if magic == b"PAR1":
+                        if not PARQUET:
+                            raise pycoMethError ("Cannot read Parquet file {} due to missing dependencies (pyarrow)".format(fn))
+                        self.log.debug("Opening file {} in parquet mode".format(fn))
+                        pa, pq = import_pyarrow()
+                        fp = pq.ParquetFile(fn)
+                    elif fn.endswith(".gz"):
                         self.log.debug("Opening file {} in gzip mode".format(fn))
                         fp = gzip.open(fn, "rt")
                     else:
@@ -280,6 +350,146 @@ class FileParser ():
         else:
             raise ValueError ("Invalid file type")
 
+    def _is_parquet (self, fp):
+        """Check if a file pointer corresponds to a Parquet file. Parquet files can only be opened once pyarrow was imported"""
+        return "pyarrow" in sys.modules and isinstance(fp, import_pyarrow()[1].ParquetFile)
+
+    def _iter_parquet_chunks (self, fn, fp, chunk_size):
+        """Generate DataFrame chunks from the record batches of a Parquet file. List columns are converted to python lists"""
+        import pandas as pd
+        pa, pq = import_pyarrow()
+        names = self.colnames[:self.ncols]
+        n_rows = fp.metadata.num_rows
+        size = os.path.getsize(fn)
+        row = 0
+        for batch in fp.iter_batches(batch_size=chunk_size, columns=names):
+            n = batch.num_rows
+            if not n:
+                continue
+            self.counter["Lines Parsed"]+=n
+
+            df = pd.DataFrame(OrderedDict(
+                (name, col.to_pylist() if pa.types.is_list(col.type) or pa.types.is_large_list(col.type) else col.to_numpy(zero_copy_only=False))
+                for name, col in zip(names, batch.columns)))
+            for i, dtype in self.dtypes_index.items():
+                if dtype in (int, float):
+                    df[names[i]] = df[names[i]].astype(dtype)
+
+            # Spread the file size over rows to track progress
+            if self.include_byte_len:
+                df["byte_len"] = np.diff(np.arange(row, row+n+1)*size//n_rows)
+            row+=n
+
+            self.counter["Line successfully parsed"]+=n
+            yield df
+
+    def _iter_chunk_lines (self):
+        """Generate namedtuple lines from parsed blocks"""
+        for df in self.iter_chunks():
+            for line in map(self.lt._make, zip(*[df[col].tolist() for col in self.colnames])):
+                yield line
+
+    def _parse_chunk (self, lines):
+        """Parse a block of raw lines into a typed DataFrame"""
+        self.counter["Lines Parsed"]+=len(lines)
+
+        # Find lines and fields boundaries in the raw block buffer
+        buf = np.frombuffer("".join(lines).encode(), dtype=np.uint8)
+        ends = np.flatnonzero(buf == ord("\n"))
+        if not len(ends) or ends[-1] != len(buf)-1:
+            ends = np.append(ends, len(buf))
+        starts = np.insert(ends[:-1]+1, 0, 0)
+        sep_pos = np.flatnonzero(buf == ord(self.sep))
+        n_fields = np.searchsorted(sep_pos, ends)-np.searchsorted(sep_pos, starts)+1
+
+        # Skip comment lines
+        valid = np.ones(len(starts), dtype=bool)
+        if self.comment:
+            comment = self.comment.encode()
+            is_comment = ends-starts >= len(comment)
+            for i, c in enumerate(comment):
+                is_comment &= buf[np.minimum(starts+i, len(buf)-1)] == c
+            if is_comment.any():
+                self.counter["Comment lines skipped"]+=int(is_comment.sum())
+                valid &= ~is_comment
+
+        # Check number of fields
+        if self.force_col_len:
+            invalid = valid & (n_fields != self.ncols)
+        else:
+            invalid = valid & (n_fields < self.ncols)
+        if invalid.any():
+            self.counter["Malformed or Invalid Lines"]+=int(invalid.sum())
+            valid &= ~invalid
+
+        # Select valid lines and truncate extra fields if allowed
+        byte_len = (np.minimum(ends+1, len(buf))-starts)[valid]
+        if not self.force_col_len and (n_fields[valid] > self.ncols).any():
+            text = "\n".join([self.sep.join(l.rstrip("\r\n").split(self.sep)[:self.ncols]) for l in itertools.compress(lines, valid)])
+            block = text.encode()
+        elif not valid.all():
+            block = buf[np.repeat(valid, np.minimum(ends+1, len(buf))-starts)].tobytes()
+        else:
+            block = buf.tobytes()
+
+        # Vectorized fields splitting and casting
+        names = self.colnames[:self.ncols]
+        if valid.any():
+            df, valid = self._read_block(block, names)
+            if valid is not None:
+                self.counter["Malformed or Invalid Lines"]+=int((~valid).sum())
+                byte_len = byte_len[valid]
+        else:
+            import pandas as pd
+            df = pd.DataFrame(columns=names)
+
+        # Add byte length if needed
+        if self.include_byte_len:
+            df["byte_len"] = byte_len
+
+        self.counter["Line successfully parsed"]+=len(df)
+        return df
+
+    def _read_block (self, block, names):
+        """Read a block of lines with pandas C parser and return a DataFrame and a mask of valid lines if some were discarded"""
+        import pandas as pd
+        read_kwargs = {
+            "sep":self.sep, "header":None, "names":names, "na_filter":False, "skip_blank_lines":False,
+            "quoting":csv.QUOTE_NONE, "engine":"c", "float_precision":"round_trip"}
+
+        # Autocast in int or float
+        if self.auto_numeric:
+            return (pd.read_csv(io.BytesIO(block), **read_kwargs), None)
+
+        # Cast values according to provided types
+        num_dtypes = OrderedDict()
+        for i, dtype in self.dtypes_index.items():
+            if dtype in (int, float):
+                num_dtypes[names[i]] = dtype
+        dtypes = {name:num_dtypes.get(name, str) for name in names}
+        try:
+            df = pd.read_csv(io.BytesIO(block), dtype=dtypes, **read_kwargs)
+            valid = None
+
+        # Fall back to coercion column by column to find lines that cannot be cast
+        except (ValueError, OverflowError):
+            df = pd.read_csv(io.BytesIO(block), dtype=str, **read_kwargs)
+            valid = np.ones(len(df), dtype=bool)
+            for name, dtype in num_dtypes.items():
+                col = pd.to_numeric(df[name], errors="coerce")
+                valid &= col.notna().values
+                # Float strings are cast later with a correctly rounded parser, as to_numeric is not
+                if dtype is int:
+                    df[name] = col
+            df = df[valid].astype(num_dtypes).reset_index(drop=True)
+
+        # Cast other types with python callables
+        for i, dtype in self.dtypes_index.items():
+            if not dtype in (int, float, str):
+                df[names[i]] = df[names[i]].map(dtype)
+
+        return (df, valid)
+
 class FileParserError (Exception):
     """ Basic exception class for FileParserError """
     pass
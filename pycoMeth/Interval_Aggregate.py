@@ -4,6 +4,7 @@
 # Standard library imports
 from collections import OrderedDict, namedtuple, Counter
 import gzip
+import os
 
 # Third party imports
 from tqdm import tqdm
@@ -21,28 +22,42 @@ def Interval_Aggregate(
     interval_bed_fn:str=None,
     output_bed_fn:str=None,
     output_tsv_fn:str=None,
-    interval_size:int=1000,
+    output_parquet_fn:str=None,
+    interval_size:[int]=[1000],
+    window_step:int=0,
     min_cpg_per_interval:int=5,
     sample_id:str="",
     min_llr:float=2,
     verbose:bool=False,
     quiet:bool=False,
     progress:bool=False,
+    profile:bool=False,
+    profile_dir:str="",
+    metrics_json:str="",
     **kwargs):
     """
     Bin the output of `pycoMeth CpG_Aggregate` in genomic intervals, using either an annotation file containing intervals or a sliding window.
     * cpg_aggregate_fn
-        Output tsv file generated by CpG_Aggregate (can be gzipped)
+        Output tsv or parquet file generated by CpG_Aggregate (can be gzipped)
     * ref_fasta_fn
         Reference file used for alignment in Fasta format (ideally already indexed with samtools faidx)
     * interval_bed_fn
-        SORTED bed file containing **non-overlapping** intervals to bin CpG data into (Optional) (can be gzipped)
+        bed file containing intervals to bin CpG data into (Optional) (can be gzipped). Intervals do not need to be sorted and can overlap,
+        in which case CpG sites are counted in all the intervals containing them
     * output_bed_fn
         Path to write a summary result file in BED format (At least 1 output file is required) (can be gzipped)
     * output_tsv_fn
         Path to write a more extensive result report in TSV format (At least 1 output file is required) (can be gzipped)
+    * output_parquet_fn
+        Path to write the same data as the TSV report in binary Parquet format with native list columns for llr values and positions.
+        Faster to parse by Meth_Comp (At least 1 output file is required) (requires pyarrow)
     * interval_size
-        Size of the sliding window in which to aggregate CpG sites data from if no BED file is provided
+        Size of the sliding window in which to aggregate CpG sites data from if no BED file is provided.
+        Several sizes can be given to aggregate the data at multiple resolutions in a single pass. In this case one output file of
+        each type is written per size, with the size added as a suffix to the file names (e.g. output_1000bp.tsv)
+    * window_step
+        Distance between the starts of consecutive sliding windows. By default windows are contiguous (step = interval_size).
+        With a smaller step windows overlap and CpG sites are counted in all the windows containing them
     * min_cpg_per_interval
         Minimal number of CpG sites per interval.
     * sample_id
@@ -53,118 +68,561 @@ def Interval_Aggregate(
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
     log = get_logger (name="pycoMeth_CpG_Comp", verbose=verbose, quiet=quiet)
+    prof = Profiler(enabled=profile, profile_dir=profile_dir, metrics_json=metrics_json, prefix="Interval_Aggregate", options=opt_summary_dict)
 
     log.warning("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
 
     # Init collections
-    counter = Counter()
+    prof.add_files(input_fn=[cpg_aggregate_fn, ref_fasta_fn, interval_bed_fn])
     coordgen = CoordGen(ref_fasta_fn, verbose, quiet)
     log_list(coordgen, log.debug, "Coordinate reference summary")
 
     # At least one output file is required, otherwise it doesn't make any sense
     log.debug ("Checking required output")
-    if not output_bed_fn and not output_tsv_fn:
-        raise pycoMethError ("At least 1 output file is requires (-t or -b)")
+    if not output_bed_fn and not output_tsv_fn and not output_parquet_fn:
+        raise pycoMethError ("At least 1 output file is requires (-t, -b or --output_parquet_fn)")
 
-    # Define type of window generator
-    log.debug ("Defining interval generator")
+    # Check interval sizes. Sizes are ignored if a BED file is provided
+    if not isinstance(interval_size, (list, tuple)):
+        interval_size = [interval_size]
+    interval_size = list(OrderedDict.fromkeys(interval_size))
     if interval_bed_fn:
-        log.debug ("Bed annotation generator")
-        intervals_gen = bed_intervals_gen(coordgen=coordgen, interval_bed_fn=interval_bed_fn)
-    else:
-        log.debug ("Sliding window generator")
-        intervals_gen = sliding_intervals_gen(coordgen=coordgen, interval_size=interval_size)
+        interval_size = [None]
+    elif not interval_size or not all(isinstance(size, int) and size > 0 for size in interval_size):
+        raise pycoMethError ("Interval sizes have to be positive integers")
+    if not isinstance(window_step, int) or window_step < 0:
+        raise pycoMethError ("Window step has to be a positive integer")
+
+    # Define output files for each resolution
+    output_fn_dict = OrderedDict()
+    for size in interval_size:
+        output_fn_dict[size] = [resolution_fn(fn, size) if len(interval_size) > 1 else fn for fn in (output_bed_fn, output_tsv_fn, output_parquet_fn)]
+        prof.add_files(output_fn=output_fn_dict[size])
+    log_dict(output_fn_dict, log.debug, "Output files")
 
     # Open file parser, sit writter and progress bar
     log.warning("Parsing CpG_aggregate file")
+    fp_in = None
+    counter_dict = OrderedDict()
+    writer_dict = OrderedDict()
+    binner_dict = OrderedDict()
     try:
         fp_in = FileParser(
             fn=cpg_aggregate_fn,
             dtypes={"start":int,"end":int,"median_llr":float,"num_motifs":int},
             verbose=verbose,
             quiet=quiet,
-            include_byte_len=True)
+            include_byte_len=True,
+            chunk_size=100000)
 
         if not fp_in.input_type == "CpG_Aggregate":
             raise pycoMethError("Invalid input file type passed (cpg_aggregate_fn). Expecting pycoMeth CpG_Aggregate output TSV file")
+        prof.add_counter("Parsing summary", fp_in.counter)
+
+        for size, (bed_fn, tsv_fn, parquet_fn) in output_fn_dict.items():
+            label = " {}bp".format(size) if len(interval_size) > 1 else ""
+            counter_dict[label] = Counter()
+            prof.add_counter("Results summary"+label, counter_dict[label])
+
+            writer_dict[label] = Interval_Writer (
+                bed_fn=bed_fn,
+                tsv_fn=tsv_fn,
+                parquet_fn=parquet_fn,
+                sample_id=sample_id,
+                min_llr=min_llr,
+                min_cpg_per_interval=min_cpg_per_interval,
+                verbose=verbose)
+            prof.add_counter("Writter summary"+label, writer_dict[label].counter)
+
+            # Overlapping BED intervals require an interval index crediting sites to all the intervals containing them
+            if interval_bed_fn:
+                log.debug ("Bed annotation intervals")
+                with prof.stage("Loading intervals", unit="intervals"):
+                    win_chr_id, win_start, win_end = bed_intervals(coordgen=coordgen, interval_bed_fn=interval_bed_fn)
+                prof.add_items("Loading intervals", len(win_start))
+                binner_dict[label] = Interval_Index_Binner (
+                    coordgen=coordgen,
+                    writer=writer_dict[label],
+                    win_chr_id=win_chr_id,
+                    win_start=win_start,
+                    win_end=win_end,
+                    counter=counter_dict[label],
+                    profiler=prof)
+
+            # Overlapping sliding windows require to credit sites to several windows
+            elif window_step and window_step != size:
+                log.debug ("Overlapping sliding window intervals"+label)
+                binner_dict[label] = Rolling_Window_Binner (
+                    coordgen=coordgen,
+                    writer=writer_dict[label],
+                    interval_size=size,
+                    window_step=window_step,
+                    counter=counter_dict[label],
+                    profiler=prof)
+
+            # Sliding windows are only generated where there are CpG sites
+            else:
+                log.debug ("Sliding window intervals"+label)
+                binner_dict[label] = Interval_Binner (
+                    coordgen=coordgen,
+                    writer=writer_dict[label],
+                    interval_size=size,
+                    counter=counter_dict[label],
+                    profiler=prof)
+
+        # Feed each chunk of sites to all resolutions
+        with tqdm (total=len(fp_in), unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+            for df in prof.iter("Parsing sites", fp_in.iter_chunks(), unit="sites"):
+                with prof.stage("Binning sites", unit="sites"):
+                    n = max([binner.add(df) for binner in binner_dict.values()])
+                prof.add_items("Binning sites", n)
+                pbar.update(int(df["byte_len"].values[:n].sum()))
+
+                # Stop when all intervals were written
+                if all(binner.done for binner in binner_dict.values()):
+                    break
 
-        fp_out = Interval_Writer (
-            bed_fn=output_bed_fn,
-            tsv_fn=output_tsv_fn,
-            sample_id=sample_id,
-            min_llr=min_llr,
-            min_cpg_per_interval=min_cpg_per_interval,
-            verbose=verbose)
-        try:
-            with tqdm (total=len(fp_in), unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
-                # Get first line
-                line = fp_in.next()
-                line_coord = coordgen(line.chromosome, line.start, line.end)
-                counter["Lines parsed"]+=1
-                pbar.update(line.byte_len)
-
-                # Get intervals from either the bed generator or the sliding window generator
-
-                for win_coord in intervals_gen:
-                    counter["Total number of intervals"]+=1
-                    llr_list = []
-                    pos_list = []
-                    num_motifs = 0
-
-                    while True:
-                        # Check if window and center of CpG overlap
-                        center = win_coord.center_comp(line_coord)
-
-                        # Center of CpG is greater than current windows = write off current vals and go to next window
-                        if center=="greater":
-                            fp_out.write (coord=win_coord, num_motifs=num_motifs, llr_list=llr_list, pos_list=pos_list)
-                            break
-
-                        # Center of CpG falls inside current windows =  save llr value
-                        if center=="inside":
-                            llr_list.append(line.median_llr)
-                            pos_list.append(int(line_coord.center))
-                            num_motifs+=line.num_motifs
-
-                        # Center of CpG lower or inside the current windows = keep reading lines
-                        line = fp_in.next()
-                        line_coord = coordgen(line.chromosome, line.start, line.end)
-                        counter["Lines parsed"]+=1
-                        pbar.update(line.byte_len)
-
-        # Stop when reaching end of input file
-        except StopIteration:
-            # Write last interval
-            fp_out.write (coord=win_coord, num_motifs=num_motifs, llr_list=llr_list, pos_list=pos_list)
+        # Write last intervals
+        with prof.stage("Writing intervals"):
+            for binner, fp_out in zip(binner_dict.values(), writer_dict.values()):
+                binner.close()
+                fp_out.flush()
 
     finally:
         # Print counters
-        log_dict(counter, log.info, "Results summary")
-        log_dict(fp_out.counter, log.info, "Writter summary")
+        for label in counter_dict.keys():
+            log_dict(counter_dict[label], log.info, "Results summary"+label)
+            log_dict(writer_dict[label].counter, log.info, "Writter summary"+label)
 
         # Close input and output files
-        for fp in (fp_in, fp_out):
+        for fp in [fp_in]+list(writer_dict.values()):
             try:
                 fp.close()
             except:
                 pass
+        prof.report(log.info)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~Interval_Binner HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class Interval_Binner():
+    """
+    Assign CpG sites to sliding windows by chunks of sites. Sites and windows are encoded as sortable integer keys combining the
+    chromosome id and twice the position. As windows are regularly spaced, the window of each site is directly computed from its
+    key for an entire chunk at once, and windows are only generated where there are sites. Per window counts, number of motifs
+    and llr lists are then obtained with segmented reductions. Empty windows are only counted.
+    Assignment follows the same rules as a joint walk through the sites and windows: a site is assigned to the first window
+    ending after its center if the center is also after the window start, otherwise it is skipped.
+    """
+
+    def __init__ (self, coordgen, writer, interval_size=1000, window_step=0, counter=None, profiler=None):
+        """"""
+        self.coordgen = coordgen
+        self.writer = writer
+        self.counter = counter if counter is not None else Counter()
+        self.prof = profiler if profiler else Profiler()
+
+        # Chromosome offsets leaving a gap between chromosomes so keys from different chromosomes never overlap
+        self.chr_len = np.array(list(coordgen.chr_name_len.values()), dtype=np.int64)
+        self.chr_offset = np.zeros(len(self.chr_len), dtype=np.int64)
+        np.cumsum(2*self.chr_len[:-1]+2, out=self.chr_offset[1:])
+        self.chr_name = np.array(list(coordgen.chr_name_len.keys()), dtype=object)
+
+        # Index of the first window of each chromosome. The last windows of a chromosome can be shorter
+        self.interval_size = interval_size
+        self.window_step = window_step or interval_size
+        if interval_size:
+            self.win_offset = np.zeros(len(self.chr_len)+1, dtype=np.int64)
+            np.cumsum(-(-self.chr_len//self.window_step), out=self.win_offset[1:])
+            self.n_win = int(self.win_offset[-1])
+
+        # Index of the current interval and of the first interval not written yet
+        self.current = 0
+        self.written = 0
+        self.done = False
+        self._init_buffer()
+
+    #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
+    def add (self, df):
+        """
+        Assign a chunk of CpG sites to windows and write all the windows completed. Return the number of sites consumed,
+        which is less than the chunk length if all the windows were completed before the end of the chunk.
+        * df
+            DataFrame chunk of CpG_Aggregate sites
+        """
+        if self.done:
+            return 0
+
+        chr_id, key, llr, pos, num_motifs = self._sites(df)
+
+        # Find the first window ending after each site center, windows being never revisited
+        size2 = 2*self.interval_size
+        idx = self.win_offset[chr_id]+np.maximum((key-self.chr_offset[chr_id]+size2-1)//size2-1, 0)
+        idx[0] = max(idx[0], self.current)
+        np.maximum.accumulate(idx, out=idx)
+
+        # Stop after the first site after the last window
+        n = len(idx)
+        if idx[-1] >= self.n_win:
+            n = int(np.searchsorted(idx, self.n_win, side="left"))+1
+            self.done = True
+        idx = idx[:n]
+        key = key[:n]
+        self.counter["Lines parsed"]+=n
+
+        # Keep sites with a center inside their window
+        inside = idx < self.n_win
+        win_chr_id, win_start, win_end = self._win_coords(idx[inside])
+        inside[inside] = self.chr_offset[win_chr_id]+2*win_start <= key[inside]
+        self._idx.append(idx[inside])
+        self._llr.append(llr[:n][inside])
+        self._pos.append(pos[:n][inside])
+        self._num_motifs.append(num_motifs[:n][inside])
+
+        # Windows before the current one are complete
+        if self.done:
+            self._write(self.n_win)
+        else:
+            self.current = int(idx[-1])
+            self._write(self.current)
+        return n
+
+    def close (self):
+        """Write the remaining windows up to the window containing the last site"""
+        if not self.done and self.counter["Lines parsed"]:
+            self._write(self.current+1)
+        self.done = True
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+    def _sites (self, df):
+        """Check sites coordinates and return arrays of chromosome ids, keys, median llr, positions and number of motifs"""
+        start = df["start"].values.astype(np.int64)
+        end = df["end"].values.astype(np.int64)
+        chr_id = self.coordgen.chr_ids(df["chromosome"].values, start, end)
+        key = self.chr_offset[chr_id]+start+end
+        pos = start+(end-start)//2
+        return (chr_id, key, df["median_llr"].values.astype(np.float64), pos, df["num_motifs"].values.astype(np.int64))
+
+    def _win_coords (self, idx):
+        """Return arrays of chromosome ids, starts and ends of windows from their index"""
+        chr_id = np.searchsorted(self.win_offset, idx, side="right")-1
+        start = (idx-self.win_offset[chr_id])*self.window_step
+        end = np.minimum(start+self.interval_size, self.chr_len[chr_id])
+        return (chr_id, start, end)
+
+    def _write_intervals (self, stop, win_idx, num_motifs, llr, pos, offsets, med_llr=None):
+        """
+        Write the non empty intervals win_idx and count all the intervals from the first interval not written yet
+        up to stop (excluded)
+        """
+        self.counter["Total number of intervals"]+=stop-self.written
+        self.writer.skip(stop-self.written-len(win_idx))
+        if len(win_idx):
+            chr_id, start, end = self._win_coords(win_idx)
+            self.writer.write_batch (
+                chr_name=self.chr_name[chr_id],
+                start=start,
+                end=end,
+                num_motifs=num_motifs,
+                llr_list=llr,
+                pos_list=pos,
+                offsets=offsets,
+                med_llr=med_llr)
+        self.written = stop
+
+    def _init_buffer (self):
+        """Empty the sites buffer"""
+        self._idx = []
+        self._llr = []
+        self._pos = []
+        self._num_motifs = []
+
+    def _write (self, stop):
+        """Aggregate buffered sites per window and write windows up to stop (excluded)"""
+        start = self.written
+        if stop <= start:
+            return
+        with self.prof.stage("Writing intervals", n_items=stop-start, unit="intervals"):
+            idx = np.concatenate(self._idx)
+            llr = np.concatenate(self._llr)
+            pos = np.concatenate(self._pos)
+            num_motifs = np.concatenate(self._num_motifs)
+
+            # Sites are sorted by window so non empty windows are contiguous segments
+            i = int(np.searchsorted(idx, stop, side="left"))
+            seg_start = np.flatnonzero(np.diff(idx[:i], prepend=-1))
+            offsets = np.append(seg_start, i)
+            sum_motifs = np.add.reduceat(num_motifs[:i], seg_start) if i else num_motifs[:0]
+            self._write_intervals (stop, idx[seg_start], sum_motifs, llr[:i], pos[:i], offsets)
+
+            # Keep sites of the current window
+            self._init_buffer()
+            self._idx.append(idx[i:])
+            self._llr.append(llr[i:])
+            self._pos.append(pos[i:])
+            self._num_motifs.append(num_motifs[i:])
+
+class Rolling_Window_Binner(Interval_Binner):
+    """
+    Assign CpG sites to overlapping sliding windows, starting every window_step. Buffered sites are kept sorted by key and each
+    site is credited to all the windows containing its center. Windows containing sites are derived from the range of windows
+    of each site, and the sites of each window are found as a contiguous slice with 2 binary searches. As both bounds of the
+    slices only increase from a window to the next one, medians are updated with a rolling median where sites entering and
+    leaving the window are inserted and removed, rather than computed from scratch for each window.
+    """
+
+    def __init__ (self, coordgen, writer, interval_size=1000, window_step=100, counter=None, profiler=None):
+        """"""
+        super().__init__ (coordgen, writer, interval_size=interval_size, window_step=window_step, counter=counter, profiler=profiler)
+        self.chr_n_win = np.diff(self.win_offset)
+        self._max_key = -1
+
+    #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
+    def add (self, df):
+        """
+        Buffer a chunk of CpG sites and write all the windows completed. Return the number of sites consumed
+        * df
+            DataFrame chunk of CpG_Aggregate sites
+        """
+        if self.done:
+            return 0
+
+        chr_id, key, llr, pos, num_motifs = self._sites(df)
+        n = len(key)
+        self.counter["Lines parsed"]+=n
+        self._max_key = max(self._max_key, int(key.max()))
+        self._key.append(key)
+        self._llr.append(llr)
+        self._pos.append(pos)
+        self._num_motifs.append(num_motifs)
+
+        # Windows ending before the last site are complete
+        self._write(int(self._win_range(np.array([self._max_key]))[0][0]))
+        return n
+
+    def close (self):
+        """Write the remaining windows up to the last window containing the last site"""
+        if not self.done and self.counter["Lines parsed"]:
+            self._write(int(self._win_range(np.array([self._max_key]))[1][0])+1)
+        self.done = True
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+    def _win_range (self, key):
+        """Return the index of the first and of the last windows containing site keys"""
+        chr_id = np.searchsorted(self.chr_offset, key, side="right")-1
+        center2 = key-self.chr_offset[chr_id]
+        size2 = 2*self.interval_size
+        step2 = 2*self.window_step
+        first = self.win_offset[chr_id]+np.maximum(-((size2-center2)//step2), 0)
+        last = self.win_offset[chr_id]+np.minimum(center2//step2, self.chr_n_win[chr_id]-1)
+        return (first, last)
+
+    def _init_buffer (self):
+        """Empty the sites buffer"""
+        self._key = []
+        self._llr = []
+        self._pos = []
+        self._num_motifs = []
+
+    def _write (self, stop):
+        """Gather buffered sites of each window, compute rolling medians and write windows up to stop (excluded)"""
+        start = self.written
+        if stop <= start:
+            return
+        with self.prof.stage("Writing intervals", n_items=stop-start, unit="intervals"):
+            key = np.concatenate(self._key)
+            llr = np.concatenate(self._llr)
+            pos = np.concatenate(self._pos)
+            num_motifs = np.concatenate(self._num_motifs)
+
+            # Sort sites if they are not already sorted
+            if (np.diff(key) < 0).any():
+                order = np.argsort(key, kind="stable")
+                key, llr, pos, num_motifs = key[order], llr[order], pos[order], num_motifs[order]
+
+            # Windows containing sites are the union of the ranges of windows of all sites. Ranges are sorted as sites are
+            first, last = self._win_range(key)
+            first, last = np.maximum(first, start), np.minimum(last, stop-1)
+            valid = first <= last
+            first, last = first[valid], last[valid]
+            new_run = np.ones(len(first), dtype=bool)
+            new_run[1:] = first[1:] > last[:-1]
+            run_start = np.flatnonzero(new_run)
+            run_first = first[run_start]
+            run_last = np.maximum.reduceat(last, run_start) if len(run_start) else run_first
+            run_len = run_last-run_first+1
+            run_offsets = np.zeros(len(run_len)+1, dtype=np.int64)
+            np.cumsum(run_len, out=run_offsets[1:])
+            win_idx = np.repeat(run_first-run_offsets[:-1], run_len)+np.arange(run_offsets[-1])
+
+            # Slice of sites contained in each window
+            win_chr_id, win_start, win_end = self._win_coords(win_idx)
+            lo = np.searchsorted(key, self.chr_offset[win_chr_id]+2*win_start, side="left")
+            hi = np.searchsorted(key, self.chr_offset[win_chr_id]+2*win_end, side="right")
+            offsets = np.zeros(len(win_idx)+1, dtype=np.int64)
+            np.cumsum(hi-lo, out=offsets[1:])
+            site_idx = np.repeat(lo-offsets[:-1], hi-lo)+np.arange(offsets[-1])
+            cum_motifs = np.zeros(len(key)+1, dtype=np.int64)
+            np.cumsum(num_motifs, out=cum_motifs[1:])
+
+            # Rolling median over windows
+            med_llr = np.empty(len(win_idx), dtype=np.float64)
+            rolling = RollingMedian()
+            llr_list = llr.tolist()
+            cur_lo = cur_hi = 0
+            for i, (l, h) in enumerate(zip(lo.tolist(), hi.tolist())):
+                if l >= cur_hi:
+                    rolling.clear()
+                    cur_lo = cur_hi = l
+                rolling.add(llr_list[cur_hi:h])
+                rolling.remove(llr_list[cur_lo:l])
+                cur_lo, cur_hi = l, h
+                med_llr[i] = rolling.median()
+
+            self._write_intervals (stop, win_idx, cum_motifs[hi]-cum_motifs[lo], llr[site_idx], pos[site_idx], offsets, med_llr)
+
+            # Only keep sites that can still be in the next windows
+            self._init_buffer()
+            if stop < self.n_win:
+                win_chr_id, win_start, win_end = self._win_coords(np.array([stop]))
+                i = int(np.searchsorted(key, self.chr_offset[win_chr_id[0]]+2*win_start[0], side="left"))
+                self._key.append(key[i:])
+                self._llr.append(llr[i:])
+                self._pos.append(pos[i:])
+                self._num_motifs.append(num_motifs[i:])
+
+class Interval_Index_Binner(Interval_Binner):
+    """
+    Assign CpG sites to possibly overlapping intervals. Intervals are sorted by start and indexed with the running maximum of
+    their ends, which tells when all the intervals before a given index are complete. Buffered sites are kept sorted by key and
+    the sites of each complete interval are then found as a contiguous slice with 2 binary searches. Each site is credited to
+    all the intervals containing it in O((N+M) log N) without rescanning the sites for each interval.
+    """
+
+    def __init__ (self, coordgen, writer, win_chr_id, win_start, win_end, counter=None, profiler=None):
+        """"""
+        super().__init__ (coordgen, writer, interval_size=None, counter=counter, profiler=profiler)
+
+        # Sort intervals by chromosome, start and end, keeping the original order for identical intervals
+        order = np.lexsort((win_end, win_start, win_chr_id))
+        self.win_chr_id = np.asarray(win_chr_id, dtype=np.int64)[order]
+        self.win_start = np.asarray(win_start, dtype=np.int64)[order]
+        self.win_end = np.asarray(win_end, dtype=np.int64)[order]
+        self.n_win = len(self.win_start)
+
+        # Intervals keys. The running maximum of ends is monotonic and can be used with searchsorted
+        self.win_start_key = self.chr_offset[self.win_chr_id]+2*self.win_start
+        self.win_end_key = self.chr_offset[self.win_chr_id]+2*self.win_end
+        self.win_max_end_key = np.maximum.accumulate(self.win_end_key) if self.n_win else self.win_end_key
+        self._max_key = -1
+
+    #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
+    def add (self, df):
+        """
+        Buffer a chunk of CpG sites and write all the intervals completed. Return the number of sites consumed,
+        which is less than the chunk length if all the intervals were completed before the end of the chunk.
+        * df
+            DataFrame chunk of CpG_Aggregate sites
+        """
+        if self.done:
+            return 0
+
+        chr_id, key, llr, pos, num_motifs = self._sites(df)
+
+        # Stop after the first site after the end of all intervals
+        max_key = np.maximum.accumulate(key)
+        np.maximum(max_key, self._max_key, out=max_key)
+        n = len(key)
+        if not self.n_win or max_key[-1] > self.win_max_end_key[-1]:
+            n = int(np.searchsorted(max_key, self.win_max_end_key[-1] if self.n_win else -1, side="right"))+1
+            self.done = True
+        self.counter["Lines parsed"]+=n
+        self._max_key = int(max_key[n-1])
+
+        # Keep sites buffer sorted by key
+        self._key.append(key[:n])
+        self._llr.append(llr[:n])
+        self._pos.append(pos[:n])
+        self._num_motifs.append(num_motifs[:n])
+
+        # Intervals ending before the last site are complete
+        if self.done:
+            self._write(self.n_win)
+        else:
+            self._write(int(np.searchsorted(self.win_max_end_key, self._max_key, side="left")))
+        return n
+
+    def close (self):
+        """Write all the remaining intervals"""
+        self._write(self.n_win)
+        self.done = True
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+    def _win_coords (self, idx):
+        """Return arrays of chromosome ids, starts and ends of intervals from their index"""
+        return (self.win_chr_id[idx], self.win_start[idx], self.win_end[idx])
+
+    def _init_buffer (self):
+        """Empty the sites buffer"""
+        self._key = []
+        self._llr = []
+        self._pos = []
+        self._num_motifs = []
+
+    def _write (self, stop):
+        """Gather buffered sites of each interval and write intervals up to stop (excluded)"""
+        start = self.written
+        if stop <= start:
+            return
+        with self.prof.stage("Writing intervals", n_items=stop-start, unit="intervals"):
+            key = np.concatenate(self._key) if self._key else np.zeros(0, dtype=np.int64)
+            llr = np.concatenate(self._llr) if self._llr else np.zeros(0, dtype=np.float64)
+            pos = np.concatenate(self._pos) if self._pos else np.zeros(0, dtype=np.int64)
+            num_motifs = np.concatenate(self._num_motifs) if self._num_motifs else np.zeros(0, dtype=np.int64)
+
+            # Sort sites if they are not already sorted
+            if (np.diff(key) < 0).any():
+                order = np.argsort(key, kind="stable")
+                key, llr, pos, num_motifs = key[order], llr[order], pos[order], num_motifs[order]
+
+            # Slice of sites contained in each non empty interval
+            lo = np.searchsorted(key, self.win_start_key[start:stop], side="left")
+            hi = np.searchsorted(key, self.win_end_key[start:stop], side="right")
+            nonempty = np.flatnonzero(hi > lo)
+            lo, hi = lo[nonempty], hi[nonempty]
+            offsets = np.zeros(len(nonempty)+1, dtype=np.int64)
+            np.cumsum(hi-lo, out=offsets[1:])
+            site_idx = np.repeat(lo-offsets[:-1], hi-lo)+np.arange(offsets[-1])
+            cum_motifs = np.zeros(len(key)+1, dtype=np.int64)
+            np.cumsum(num_motifs, out=cum_motifs[1:])
+            self._write_intervals (stop, nonempty+start, cum_motifs[hi]-cum_motifs[lo], llr[site_idx], pos[site_idx], offsets)
+
+            # Only keep sites that can still be in the next intervals
+            self._init_buffer()
+            if stop < self.n_win:
+                i = int(np.searchsorted(key, self.win_start_key[stop], side="left"))
+                self._key.append(key[i:])
+                self._llr.append(llr[i:])
+                self._pos.append(pos[i:])
+                self._num_motifs.append(num_motifs[i:])
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~Interval_Writer HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class Interval_Writer():
-    """Extract data for valid sites and write to BED and/or TSV file"""
+    """Extract data for valid sites and write to BED, TSV and/or Parquet file"""
 
-    def __init__ (self, bed_fn=None, tsv_fn=None, sample_id=None, min_llr=2, min_cpg_per_interval=5, verbose=True):
+    def __init__ (self, bed_fn=None, tsv_fn=None, parquet_fn=None, sample_id=None, min_llr=2, min_cpg_per_interval=5, batch_size=10000, verbose=True):
         """"""
         self.log = get_logger (name="Interval_Writer", verbose=verbose)
         self.counter = Counter()
         self.sample_id = sample_id
         self.min_llr = min_llr
         self.min_cpg_per_interval = min_cpg_per_interval
+        self.batch_size = batch_size
         self.bed_fn = bed_fn
         self.tsv_fn = tsv_fn
+        self.parquet_fn = parquet_fn
         self.bed_fp = self._init_bed () if bed_fn else None
         self.tsv_fp = self._init_tsv () if tsv_fn else None
+        self.parquet_fp = self._init_parquet () if parquet_fn else None
 
         # Color score tables
         self.pos_colors = OrderedDict()
@@ -183,29 +641,130 @@ class Interval_Writer():
         self.neg_colors[-min_llr]='52,168,194'
         self.neg_colors[0]='230,230,230'
 
+        # Buffer of intervals waiting to be written
+        self._init_batch()
+
     #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
     def write (self, coord, num_motifs, llr_list, pos_list):
-        """"""
-        if not llr_list:
-             self.counter["Empty intervals skipped"]+=1
-        elif len(llr_list) < self.min_cpg_per_interval:
-            self.counter["Low CpG intervals skipped"]+=1
-        else:
-            self.counter["Valid intervals written"]+=1
-            med_llr = round(np.median(llr_list), 3) # No points going further as nanopolish precision if 2 digits only
+        """Buffer an interval and write all buffered intervals at once when the batch is full"""
+        self._coords.append(coord)
+        self._num_motifs.append(num_motifs)
+        self._llr_list.extend(llr_list)
+        self._pos_list.extend(pos_list)
+        self._offsets.append(len(self._llr_list))
+        if len(self._coords) >= self.batch_size:
+            self.flush()
+
+    def skip (self, n):
+        """Count empty intervals that were not passed to the writer"""
+        if n:
+            self.counter["Empty intervals skipped"]+=int(n)
+
+    def flush (self):
+        """Write all buffered intervals"""
+        if self._coords:
+            self.write_batch (
+                chr_name=[coord.chr_name for coord in self._coords],
+                start=[coord.start for coord in self._coords],
+                end=[coord.end for coord in self._coords],
+                num_motifs=self._num_motifs,
+                llr_list=self._llr_list,
+                pos_list=self._pos_list,
+                offsets=self._offsets)
+            self._init_batch()
+
+    def write_batch (self, chr_name, start, end, num_motifs, llr_list, pos_list, offsets, med_llr=None):
+        """
+        Write many intervals at once. Medians are computed with a single segmented operation over the flat llr buffer
+        * chr_name
+            List or array of interval chromosome names
+        * start
+            List or array of interval starts
+        * end
+            List or array of interval ends
+        * num_motifs
+            List of number of motifs per interval
+        * llr_list
+            Flat list of the CpG median llr of all intervals
+        * pos_list
+            Flat list of the CpG positions of all intervals
+        * offsets
+            Start index of each interval in llr_list and pos_list, followed by the total length
+        * med_llr
+            Median llr of each interval if already computed
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        chr_name = np.asarray(chr_name, dtype=object)
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        num_motifs = np.asarray(num_motifs, dtype=np.int64)
+        n_cpg = np.diff(offsets)
+        empty = n_cpg == 0
+        valid = ~empty & (n_cpg >= self.min_cpg_per_interval)
+        for key, n in (
+            ("Empty intervals skipped", np.count_nonzero(empty)),
+            ("Low CpG intervals skipped", np.count_nonzero(~empty & ~valid)),
+            ("Valid intervals written", np.count_nonzero(valid))):
+            if n:
+                self.counter[key]+=int(n)
+
+        # No points going further as nanopolish precision if 2 digits only
+        med_llr = np.round(segment_median(llr_list, offsets) if med_llr is None else np.asarray(med_llr, dtype=np.float64), 3)
+        colors = self._bed_colors(med_llr) if self.bed_fn else None
+        if self.tsv_fn or self.parquet_fn:
+            llr_array = np.asarray(llr_list, dtype=np.float64)
+            pos_array = np.asarray(pos_list, dtype=np.int64)
+        if self.tsv_fn:
+            llr_list = llr_array.tolist()
+            pos_list = pos_array.tolist()
+
+        valid_idx = np.flatnonzero(valid)
+        for idx, c, s, e, n in zip(valid_idx.tolist(), chr_name[valid].tolist(), start[valid].tolist(), end[valid].tolist(), num_motifs[valid].tolist()):
             if self.bed_fn:
-                self._write_bed (coord, med_llr)
+                self._write_bed (c, s, e, med_llr[idx], colors[idx])
             if self.tsv_fn:
-                self._write_tsv (coord, num_motifs, med_llr, llr_list, pos_list)
+                i, j = offsets[idx], offsets[idx+1]
+                self._write_tsv (c, s, e, n, med_llr[idx], llr_list[i:j], pos_list[i:j])
+
+        if self.parquet_fn and valid.any():
+            pa, pq = import_pyarrow()
+            valid_cpg = np.repeat(valid, n_cpg)
+            valid_offsets = np.zeros(len(valid_idx)+1, dtype=np.int64)
+            np.cumsum(n_cpg[valid], out=valid_offsets[1:])
+            self.parquet_fp.write ([
+                chr_name[valid].tolist(),
+                start[valid],
+                end[valid],
+                num_motifs[valid],
+                med_llr[valid],
+                pa.LargeListArray.from_arrays(valid_offsets, llr_array[valid_cpg]),
+                pa.LargeListArray.from_arrays(valid_offsets, pos_array[valid_cpg])])
 
     def close (self):
-        for fp in (self.bed_fp, self.tsv_fp):
+        self.flush()
+        for fp in (self.bed_fp, self.tsv_fp, self.parquet_fp):
             try:
                 fp.close()
             except:
                 pass
 
     #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+    def _init_batch (self):
+        """Empty the intervals buffer"""
+        self._coords = []
+        self._num_motifs = []
+        self._llr_list = []
+        self._pos_list = []
+        self._offsets = [0]
+
+    def _bed_colors (self, med_llr):
+        """Vectorized selection of the track colors from an array of median llr"""
+        pos = med_llr >= 0
+        condlist = [pos & (med_llr >= min_llr) for min_llr in self.pos_colors.keys()]
+        condlist+= [~pos & (med_llr <= min_llr) for min_llr in self.neg_colors.keys()]
+        choicelist = list(self.pos_colors.values())+list(self.neg_colors.values())
+        return np.select(condlist, choicelist, default=self.neg_colors[0])
+
     def _init_bed (self):
         """Open BED file and write file header"""
         self.log.debug("Initialise output bed file")
@@ -214,21 +773,9 @@ class Interval_Writer():
         fp.write("track name={}_Interval itemRgb=On\n".format(self.sample_id))
         return fp
 
-    def _write_bed (self, coord, med_llr):
+    def _write_bed (self, chr_name, start, end, med_llr, color):
         """Write line to BED file"""
-
-        # Define track color depending on med_llr value
-        if med_llr>=0:
-            for min_llr, color in self.pos_colors.items():
-                if med_llr >= min_llr:
-                    break
-        else:
-            for min_llr, color in self.neg_colors.items():
-                if med_llr <= min_llr:
-                    break
-
-        # Write line
-        res_line = [coord.chr_name, coord.start, coord.end, ".", med_llr, ".", coord.start, coord.end, color]
+        res_line = [chr_name, start, end, ".", med_llr, ".", start, end, color]
         self.bed_fp.write(str_join(res_line, sep="\t", line_end="\n"))
 
     def _init_tsv (self):
@@ -242,37 +789,60 @@ class Interval_Writer():
         fp.write(str_join(header, sep="\t", line_end="\n"))
         return fp
 
-    def _write_tsv (self, coord, num_motifs, med_llr, llr_list, pos_list):
+    def _write_tsv (self, chr_name, start, end, num_motifs, med_llr, llr_list, pos_list):
         """Write line to TSV file"""
-        res_line = [coord.chr_name, coord.start, coord.end, num_motifs, med_llr, list_to_str(llr_list), list_to_str(pos_list)]
+        res_line = [chr_name, start, end, num_motifs, med_llr, list_to_str(llr_list), list_to_str(pos_list)]
         self.tsv_fp.write(str_join(res_line, sep="\t", line_end="\n"))
 
-#~~~~~~~~~~~~~~~~~~~~~~~~~~~Interval generator helper functions~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-def sliding_intervals_gen (coordgen, interval_size=1000):
+    def _init_parquet (self):
+        """Open Parquet file with native list columns for llr values and positions"""
+        self.log.debug("Initialise output parquet file")
+        pa, pq = import_pyarrow()
+        schema = pa.schema([
+            ("chromosome", pa.string()), ("start", pa.int64()), ("end", pa.int64()), ("num_motifs", pa.int64()),
+            ("median_llr", pa.float64()), ("llr_list", pa.large_list(pa.float64())), ("pos_list", pa.large_list(pa.int64()))])
+        return ParquetWriter(self.parquet_fn, schema)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~Interval helper functions~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+def resolution_fn (fn, interval_size):
     """
-    Generate sliding window coordinate intervals over the entire reference genome provided
+    Add the interval size as a suffix to a file name, before the extension(s). ex: out.tsv.gz => out_1000bp.tsv.gz
     """
-    for chr_name, chr_len in coordgen.chr_name_len.items():
-        for start in range(0, chr_len, interval_size):
-            end = start+interval_size if start+interval_size <= chr_len else chr_len
-            yield (coordgen(chr_name, start, end))
+    if not fn:
+        return fn
+    dirname, basename = os.path.split(fn)
+    ext = ""
+    if basename.endswith(".gz"):
+        basename, ext = basename[:-3], ".gz"
+    stem, dot, last_ext = basename.rpartition(".")
+    if not dot:
+        stem, last_ext = last_ext, ""
+    else:
+        last_ext = "."+last_ext
+    return os.path.join(dirname, "{}_{}bp{}{}".format(stem, interval_size, last_ext, ext))
 
-def bed_intervals_gen (coordgen, interval_bed_fn):
+def bed_intervals (coordgen, interval_bed_fn):
     """
-    Generate coordinate intervals corresponding to the provided bed file
+    Load coordinate intervals corresponding to the provided bed file, in the file order.
+    Return arrays of chromosome ids, starts and ends
     """
+    chr_id_list, start_list, end_list = [], [], []
     with FileParser(
         fn=interval_bed_fn,
         colnames=["chrom", "start", "end"],
         dtypes={"start":int,"end":int},
         force_col_len=False,
         comment="track",
+        chunk_size=100000,
         quiet=True) as bed:
 
-        prev_ct = None
-        for line in bed:
-            ct = coordgen(line.chrom, line.start, line.end)
-            if prev_ct and ct < prev_ct:
-                raise ValueError("Unsorted coordinate found in bed file {} found after {}. Chromosomes have to be ordered as in fasta reference file".format(ct, prev_ct))
-            prev_ct = ct
-            yield (ct)
+        for df in bed.iter_chunks():
+            start = df["start"].values.astype(np.int64)
+            end = df["end"].values.astype(np.int64)
+            chr_id_list.append(coordgen.chr_ids(df["chrom"].values, start, end))
+            start_list.append(start)
+            end_list.append(end)
+
+    if not chr_id_list:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    return (np.concatenate(chr_id_list), np.concatenate(start_list), np.concatenate(end_list))
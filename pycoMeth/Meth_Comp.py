@@ -5,13 +5,16 @@
 from collections import OrderedDict, namedtuple, Counter
 import gzip
 import itertools
+import heapq
+import pickle
+import tempfile
+from array import array
+from multiprocessing import Pool
 
 # Third party imports
 from tqdm import tqdm
 import numpy as np
-import pandas as pd
-from scipy.stats import kruskal, mannwhitneyu
-from statsmodels.stats.multitest import multipletests
+# scipy and statsmodels are slow to import and only imported when needed
 
 # Local imports
 from pycoMeth.common import *
@@ -31,9 +34,15 @@ def Meth_Comp (
     pvalue_adj_method:str="fdr_bh",
     pvalue_threshold:float=0.01,
     only_tested_sites:bool=False,
+    threads:int=1,
+    scipy_stats:bool=False,
+    tmp_dir:str="",
     verbose:bool=False,
     quiet:bool=False,
     progress:bool=False,
+    profile:bool=False,
+    profile_dir:str="",
+    metrics_json:str="",
     **kwargs):
     """
     Compare methylation values for each CpG positions or intervals between n samples and perform a statistical test to evaluate if the positions are
@@ -60,11 +69,18 @@ def Meth_Comp (
         Alpha parameter (family-wise error rate) for pValue adjustment
     * only_tested_sites
         Do not include sites that were not tested because of insufficient samples or effect size in the report
+    * threads
+        Number of worker processes used to run the statistical tests by batches of sites, while parsing the input files
+    * scipy_stats
+        Run the statistical tests site by site with scipy.stats instead of the vectorized batch engine (slower)
+    * tmp_dir
+        Directory where to write the temporary results file instead of the system temporary directory
     """
 
     # Init method
     opt_summary_dict = opt_summary(local_opt=locals())
     log = get_logger (name="pycoMeth_CpG_Comp", verbose=verbose, quiet=quiet)
+    prof = Profiler(enabled=profile, profile_dir=profile_dir, metrics_json=metrics_json, prefix="Meth_Comp", options=opt_summary_dict)
 
     log.warning("Checking options and input files")
     log_dict(opt_summary_dict, log.debug, "Options summary")
@@ -100,6 +116,7 @@ def Meth_Comp (
         raise pycoMethError ("Meth_Comp needs at least 2 input files")
 
     log.warning("Parsing files")
+    stats_results = None
     try:
         log.info("Reading input files header and checking consistancy between headers")
         colnames = set()
@@ -116,9 +133,11 @@ def Meth_Comp (
                 label=label,
                 dtypes={"start":int,"end":int,"median_llr":float},
                 verbose=verbose, quiet=quiet,
-                include_byte_len=True)
+                include_byte_len=True,
+                chunk_size=100000)
             all_fp_len+=len(fp)
             fp_list.append(fp)
+            prof.add_counter("Parsing summary {}".format(label), fp.counter)
 
             # Check colnames
             if not colnames:
@@ -144,76 +163,84 @@ def Meth_Comp (
             min_diff_llr = min_diff_llr,
             min_samples = min_samples,
             input_type=input_type,
-            only_tested_sites=only_tested_sites)
+            only_tested_sites=only_tested_sites,
+            threads=threads,
+            scipy_stats=scipy_stats,
+            tmp_dir=tmp_dir,
+            profiler=prof)
+        prof.add_counter("Results summary", stats_results.counter)
+        prof.add_files(input_fn=[aggregate_fn_list, ref_fasta_fn], output_fn=[output_bed_fn, output_tsv_fn])
 
         log.info("Starting asynchronous file parsing")
-        with tqdm (total=all_fp_len, unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
+        with prof.stage("Parsing and merging files", unit="lines"), tqdm (total=all_fp_len, unit=" bytes", unit_scale=True, desc="\tProgress", disable=not progress) as pbar:
 
-            coord_d = defaultdict(list)
+            # Fixed sample slots ordered by label
+            fp_list.sort(key=lambda x: x.label)
 
-            # Read first line from each file
+            # Read first line from each file and index by coordinate and slot in a heap
             log.debug("Reading first lines")
-            for fp in fp_list:
-                # Move pointer up and index by coordinate
+            heap = []
+            for slot, fp in enumerate(fp_list):
                 try:
                     line = fp.next()
                     coord = coordgen(line.chromosome, line.start, line.end)
-                    coord_d[coord].append(fp)
+                    heap.append((coord.chr_id, coord.start, coord.end, slot, coord))
                     pbar.update(line.byte_len)
                 except StopIteration:
                     raise pycoMethError ("Empty file found")
+            heapq.heapify(heap)
 
-            # Continue reading lines from all files
+            # k-way merge of all files
             log.debug("Starting deep parsing")
-            fp_done = 0
-            while True:
-                # Get lower coord if has enough samples
-                lower_coord = sorted(coord_d.keys())[0]
-                coord_fp_list = sorted(coord_d[lower_coord], key=lambda x: x.label)
+            while heap:
+                # Pop all the slots sharing the lower coordinate. Ties are ordered by slot and thus by label
+                chr_id, start, end, slot, lower_coord = heapq.heappop(heap)
+                slot_list = [slot]
+                while heap and heap[0][0] == chr_id and heap[0][1] == start and heap[0][2] == end:
+                    slot_list.append(heapq.heappop(heap)[3])
 
                 # Deal with lower coordinates and compute result if needed
                 stats_results.compute_pvalue(
                     coord=lower_coord,
-                    line_list=[coord_fp.current() for coord_fp in coord_fp_list],
-                    label_list=[coord_fp.label for coord_fp in coord_fp_list])
+                    line_list=[fp_list[slot].current() for slot in slot_list],
+                    label_list=[fp_list[slot].label for slot in slot_list])
 
-                # Remove lower entry and move fp to next sequence
-                del(coord_d[lower_coord])
-                for fp in coord_fp_list:
-
-                    # Move pointer up and index by coordinate
+                # Move pointers up and push next coordinates
+                for slot in slot_list:
+                    fp = fp_list[slot]
                     try:
                         line = fp.next()
                         coord = coordgen(line.chromosome, line.start, line.end)
-                        coord_d[coord].append(fp)
+                        heapq.heappush(heap, (coord.chr_id, coord.start, coord.end, slot, coord))
                         pbar.update(line.byte_len)
                     except StopIteration:
-                        fp_done+=1
-
-                # Exit condition = all file are finished
-                if fp_done == len(fp_list):
-                    break
+                        pass
+        prof.add_items("Parsing and merging files", sum(fp.counter["Lines Parsed"] for fp in fp_list))
 
         # Init file writter
         with Comp_Writer(bed_fn=output_bed_fn, tsv_fn=output_tsv_fn, input_type=input_type, verbose=verbose) as writer:
 
             # Exit condition
-            if not stats_results.res_list:
+            if not len(stats_results):
                 log.info("No valid p-Value could be computed")
 
             else:
                 # Convert results to dataframe and correct pvalues for multiple tests
                 log.info("Adjust pvalues")
-                stats_results.multitest_adjust()
+                with prof.stage("Adjusting pvalues", n_items=len(stats_results), unit="sites"):
+                    stats_results.multitest_adjust()
 
                 # Write output file
                 log.info("Writing output file")
-                for res in tqdm(stats_results.res_list, unit=" sites", unit_scale=True, desc="\tProgress", disable=not progress):
-                    writer.write (res)
+                with prof.stage("Writing results", n_items=len(stats_results), unit="sites"):
+                    for res in tqdm(stats_results, total=len(stats_results), unit=" sites", unit_scale=True, desc="\tProgress", disable=not progress):
+                        writer.write (res)
 
     finally:
-        # Print counters
-        log_dict(stats_results.counter, log.info, "Results summary")
+        # Stop worker processes, remove temporary results and print counters
+        if stats_results is not None:
+            stats_results.close()
+            log_dict(stats_results.counter, log.info, "Results summary")
 
         # Close input and output files
         for fp in fp_list:
@@ -221,6 +248,7 @@ def Meth_Comp (
                 fp.close()
             except:
                 pass
+        prof.report(log.info)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~StatsResults HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
@@ -232,8 +260,17 @@ class StatsResults():
         min_diff_llr=1,
         min_samples=3,
         input_type="Interval_Aggregate",
-        only_tested_sites=False):
-        """"""
+        only_tested_sites=False,
+        threads=1,
+        scipy_stats=False,
+        tmp_dir="",
+        batch_size=1000,
+        profiler=None):
+        """
+        Results are streamed to a temporary file as they are computed, while pvalues are kept in a compact array for the
+        multiple tests adjustment. Adjusted pvalues are joined back to the results when iterating over the object.
+        The time spent running or waiting for statistical tests is recorded by the optional Profiler.
+        """
         # Save self variables
         self.pvalue_method = pvalue_method
         self.pvalue_adj_method = pvalue_adj_method
@@ -242,10 +279,24 @@ class StatsResults():
         self.min_samples = min_samples
         self.input_type = input_type
         self.only_tested_sites = only_tested_sites
+        self.scipy_stats = scipy_stats
+        self.batch_size = batch_size
+        self.profiler = profiler if profiler else Profiler()
 
-        # Init self collections
-        self.res_list = []
+        # Init self collections. Results are pickled in a temporary file and pvalues saved in an array with nan for untested sites
         self.counter = Counter()
+        self._res_fp = tempfile.TemporaryFile(prefix="pycoMeth_", dir=tmp_dir if tmp_dir else None)
+        self._pvalues = array("d")
+        self._adj_pvalues = None
+        self._significant = None
+
+        # Worker processes for statistical tests with pending batches of sites and submitted batches
+        self._pool = Pool(threads) if threads > 1 else None
+        self._batch_tests = threads > 1 or not scipy_stats
+        self._batch_idx = []
+        self._batch_llr = []
+        self._async_results = []
+        self._max_async_results = 2*threads
 
         # Get minimal non-zero float value
         self.min_pval = np.nextafter(float(0), float(1))
@@ -256,14 +307,33 @@ class StatsResults():
         return dict_to_str(self.counter)
 
     def __len__(self):
-        return len(self.res_list)
+        return len(self._pvalues)
 
     def __iter__(self):
-        for i in self.res_list:
-            yield i
+        """Read back results from the temporary file and join pvalues, adjusted pvalues and comments"""
+        self._res_fp.flush()
+        self._res_fp.seek(0)
+        for i in range(len(self._pvalues)):
+            res = pickle.load(self._res_fp)
+            pvalue = self._pvalues[i]
+            # Untested sites keep the nan singleton which is lost when unpickling
+            if np.isnan(pvalue):
+                res["pvalue"] = res["adj_pvalue"] = np.nan
+            else:
+                res["pvalue"] = pvalue
+                if self._adj_pvalues is not None:
+                    res["adj_pvalue"] = float(self._adj_pvalues[i])
+                    res["comment"] = "Significant pvalue" if self._significant[i] else "Non-significant pvalue"
+            yield res
+        self._res_fp.seek(0, 2)
 
     #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
 
+    def close (self):
+        """Stop worker processes if any and remove the temporary results file"""
+        self._stop_pool()
+        self._res_fp.close()
+
     def compute_pvalue (self, coord, line_list, label_list):
         """"""
 
@@ -303,20 +373,12 @@ class StatsResults():
                 if self.input_type == "Interval_Aggregate":
                     raw_pos_list.append(str_to_list(line.pos_list))
 
-            # Run stat test
-            if self.pvalue_method == "KW":
-                statistics, pvalue = kruskal(*raw_llr_list)
-            elif self.pvalue_method == "MW":
-                statistics, pvalue = mannwhitneyu(raw_llr_list[0], raw_llr_list[1], alternative='two-sided')
-
-            # Fix and categorize p-values
-            if pvalue is np.nan or pvalue is None or pvalue>1 or pvalue<0:
-                pvalue = 1.0
-                self.counter["Sites with invalid pvalue"]+=1
-
-            # Correct very low pvalues to minimal float size
-            elif pvalue == 0:
-                pvalue = self.min_pval
+            # Run stat test or defer it to batch processing
+            if self._batch_tests:
+                pvalue = None
+            else:
+                with self.profiler.stage("Statistical tests", n_items=1, unit="sites"):
+                    pvalue = self._fix_pvalue(_stats_test(self.pvalue_method, raw_llr_list))
 
         # Update counters result table
         self.counter[comment]+=1
@@ -343,46 +405,242 @@ class StatsResults():
             res["raw_pos_list"] = raw_pos_list
             res["unique_cpg_pos"] = len(set(itertools.chain.from_iterable(raw_pos_list)))
 
-        self.res_list.append(res)
+        # Stream result to disk and save pvalue apart. Pending pvalues are filled once tested
+        pickle.dump(res, self._res_fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self._pvalues.append(np.nan if pvalue is None else pvalue)
+
+        # Add to pending batch of sites to test
+        if self._batch_tests and comment == "Valid":
+            self._batch_idx.append(len(self._pvalues)-1)
+            self._batch_llr.append(raw_llr_list)
+            if len(self._batch_idx) >= self.batch_size:
+                self._submit_batch()
 
     def multitest_adjust(self):
         """"""
+        # Wait for pvalues computed by batches
+        if self._batch_tests:
+            self._collect_pvalues()
+
         # Collect non-nan pvalues
-        pvalue_idx = []
-        pvalue_list = []
-        for i, res in enumerate(self.res_list):
-            if not res["pvalue"] is np.nan:
-                pvalue_idx.append(i)
-                pvalue_list.append(res["pvalue"])
+        pvalue_array = np.frombuffer(self._pvalues, dtype=np.float64)
+        pvalue_idx = np.flatnonzero(~np.isnan(pvalue_array))
 
         # Adjust values
-        if pvalue_list:
-            adj_pvalue_list = multipletests(
-                pvals = pvalue_list,
+        if len(pvalue_idx):
+            from statsmodels.stats.multitest import multipletests
+            adj_pvalue_array = multipletests(
+                pvals = pvalue_array[pvalue_idx],
                 alpha = self.pvalue_threshold,
                 method = self.pvalue_adj_method)[1]
 
-            # add adjusted values to appropriate category
-            for i, adj_pvalue in zip(pvalue_idx, adj_pvalue_list):
-
-                # Fix and categorize p-values
-                if adj_pvalue is np.nan or adj_pvalue is None or adj_pvalue>1 or adj_pvalue<0:
-                    adj_pvalue = 1.0
-                    comment="Non-significant pvalue"
-
-                elif adj_pvalue <= self.pvalue_threshold:
-                    # Correct very low pvalues to minimal float size
-                    if adj_pvalue == 0:
-                        adj_pvalue = self.min_pval
-                    # update counter if pval is still significant after adjustment
-                    comment = "Significant pvalue"
-                else:
-                    comment= "Non-significant pvalue"
-
-                # update counters and update comment and adj pavalue
-                self.counter[comment]+=1
-                self.res_list[i]["comment"] = comment
-                self.res_list[i]["adj_pvalue"] = adj_pvalue
+            # Fix and categorize p-values
+            invalid = np.isnan(adj_pvalue_array) | (adj_pvalue_array>1) | (adj_pvalue_array<0)
+            adj_pvalue_array[invalid] = 1.0
+            significant = ~invalid & (adj_pvalue_array <= self.pvalue_threshold)
+            # Correct very low pvalues to minimal float size
+            adj_pvalue_array[significant & (adj_pvalue_array == 0)] = self.min_pval
+
+            # update counters in order of first occurence
+            comment_counts = [
+                (np.argmax(significant), "Significant pvalue", np.count_nonzero(significant)),
+                (np.argmin(significant), "Non-significant pvalue", np.count_nonzero(~significant))]
+            for first, comment, count in sorted(comment_counts):
+                if count:
+                    self.counter[comment]+=count
+
+            # Save adjusted values and significance for all results
+            self._adj_pvalues = np.full(len(pvalue_array), np.nan)
+            self._adj_pvalues[pvalue_idx] = adj_pvalue_array
+            self._significant = np.zeros(len(pvalue_array), dtype=bool)
+            self._significant[pvalue_idx] = significant
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+
+    def _fix_pvalue (self, pvalue):
+        """Fix and categorize p-values"""
+        if pvalue is np.nan or pvalue is None or pvalue>1 or pvalue<0:
+            self.counter["Sites with invalid pvalue"]+=1
+            return 1.0
+
+        # Correct very low pvalues to minimal float size
+        elif pvalue == 0:
+            return self.min_pval
+
+        return pvalue
+
+    def _submit_batch (self):
+        """Send pending batch of sites to worker processes or test them directly"""
+        if self._batch_idx:
+            if self._pool:
+                # Wait for the oldest batch when too many are pending, to bound the memory used by queued llr values
+                if len(self._async_results) >= self._max_async_results:
+                    self._fill_async_pvalues(*self._async_results.pop(0))
+                async_res = self._pool.apply_async(_stats_test_batch, (self.pvalue_method, self._batch_llr, self.scipy_stats))
+                self._async_results.append((self._batch_idx, async_res))
+            else:
+                with self.profiler.stage("Statistical tests", n_items=len(self._batch_idx), unit="sites"):
+                    self._fill_pvalues(self._batch_idx, _stats_test_batch(self.pvalue_method, self._batch_llr, self.scipy_stats))
+            self._batch_idx = []
+            self._batch_llr = []
+
+    def _collect_pvalues (self):
+        """Submit last batch and fill pvalues from all batches in coordinate order"""
+        self._submit_batch()
+        for idx_list, async_res in self._async_results:
+            self._fill_async_pvalues(idx_list, async_res)
+        self._async_results = []
+        self._stop_pool()
+
+    def _fill_async_pvalues (self, idx_list, async_res):
+        """Wait for a batch submitted to worker processes and save its pvalues"""
+        with self.profiler.stage("Statistical tests", n_items=len(idx_list), unit="sites"):
+            self._fill_pvalues(idx_list, async_res.get())
+
+    def _fill_pvalues (self, idx_list, pvalue_list):
+        """Fix pvalues of a tested batch and save them in the pvalue array"""
+        for i, pvalue in zip(idx_list, pvalue_list):
+            self._pvalues[i] = self._fix_pvalue(pvalue)
+
+    def _stop_pool (self):
+        """Stop worker processes if any"""
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~Statistical tests helper functions~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def _stats_test (pvalue_method, raw_llr_list):
+    """Run Kruskal Wallis or Mann_Withney test on the raw llr lists of a site and return the pvalue"""
+    from scipy.stats import kruskal, mannwhitneyu
+    if pvalue_method == "KW":
+        statistics, pvalue = kruskal(*raw_llr_list)
+    elif pvalue_method == "MW":
+        statistics, pvalue = mannwhitneyu(raw_llr_list[0], raw_llr_list[1], alternative='two-sided')
+    return pvalue
+
+def _stats_test_batch (pvalue_method, raw_llr_batch, scipy_stats=False):
+    """Run the statistical test on a batch of sites, either with the vectorized engine or site by site with scipy.stats"""
+    if scipy_stats:
+        return [_stats_test(pvalue_method, raw_llr_list) for raw_llr_list in raw_llr_batch]
+
+    # Flatten the batch into values, samples offsets and sites offsets
+    sample_len = [len(llr_list) for raw_llr_list in raw_llr_batch for llr_list in raw_llr_list]
+    site_len = [len(raw_llr_list) for raw_llr_list in raw_llr_batch]
+    values = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(raw_llr_batch)), dtype=np.float64, count=sum(sample_len))
+    sample_offsets = np.zeros(len(sample_len)+1, dtype=np.int64)
+    np.cumsum(sample_len, out=sample_offsets[1:])
+    site_offsets = np.zeros(len(site_len)+1, dtype=np.int64)
+    np.cumsum(site_len, out=site_offsets[1:])
+
+    if pvalue_method == "KW":
+        pvalue_array = kruskal_batch(values, sample_offsets, site_offsets)[1]
+    elif pvalue_method == "MW":
+        pvalue_array = mannwhitneyu_batch(values, sample_offsets, site_offsets)[1]
+
+    # Untestable sites get the same nan value as scipy.stats
+    return [np.nan if np.isnan(pvalue) else pvalue for pvalue in pvalue_array.tolist()]
+
+def _rank_batch (values, sample_offsets, site_offsets):
+    """
+    Rank values within each site with averaged ranks for ties like scipy.stats.rankdata.
+    Return the ranks, the sum of ranks per sample, the tie correction factor per site, and sample to site index
+    """
+    n_sites = len(site_offsets)-1
+    sample_site = np.repeat(np.arange(n_sites), np.diff(site_offsets))
+    value_sample = np.repeat(np.arange(len(sample_offsets)-1), np.diff(sample_offsets))
+    value_site = sample_site[value_sample]
+
+    # Sort values within sites and find groups of ties
+    order = np.lexsort((values, value_site))
+    sorted_values = values[order]
+    sorted_site = value_site[order]
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_site[1:] != sorted_site[:-1])
+    tie_start = np.flatnonzero(first)
+    tie_end = np.append(tie_start[1:], len(values))
+    tie_id = np.cumsum(first)-1
+
+    # Average rank of each group of ties, relative to the site start
+    site_start = np.repeat(sample_offsets[site_offsets[:-1]], np.bincount(value_site, minlength=n_sites))
+    tie_rank = 0.5*(tie_start+tie_end+1)
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[order] = tie_rank[tie_id]-site_start
+
+    # Tie correction factor per site
+    tie_count = (tie_end-tie_start).astype(np.float64)
+    tie_sum = np.bincount(sorted_site[tie_start], weights=tie_count**3-tie_count, minlength=n_sites)
+    size = np.bincount(value_site, minlength=n_sites).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ties = np.where(size < 2, 1.0, 1.0-tie_sum/(size**3-size))
+
+    rank_sums = np.bincount(value_sample, weights=ranks, minlength=len(sample_offsets)-1)
+    return ranks, rank_sums, ties, sample_site
+
+def mannwhitneyu_batch (values, sample_offsets, site_offsets):
+    """
+    Vectorized two-sided Mann_Withney U test with tie and continuity corrections (asymptotic normal approximation),
+    identical to scipy.stats.mannwhitneyu(x, y, alternative="two-sided") from scipy 1.4.1 for each site.
+    Return arrays of U statistics and pvalues (nan for sites where all values are identical)
+    * values
+        Flat array of values of all samples of all sites
+    * sample_offsets
+        Start index of each sample in values, followed by the total length
+    * site_offsets
+        Start index of the 2 samples of each site in sample_offsets, followed by the total number of samples
+    """
+    ranks, rank_sums, ties, sample_site = _rank_batch(values, sample_offsets, site_offsets)
+    n = np.diff(sample_offsets)
+    x_idx = site_offsets[:-1]
+    n1 = n[x_idx]
+    n2 = n[x_idx+1]
+
+    u1 = n1*n2+(n1*(n1+1))/2.0-rank_sums[x_idx]
+    u2 = n1*n2-u1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sd = np.sqrt(ties*n1*n2*(n1+n2+1)/12.0)
+        meanrank = n1*n2/2.0+0.5
+        z = (np.maximum(u1, u2)-meanrank)/sd
+    from scipy.stats import norm
+    pvalue = 2*norm.sf(np.abs(z))
+    pvalue[ties == 0] = np.nan
+    return u2, pvalue
+
+def kruskal_batch (values, sample_offsets, site_offsets):
+    """
+    Vectorized Kruskal Wallis H test with tie correction, identical to scipy.stats.kruskal from scipy 1.4.1 for each site.
+    Return arrays of H statistics and pvalues (nan for sites with an empty sample or where all values are identical)
+    * values
+        Flat array of values of all samples of all sites
+    * sample_offsets
+        Start index of each sample in values, followed by the total length
+    * site_offsets
+        Start index of the samples of each site in sample_offsets, followed by the total number of samples
+    """
+    ranks, rank_sums, ties, sample_site = _rank_batch(values, sample_offsets, site_offsets)
+    n = np.diff(sample_offsets)
+    n_groups = np.diff(site_offsets)
+
+    # Sum over the samples of each site in the same order as scipy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        group_ssbn = rank_sums*rank_sums/n
+    ssbn = np.zeros(len(n_groups), dtype=np.float64)
+    for i in range(n_groups.max() if len(n_groups) else 0):
+        has_group = n_groups > i
+        ssbn[has_group]+=group_ssbn[site_offsets[:-1][has_group]+i]
+
+    totaln = np.bincount(sample_site, weights=n, minlength=len(n_groups))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = 12.0/(totaln*(totaln+1))*ssbn-3*(totaln+1)
+        h/=ties
+    from scipy.stats import chi2
+    pvalue = chi2.sf(h, n_groups-1)
+
+    # Sites that cannot be tested
+    empty = np.bincount(sample_site, weights=n == 0, minlength=len(n_groups)) > 0
+    h[empty] = np.nan
+    pvalue[empty | (ties == 0)] = np.nan
+    return h, pvalue
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~Comp_Writer HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class Comp_Writer():
@@ -11,6 +11,18 @@ import datetime
 import logging
 import json
 import gzip
+import time
+import cProfile
+from contextlib import contextmanager
+from functools import lru_cache
+from bisect import bisect_left, insort
+from importlib.util import find_spec
+
+# Peak memory is only available on Unix platforms
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Local imports
 from pycoMeth import __version__ as pkg_version
@@ -18,15 +30,14 @@ from pycoMeth import __name__ as pkg_name
 
 # Third party imports
 import colorlog
+import numpy as np
 
+# Optional deps are only looked up here and imported on first use to keep the CLI startup fast
 # Optional static export deps
-try:
-    from kaleido.scopes.plotly import PlotlyScope
-    from IPython.core.display import SVG, display
-    STATIC_EXPORT=True
-except (ModuleNotFoundError, ImportError) as E:
-    STATIC_EXPORT=False
-    pass
+STATIC_EXPORT = bool(find_spec("kaleido") and find_spec("IPython"))
+
+# Optional binary columnar format deps
+PARQUET = bool(find_spec("pyarrow"))
 
 #~~~~~~~~~~~~~~FUNCTIONS~~~~~~~~~~~~~~#
 def opt_summary (local_opt):
@@ -48,8 +59,75 @@ def list_to_str (l):
     """Generate a string from any list"""
     return str(json.dumps(l)).replace(" ", "")
 
+def segment_median (a, offsets):
+    """
+    Compute the median of all the segments of a flat array delimited by offsets in a single vectorized operation.
+    Values are identical to np.median applied to each segment, and NaN for empty segments
+    """
+    a = np.asarray(a, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    seg_id = np.repeat(np.arange(len(lengths)), lengths)
+
+    # Sort values within segments and average the 2 middle values (identical for odd lengths)
+    sorted_a = a[np.lexsort((a, seg_id))]
+    med = np.full(len(lengths), np.nan)
+    valid = lengths > 0
+    seg_start = offsets[:-1][valid]
+    med[valid] = (sorted_a[seg_start+(lengths[valid]-1)//2]+sorted_a[seg_start+lengths[valid]//2])/2
+
+    # Propagate NaN values like np.median
+    nan = np.isnan(a)
+    if nan.any():
+        med[np.bincount(seg_id[nan], minlength=len(lengths)) > 0] = np.nan
+    return med
+
+class RollingMedian ():
+    """
+    Running median of a window of values that slides over a sequence. The window is kept as a sorted list in which values are
+    inserted and removed with binary searches, so that the median of each new window position is obtained without sorting the
+    whole window again. Values are identical to np.median applied to the window, including NaN propagation
+    """
+
+    def __init__ (self):
+        self._sorted = []
+        self._n_nan = 0
+
+    def __len__ (self):
+        return len(self._sorted)+self._n_nan
+
+    def add (self, values):
+        """Insert all the values of an iterable in the window"""
+        for v in values:
+            if v != v:
+                self._n_nan+=1
+            else:
+                insort(self._sorted, v)
+
+    def remove (self, values):
+        """Remove all the values of an iterable from the window"""
+        for v in values:
+            if v != v:
+                self._n_nan-=1
+            else:
+                del self._sorted[bisect_left(self._sorted, v)]
+
+    def clear (self):
+        """Empty the window"""
+        self._sorted = []
+        self._n_nan = 0
+
+    def median (self):
+        """Median of the values currently in the window or NaN if empty"""
+        n = len(self._sorted)
+        if self._n_nan or not n:
+            return np.nan
+        return (self._sorted[(n-1)//2]+self._sorted[n//2])/2
+
 def str_to_list (s, parse_int=None, parse_float=None):
-    """Generate a list from a string"""
+    """Generate a list from a string. Lists already parsed from binary files are returned as is"""
+    if isinstance(s, list):
+        return s
     return json.loads(s, parse_int=parse_int, parse_float=parse_float)
 
 def all_in (l1, l2):
@@ -376,12 +454,59 @@ def log_list (l, logger, header="", indent="\t"):
     for i in l:
         logger("{}*{}".format(indent, i))
 
+def file_size_dict (fn_list):
+    """Size in bytes of a list of files, regex or directories. Directories are walked recursively"""
+    d = OrderedDict()
+    for fn_regex in fn_list:
+        for fn in iglob(fn_regex):
+            if os.path.isdir(fn):
+                for root, dirs, files in os.walk(fn):
+                    for f in sorted(files):
+                        d[os.path.join(root, f)] = os.path.getsize(os.path.join(root, f))
+            else:
+                d[fn] = os.path.getsize(fn)
+    return d
+
+def _json_default (o):
+    """Convert numpy scalars and other objects that json cannot serialize"""
+    if isinstance(o, np.generic):
+        return o.item()
+    return str(o)
+
+@lru_cache(maxsize=None)
+def import_pyarrow ():
+    """Import pyarrow on first use and return the pyarrow and pyarrow.parquet modules"""
+    if not PARQUET:
+        raise pycoMethError ("Parquet format is not supported due to missing dependencies (pyarrow)")
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    return pa, pq
+
+def peak_rss_mb ():
+    """
+    Peak resident memory of the current process in MB, or 0 if not available. VmHWM is used on Linux since ru_maxrss is carried
+    over through exec and would include the memory of the parent process
+    """
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    if not resource:
+        return 0.0
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/1024/1024 if sys.platform == "darwin" else maxrss/1024
+
 
 class Kaleido:
     def __init__ (self):
         # Init scopes
         if not STATIC_EXPORT:
             raise ImportError ("Static export is not possible due to missing dependencies")
+        from kaleido.scopes.plotly import PlotlyScope
         self.plotly_scope = PlotlyScope()
 
     def render_plotly_svg (self, fig, width=None, height=None):
@@ -389,6 +514,7 @@ class Kaleido:
         Function to render a plotly figure in SVG inside jupyter
         """
         if STATIC_EXPORT:
+            from IPython.core.display import SVG
             svg_fig = self.plotly_scope.transform(fig, format="svg", width=width, height=height)
             return SVG(svg_fig)
 
@@ -401,6 +527,245 @@ class Kaleido:
             with open (fn, mode="wb") as fp:
                 fp.write(svg_fig)
 
+class ParquetWriter:
+    def __init__ (self, fn, schema, row_group_size=100000):
+        """
+        Buffer columns and write them in a Parquet file by large row groups
+        * fn
+            Path of the Parquet file to write
+        * schema
+            pyarrow schema of the file
+        * row_group_size
+            Minimal number of rows to buffer before writing a row group
+        """
+        if not PARQUET:
+            raise pycoMethError ("Parquet output is not possible due to missing dependencies (pyarrow)")
+        pa, pq = import_pyarrow()
+        mkbasedir (fn, exist_ok=True)
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self._writer = pq.ParquetWriter(fn, schema)
+        self._batches = []
+        self._n_rows = 0
+
+    def write (self, columns):
+        """Buffer a list of arrays or lists corresponding to the schema fields"""
+        pa, pq = import_pyarrow()
+        batch = pa.record_batch(columns, schema=self.schema)
+        if batch.num_rows:
+            self._batches.append(batch)
+            self._n_rows+=batch.num_rows
+            if self._n_rows >= self.row_group_size:
+                self.flush()
+
+    def flush (self):
+        """Write all buffered rows"""
+        if self._batches:
+            pa, pq = import_pyarrow()
+            self._writer.write_table(pa.Table.from_batches(self._batches, schema=self.schema), row_group_size=self._n_rows)
+            self._batches = []
+            self._n_rows = 0
+
+    def close (self):
+        self.flush()
+        self._writer.close()
+
+class Profiler:
+    def __init__ (self, enabled=False, profile_dir="", metrics_json="", prefix="pycoMeth", options=None):
+        """
+        Record the wall time, CPU time, peak memory and throughput of the successive stages of a subcommand.
+        When a stage is started inside another one, the outer stage is paused so that all the times are exclusive.
+        Stages can be started several times and their values are accumulated. The CPU time of worker processes is only
+        counted once they are terminated, in the stage active at that time.
+        * enabled
+            Record stages and log their summary at the end. If False and no file is required all the methods return immediately
+        * profile_dir
+            Directory where to dump the cProfile stats of each stage at the end (implies enabled)
+        * metrics_json
+            Path to write the stages values, registered counters and input/output file sizes in JSON format at the end
+        * prefix
+            Name of the subcommand used as prefix of the cProfile stats files
+        * options
+            Dict of options of the subcommand to include in the metrics file
+        """
+        self.log_summary = enabled or bool(profile_dir)
+        self.enabled = self.log_summary or bool(metrics_json)
+        self.profile_dir = profile_dir
+        self.metrics_json = metrics_json
+        self.prefix = prefix
+        self.options = options if options else OrderedDict()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.input_fn = []
+        self.output_fn = []
+        self._stack = []
+        self._t0 = self._times()
+        if profile_dir:
+            mkdir (profile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage (self, name, n_items=0, unit="items"):
+        """Context manager recording a stage"""
+        self.start(name, unit)
+        try:
+            yield self
+        finally:
+            self.stop(name, n_items)
+
+    def iter (self, name, iterable, unit="items", count=len):
+        """Iterate over iterable and record the time spent to get each element in a stage. Items are counted with count"""
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            self.start(name, unit)
+            n_items = 0
+            try:
+                item = next(it)
+                n_items = count(item) if count else 1
+            except StopIteration:
+                return
+            finally:
+                self.stop(name, n_items)
+            yield item
+
+    def start (self, name, unit="items"):
+        """Start or resume a stage and pause the current one"""
+        if not self.enabled:
+            return
+        if self._stack:
+            self._pause(self._stack[-1])
+        if not name in self.stages:
+            self.stages[name] = {"wall":0.0, "cpu":0.0, "n_items":0, "unit":unit, "peak_rss":0.0, "cprofile":cProfile.Profile() if self.profile_dir else None}
+        self._stack.append(name)
+        self._resume(name)
+
+    def stop (self, name, n_items=0):
+        """Stop a stage, count the items processed and resume the previous one"""
+        if not self.enabled:
+            return
+        if not self._stack or self._stack[-1] != name:
+            raise pycoMethError ("Profiling stage {} stopped before being started".format(name))
+        self._pause(name)
+        self._stack.pop()
+        stage = self.stages[name]
+        stage["n_items"]+=n_items
+        stage["peak_rss"] = max(stage["peak_rss"], peak_rss_mb())
+        if self._stack:
+            self._resume(self._stack[-1])
+
+    def add_items (self, name, n_items):
+        """Count items processed by a stage after it was stopped"""
+        if self.enabled and name in self.stages:
+            self.stages[name]["n_items"]+=n_items
+
+    def add_counter (self, name, counter):
+        """Register a counter to export in the metrics file. Values are read when the file is written"""
+        if self.enabled:
+            self.counters[name] = counter
+
+    def add_files (self, input_fn=None, output_fn=None):
+        """Register input and output files, lists of files, regex or directories to export their size in the metrics file"""
+        if self.enabled:
+            for fn_list, fn in ((self.input_fn, input_fn), (self.output_fn, output_fn)):
+                if isinstance(fn, str):
+                    fn = [fn]
+                for i in fn if fn else []:
+                    if isinstance(i, (list, tuple)):
+                        fn_list.extend(i)
+                    elif i:
+                        fn_list.append(i)
+
+    def metrics (self):
+        """Multilevel dict of raw values for each stage, registered counters and file sizes"""
+        self._stop_all()
+        d = OrderedDict()
+        d["subcommand"] = self.prefix
+        d["package_name"] = pkg_name
+        d["package_version"] = pkg_version
+        exc_type, exc_val = sys.exc_info()[:2]
+        d["status"] = "failed: {}: {}".format(exc_type.__name__, exc_val) if exc_type else "completed"
+        d["options"] = OrderedDict((i, j) for i, j in self.options.items() if i != "kwargs")
+        d["counters"] = OrderedDict((name, OrderedDict(counter)) for name, counter in self.counters.items())
+        d["stages"] = OrderedDict()
+        for name, stage in self.stages.items():
+            sd = OrderedDict()
+            sd["wall_time_s"] = stage["wall"]
+            sd["cpu_time_s"] = stage["cpu"]
+            sd["peak_rss_mb"] = stage["peak_rss"]
+            sd["n_items"] = stage["n_items"]
+            sd["unit"] = stage["unit"]
+            sd["throughput"] = stage["n_items"]/stage["wall"] if stage["wall"] else None
+            d["stages"][name] = sd
+        wall, cpu = [j-i for i, j in zip(self._t0, self._times())]
+        d["total"] = OrderedDict([("wall_time_s", wall), ("cpu_time_s", cpu), ("peak_rss_mb", peak_rss_mb())])
+        for key, fn_list in (("input", self.input_fn), ("output", self.output_fn)):
+            size_d = file_size_dict(fn_list)
+            d[key+"_files"] = size_d
+            d[key+"_bytes"] = sum(size_d.values())
+        return d
+
+    def summary (self):
+        """Multilevel dict of formatted values for each stage and for the whole run"""
+        d = OrderedDict()
+        for name, stage in self.stages.items():
+            sd = OrderedDict()
+            sd["Wall time"] = "{:,.3f} s".format(stage["wall"])
+            sd["CPU time"] = "{:,.3f} s".format(stage["cpu"])
+            sd["Peak RSS"] = "{:,.1f} MB".format(stage["peak_rss"])
+            if stage["n_items"]:
+                sd["Items"] = "{:,} {}".format(stage["n_items"], stage["unit"])
+                if stage["wall"]:
+                    sd["Throughput"] = "{:,.0f} {}/s".format(stage["n_items"]/stage["wall"], stage["unit"])
+            d[name] = sd
+        wall, cpu = [j-i for i, j in zip(self._t0, self._times())]
+        d["Total"] = OrderedDict([("Wall time", "{:,.3f} s".format(wall)), ("CPU time", "{:,.3f} s".format(cpu)), ("Peak RSS", "{:,.1f} MB".format(peak_rss_mb()))])
+        return d
+
+    def report (self, logger):
+        """Log the summary, dump cProfile stats of each stage if profile_dir was given and write the metrics file if metrics_json was given"""
+        if not self.enabled:
+            return
+        # Stages left open by an exception are stopped to count the time spent until the failure
+        self._stop_all()
+        if self.log_summary:
+            log_dict(self.summary(), logger, "Profiling summary")
+        if self.profile_dir:
+            for i, (name, stage) in enumerate(self.stages.items(), 1):
+                fn = "{}_{:02}_{}.prof".format(self.prefix, i, "_".join(name.split()))
+                stage["cprofile"].dump_stats(os.path.join(self.profile_dir, fn))
+                logger("\tcProfile stats of stage {} written to {}".format(name, fn))
+        if self.metrics_json:
+            mkbasedir (self.metrics_json, exist_ok=True)
+            with open (self.metrics_json, "w") as fp:
+                json.dump(self.metrics(), fp, indent=2, default=_json_default)
+            logger("\tRun metrics written to {}".format(self.metrics_json))
+
+    def _stop_all (self):
+        """Stop all the stages still running, starting from the innermost one"""
+        while self._stack:
+            self.stop(self._stack[-1])
+
+    def _pause (self, name):
+        stage = self.stages[name]
+        if stage["cprofile"]:
+            stage["cprofile"].disable()
+        wall, cpu = self._times()
+        stage["wall"]+=wall-stage["_wall"]
+        stage["cpu"]+=cpu-stage["_cpu"]
+
+    def _resume (self, name):
+        stage = self.stages[name]
+        stage["_wall"], stage["_cpu"] = self._times()
+        if stage["cprofile"]:
+            stage["cprofile"].enable()
+
+    def _times (self):
+        """Wall time and CPU time of the process and of its terminated worker processes"""
+        t = os.times()
+        return (time.perf_counter(), t.user+t.system+t.children_user+t.children_system)
+
 #~~~~~~~~~~~~~~CUSTOM EXCEPTION AND WARN CLASSES~~~~~~~~~~~~~~#
 class pycoMethError (Exception):
     """ Basic exception class for pycoMeth package """